@@ -2,23 +2,17 @@
 # coding=utf-8
 
 import argparse
+import concurrent.futures
+import hashlib
 import os
 import json
+import time
 import mutagen
+import mutagen.flac
+import mutagen.mp3
+import mutagen.mp4
 import sys
 
-# main
-parser = argparse.ArgumentParser(
-        description='Extract Albumart')
-
-parser.add_argument('--mpd_dir', 
-                    help = 'MPD Music Directory', 
-                    default = '/var/lib/mpd/music',
-                    required = False)
-
-args = vars(parser.parse_args())
-mpd_dir = args['mpd_dir']
-
 art_names = [
         'cover.png',
         'cover.jpg',
@@ -34,92 +28,349 @@ music_file_exts = [
         'm4a',
         ]
 
-total_created = 0
-total_extract_failures = 0
-total_write_failures = 0
-total_existing = 0
-total_dirs_scanned = 0
-
-for root, dirs, files in os.walk(
-        mpd_dir,
-        followlinks = True):
-    total_dirs_scanned += 1
-    print('Scanned %d directories        ' % (total_dirs_scanned), end = '\r')
-    # test for cover.XXX in directory
-    cover_exists = False
-    for name in art_names:
-        cover_file = os.path.join(root, name)
-        if os.path.exists(cover_file):
-            cover_exists = True
-            break
-
-    if cover_exists:
-        total_existing += 1
-        continue
-
-    # Scan files that match music extension and 
-    # try to source cover from first one found 
-    source_file = None
-    for file in files:
-        for ext in music_file_exts:
-            if file.endswith(ext):
-                 source_file = os.path.join(root, file)
-                 break
-
-        if source_file:
-            # skip any further file checks
-            break
-
-    if source_file:
-        print('Extracting albumart from %s' % (source_file))
-        # Analyse file with mutagen and try to extract albumart
-        albumart_data = None
+
+def extract_embedded_albumart(source_file):
+    # Analyse file with mutagen and try to extract
+    # the first embedded picture
+    # Returns (mime type, data) or (None, None)
+    albumart_mime = None
+    albumart_data = None
+    try:
         mrec = mutagen.File(source_file)
+    except Exception:
+        return (None, None)
 
-        if type(mrec) == mutagen.flac.FLAC:
-            if (len(mrec.pictures) > 0):
-                albumart_mime = mrec.pictures[0].mime
-                albumart_data = mrec.pictures[0].data
+    if mrec is None:
+        return (None, None)
 
-        elif type(mrec) == mutagen.mp3.MP3:
+    if type(mrec) == mutagen.flac.FLAC:
+        if (len(mrec.pictures) > 0):
+            albumart_mime = mrec.pictures[0].mime
+            albumart_data = mrec.pictures[0].data
+
+    elif type(mrec) == mutagen.mp3.MP3:
+        if mrec.tags:
             for tag in mrec.tags.keys():
                 if tag.startswith('APIC'):
                     albumart_mime = mrec.tags[tag].mime
                     albumart_data = mrec.tags[tag].data
                     break
 
-        elif type(mrec) == mutagen.mp4.MP4:
-            if 'covr' in mrec.tags:
-                albumart_data = mrec.tags['covr'][0]
-                if mrec.tags['covr'][0].imageformat == 13:
-                    albumart_mime = 'image/jpg'
+    elif type(mrec) == mutagen.mp4.MP4:
+        if mrec.tags and 'covr' in mrec.tags:
+            albumart_data = bytes(mrec.tags['covr'][0])
+            if mrec.tags['covr'][0].imageformat == 13:
+                albumart_mime = 'image/jpeg'
+            else:
+                albumart_mime = 'image/png'
+
+    if not albumart_data:
+        return (None, None)
+
+    return (albumart_mime, albumart_data)
+
+
+def albumart_mime_to_ext(albumart_mime):
+    # File extension for an albumart mime type
+    albumart_ext = albumart_mime.replace('image/', '')
+    if albumart_ext == 'jpeg':
+        albumart_ext = 'jpg'
+
+    return albumart_ext
+
+
+def scan_music_dirs(mpd_dir):
+    # Walk the music tree with os.scandir()
+    # following symlinks (as os.walk(followlinks = True))
+    # Yields (dir path, dir mtime, file names) with one
+    # directory listing and stat per directory
+    try:
+        root_mtime = os.stat(mpd_dir).st_mtime_ns
+    except OSError:
+        return
+
+    dir_stack = [(mpd_dir, root_mtime)]
+    while dir_stack:
+        dir_path, dir_mtime = dir_stack.pop()
+        file_names = []
+        sub_dirs = []
+        try:
+            with os.scandir(dir_path) as dir_iter:
+                for entry in dir_iter:
+                    try:
+                        if entry.is_dir():
+                            sub_dirs.append(
+                                    (entry.path, entry.stat().st_mtime_ns))
+                        else:
+                            file_names.append(entry.name)
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+
+        yield (dir_path, dir_mtime, file_names)
+
+        # depth-first in name order
+        sub_dirs.sort(reverse = True)
+        dir_stack.extend(sub_dirs)
+
+
+def load_manifest(manifest_file):
+    # Manifest of previous runs
+    # dirs: directory -> mtime (nsecs) of each 
+    # directory fully processed
+    # covers: content hash -> cover file written
+    manifest_dict = {}
+    try:
+        with open(manifest_file, 'r') as json_file:
+            manifest_dict = json.load(json_file)
+    except (OSError, ValueError):
+        pass
+
+    if 'dirs' not in manifest_dict:
+        manifest_dict['dirs'] = {}
+    if 'covers' not in manifest_dict:
+        manifest_dict['covers'] = {}
+
+    return manifest_dict
+
+
+def write_cover(albumart_path, albumart_data, dedupe_mode, cover_dict):
+    # Write a cover file
+    # With dedupe_mode 'hardlink' or 'symlink', an 
+    # identical cover already written (per content hash
+    # in cover_dict) is linked instead of copied
+    # Returns True if linked to an existing cover
+    albumart_hash = hashlib.sha1(albumart_data).hexdigest()
+    existing_path = cover_dict.get(albumart_hash)
+
+    if (dedupe_mode and 
+            existing_path and 
+            existing_path != albumart_path):
+        try:
+            # must still be the same image, not just 
+            # one of the same size
+            with open(existing_path, 'rb') as existing_file:
+                existing_data = existing_file.read()
+            if existing_data == albumart_data:
+                if dedupe_mode == 'hardlink':
+                    os.link(existing_path, albumart_path)
                 else:
-                    albumart_mime = 'image/png'
+                    os.symlink(
+                            os.path.relpath(
+                                existing_path, 
+                                os.path.dirname(albumart_path)),
+                            albumart_path)
+                return True
+        except OSError:
+            # eg hardlink across filesystems
+            # falls back to a copy
+            pass
+
+    aa_file = open(albumart_path, 'wb')
+    aa_file.write(albumart_data)
+    aa_file.close()
+    cover_dict[albumart_hash] = albumart_path
+
+    return False
+
+
+def save_manifest(manifest_file, manifest_dict):
+    # write then rename so an interrupted
+    # save never leaves a corrupt manifest
+    tmp_filename = manifest_file + '.tmp'
+    try:
+        with open(tmp_filename, 'w') as json_file:
+            json.dump(manifest_dict, json_file)
+        os.replace(tmp_filename, manifest_file)
+    except OSError:
+        print('Failed to save manifest %s' % (manifest_file))
+
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Extract Albumart')
+
+    parser.add_argument('--mpd_dir',
+                        help = 'MPD Music Directory',
+                        default = '/var/lib/mpd/music',
+                        required = False)
+
+    parser.add_argument('--workers',
+                        help = 'Extraction worker processes (default CPU count)',
+                        type = int,
+                        default = os.cpu_count() or 1,
+                        required = False)
+
+    parser.add_argument('--manifest',
+                        help = 'Manifest of processed directories',
+                        default = os.path.expanduser(
+                            '~/.cache/mpd2chromecast/extract_albumart.json'),
+                        required = False)
+
+    parser.add_argument('--dedupe',
+                        help = 'Link identical covers to a single copy',
+                        choices = ['hardlink', 'symlink'],
+                        default = None,
+                        required = False)
+
+    parser.add_argument('--full',
+                        help = 'Rescan all directories, ignoring the manifest',
+                        action = 'store_true')
+
+    args = vars(parser.parse_args())
+    mpd_dir = args['mpd_dir']
+    num_workers = max(1, args['workers'])
+    manifest_file = args['manifest']
+    dedupe_mode = args['dedupe']
+
+    # Directories unchanged since the last run
+    # are skipped
+    manifest_dict = load_manifest(manifest_file)
+    if args['full']:
+        manifest_dict['dirs'] = {}
+    dir_dict = manifest_dict['dirs']
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_file)), exist_ok = True)
+
+    total_created = 0
+    total_extract_failures = 0
+    total_write_failures = 0
+    total_existing = 0
+    total_dirs_scanned = 0
+    total_dirs_unchanged = 0
+    total_tracks = 0
+    total_linked = 0
+    total_bytes_saved = 0
+    manifest_save_interval = 1000
+
+    start_time = time.monotonic()
+
+    # Extraction (tag parsing) runs on the worker 
+    # processes. Covers are written here as results 
+    # come in. In-flight jobs are bounded to keep 
+    # image data in memory in check
+    pending_dict = {}
+    max_pending = num_workers * 4
+
+    def process_result(future):
+        global total_created
+        global total_write_failures
+        global total_extract_failures
+        global total_linked
+        global total_bytes_saved
+
+        root, root_mtime, source_file = pending_dict.pop(future)
+        try:
+            albumart_mime, albumart_data = future.result()
+        except Exception:
+            albumart_mime, albumart_data = (None, None)
 
         if albumart_data:
             # Write detected embedded albumart to a file
-            albumart_ext = albumart_mime.replace('image/', '')
-            if albumart_ext == 'jpeg':
-                albumart_ext = 'jpg'
+            albumart_ext = albumart_mime_to_ext(albumart_mime)
             albumart_filename = 'cover.%s' % (albumart_ext)
             albumart_path = os.path.join(root, albumart_filename)
             try:
-                aa_file = open(albumart_path, 'wb')
-                aa_file.write(albumart_data)
-                aa_file.close()
+                if write_cover(
+                        albumart_path, 
+                        albumart_data, 
+                        dedupe_mode,
+                        manifest_dict['covers']):
+                    total_linked += 1
+                    total_bytes_saved += len(albumart_data)
+                    print('Linked %s' % (albumart_path))
+                else:
+                    print('Created %s' % (albumart_path))
                 total_created += 1
-                print('Created %s' % (albumart_path))
             except:
                 print('Failed to create %s' % (albumart_path))
                 total_write_failures += 1
+                # retry on the next run
+                return
         else:
             total_extract_failures += 1
             print('Failed to extract albumart in %s' % (root))
 
+        # Record the mtime after any cover write
+        try:
+            dir_dict[root] = os.stat(root).st_mtime_ns
+        except OSError:
+            pass
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers = num_workers) as executor:
+        for root, root_mtime, files in scan_music_dirs(mpd_dir):
+            total_dirs_scanned += 1
+            print('Scanned %d directories        ' % (total_dirs_scanned), end = '\r')
+
+            # count tracks
+            music_files = []
+            for file in files:
+                for ext in music_file_exts:
+                    if file.endswith(ext):
+                        music_files.append(file)
+                        break
+            total_tracks += len(music_files)
+
+            if dir_dict.get(root) == root_mtime:
+                total_dirs_unchanged += 1
+                continue
+
+            # test for cover.XXX in directory listing
+            file_set = set(files)
+            cover_exists = False
+            for name in art_names:
+                if name in file_set:
+                    cover_exists = True
+                    break
+
+            if cover_exists:
+                total_existing += 1
+                dir_dict[root] = root_mtime
+                continue
+
+            # Try to source cover from first
+            # music file found
+            if not music_files:
+                dir_dict[root] = root_mtime
+                continue
+
+            source_file = os.path.join(root, music_files[0])
+            print('Extracting albumart from %s' % (source_file))
+            future = executor.submit(extract_embedded_albumart, source_file)
+            pending_dict[future] = (root, root_mtime, source_file)
+
+            if len(pending_dict) >= max_pending:
+                done, not_done = concurrent.futures.wait(
+                        list(pending_dict.keys()),
+                        return_when = concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    process_result(future)
+
+            if total_dirs_scanned % manifest_save_interval == 0:
+                save_manifest(manifest_file, manifest_dict)
+
+        for future in concurrent.futures.as_completed(list(pending_dict.keys())):
+            process_result(future)
+
+    save_manifest(manifest_file, manifest_dict)
+    elapsed = max(time.monotonic() - start_time, 0.001)
 
-print('\n\nComplete')
-print('Scanned %d directories' % (total_dirs_scanned))
-print('Created %d covers' % (total_created))
-print('Failed to create %d covers' % (total_write_failures))
-print('Failed to exract albumart in %d directories' % (total_extract_failures))
-print('Found %d existing covers' % (total_existing))
+    print('\n\nComplete')
+    print('Scanned %d directories' % (total_dirs_scanned))
+    print('Skipped %d unchanged directories' % (total_dirs_unchanged))
+    print('Created %d covers' % (total_created))
+    print('Failed to create %d covers' % (total_write_failures))
+    print('Failed to exract albumart in %d directories' % (total_extract_failures))
+    print('Found %d existing covers' % (total_existing))
+    if dedupe_mode:
+        print('Linked %d duplicate covers (%s), saving %d bytes' % (
+            total_linked,
+            dedupe_mode,
+            total_bytes_saved))
+    print('Took %.1f secs, %.1f directories/sec, %.1f tracks/sec' % (
+        elapsed,
+        total_dirs_scanned / elapsed,
+        total_tracks / elapsed))
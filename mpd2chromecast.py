@@ -14,8 +14,35 @@ import sys
 import cherrypy
 import json
 import socket
-import pathlib
 import traceback
+import threading
+import collections
+import uuid
+import http.server
+import http.client
+import mimetypes
+import multiprocessing
+import queue
+import hashlib
+import io
+import sqlite3
+import struct
+import subprocess
+import shutil
+
+# Optional embedded albumart extraction
+# (requires mutagen)
+try:
+    import extract_albumart
+except ImportError:
+    extract_albumart = None
+
+# Optional album art thumbnailing
+# (requires Pillow)
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 
 def log_message(verbose,
@@ -33,22 +60,411 @@ gv_cfg_filename = ''
 gv_cfg_dict = {}
 gv_cfg_dict['castDevice'] = 'Disabled'
 gv_cfg_dict['castMode'] = 'direct' # default 
+gv_cfg_dict['syncThreshold'] = 0.3 # secs
 gv_cast_port = 8090
 gv_platform_variant = 'Unknown'
 gv_stream_albumart_dir = None
 gv_stream_albumart_file = None
 
+# Media server
+# Serves /music and /albumart to cast devices on its 
+# own port using sendfile() with HTTP Range support.
+# Per-request throughput and CPU cost are kept in a
+# history and totals for /stats
+gv_media_port = 8091
+gv_media_chunk_bytes = 1024 * 1024
+gv_media_request_history = collections.deque(maxlen = 50)
+gv_media_stats_dict = {
+        'requests': 0,
+        'rangeRequests': 0,
+        'aborted': 0,
+        'errors': 0,
+        'bytes': 0,
+        'secs': 0.0,
+        'cpuSecs': 0.0,
+        'artTransfers': 0,
+        'artNotModified': 0,
+        }
+gv_media_stats_lock = threading.Lock()
+
+# Embedded album art
+# Served on /art/<track> from the track's own tags
+# for albums without a cover file. Extracted art (or 
+# its absence) is kept in an in-memory LRU bounded at
+# gv_art_cache_max_bytes and gv_art_cache_max_entries and
+# on disk under the cache dir, keyed by track path, 
+# mtime and size
+gv_art_cache = collections.OrderedDict()
+gv_art_cache_lock = threading.Lock()
+gv_art_cache_bytes = 0
+gv_art_cache_max_bytes = 32 * 1024 * 1024
+gv_art_cache_max_entries = 5000
+gv_art_disk_cache = True
+gv_art_cache_dir = None
+gv_art_cache_stats_dict = {
+        'memoryHits': 0,
+        'diskHits': 0,
+        'extractions': 0,
+        'evictions': 0,
+        }
+
+# Album art thumbnails
+# With Pillow available, cover files and embedded art 
+# are re-encoded as JPEGs of at most gv_thumb_max_size 
+# pixels a side and cached on disk, keyed by source path,
+# mtime and size. Cast metadata then points at the
+# thumbnail rather than the (often multi-MB) original
+gv_thumb_max_size = 640
+gv_thumb_quality = 85
+gv_thumb_cache_dir = None
+gv_thumb_stats_dict = {
+        'hits': 0,
+        'created': 0,
+        'failures': 0,
+        'sourceBytes': 0,
+        'thumbBytes': 0,
+        }
+gv_thumb_stats_lock = threading.Lock()
+
+# Album art store
+# The art sent for a track (thumbnail, cover file or 
+# embedded art) is cast as /cover/<key>/<source> where 
+# the key is a hash of the source's path and mtime, so 
+# the cast path costs a stat. The media server makes 
+# the art on first request and stores it as 
+# <key>.<ext>. The URL never changes for the same 
+# source, so it's served as immutable with a strong 
+# ETag and devices fetch it once however many tracks 
+# share a cover file. Keys map to their stored file 
+# in a bounded LRU
+gv_art_store_dir = None
+gv_art_store_dict = collections.OrderedDict()
+gv_art_store_exts = ['jpg', 'png', 'tiff', 'gif', 'bmp', 'webp']
+gv_art_store_lock = threading.Lock()
+gv_art_store_max_entries = 2000
+gv_art_store_stats_dict = {
+        'stored': 0,
+        }
+
+# Library index
+# SQLite database in the cache dir of MPD tracks 
+# (by MPD-relative path) with their audio format and 
+# art source. Synced from MPD's listallinfo at startup
+# and on each MPD database update, only rewriting 
+# tracks whose MPD last-modified time has changed. 
+# Each thread has its own connection. The index is 
+# rebuilt when its schema version changes. Syncs 
+# commit in batches so the write lock is never held
+# for long
+gv_library_db_file = None
+gv_library_schema_version = '3'
+gv_library_sync_batch = 500
+gv_library_local = threading.local()
+gv_library_update_event = threading.Event()
+gv_library_retry_secs = 30
+gv_library_stats_dict = {
+        'syncs': 0,
+        'lastSyncSecs': None,
+        'lastSyncUpdated': 0,
+        'lastSyncRemoved': 0,
+        'lookups': 0,
+        'misses': 0,
+        }
+
+# Media format sniffing
+# Container, codec and stream parameters are read 
+# from the head (and if needed tail) of each file and 
+# cached by path and mtime in memory and the library
+# database. New results are written by the Library 
+# Agent so the cast path never waits on the database
+# write lock
+gv_sniff_bytes = 64 * 1024
+gv_media_info_cache = collections.OrderedDict()
+gv_media_info_cache_max_entries = 5000
+gv_media_info_pending_dict = {}
+gv_media_info_lock = threading.Lock()
+gv_media_info_flush_secs = 5
+gv_media_info_stats_dict = {
+        'sniffed': 0,
+        'cached': 0,
+        'skipped': 0,
+        }
+
+# Cast device capability profiles
+# Containers, codecs and stream limits playable by the
+# default media receiver on each device family. Devices
+# are matched on model name, then on cast type. Tracks 
+# outside a device's profile are skipped before 
+# play_media() rather than failing on the device.
+# Video Chromecasts won't play multichannel audio while
+# Chromecast Audio and Google Home play it as stereo
+# AIFF is left out of both deliberately. It is only
+# sniffed so it can be skipped as the receivers play
+# little-endian PCM in WAV but not big-endian AIFF
+gv_cast_profile_dict = {
+        'video': {
+            'containers': ['flac', 'mpeg', 'adts', 'mp4', 'ogg', 'wav'],
+            'codecs': ['flac', 'mp3', 'aac', 'vorbis', 'opus', 'pcm'],
+            'maxSamplerate': 96000,
+            'maxBits': 24,
+            'maxChannels': 2,
+            },
+        'audio': {
+            'containers': ['flac', 'mpeg', 'adts', 'mp4', 'ogg', 'wav'],
+            'codecs': ['flac', 'mp3', 'aac', 'vorbis', 'opus', 'pcm'],
+            'maxSamplerate': 96000,
+            'maxBits': 24,
+            'maxChannels': 8,
+            },
+        }
+gv_cast_model_profile_dict = {
+        'Chromecast Audio': 'audio',
+        'Google Home': 'audio',
+        'Google Home Mini': 'audio',
+        'Google Home Max': 'audio',
+        'Google Nest Mini': 'audio',
+        'Google Nest Audio': 'audio',
+        }
+gv_cast_type_profile_dict = {
+        'audio': 'audio',
+        'cast': 'video',
+        'group': 'video',
+        }
+
+# Media server worker processes
+# With --media_workers the media server runs in that 
+# many pre-forked processes sharing the port with 
+# SO_REUSEPORT so file streaming can't compete with the
+# agents for the interpreter. Each worker sends its 
+# request stats back to the main process on a queue.
+# Workers are forked and restarted by a single-threaded
+# supervisor process, itself forked before any threads 
+# are started, so no worker is forked with locks held 
+# by other threads.
+# gv_media_worker_index is only set inside a worker
+gv_media_workers = 0
+gv_media_worker_list = []
+gv_media_worker_index = None
+gv_media_stats_queue = None
+gv_media_supervisor = None
+gv_media_supervisor_reported = False
+
+# Audio types missing from the mimetypes module
+mimetypes.add_type('audio/flac', '.flac')
+mimetypes.add_type('audio/x-dsf', '.dsf')
+mimetypes.add_type('audio/x-dff', '.dff')
+mimetypes.add_type('audio/x-wavpack', '.wv')
+mimetypes.add_type('audio/x-ape', '.ape')
+
 # Discovered cast devices dict
 # and related zconf object
 gv_cast_devices_dict = {}
 gv_zconf = None
+gv_cast_browser = None
+
+# Cache dir for persisted state
+# and the on-disk discovered cast devices cache
+# Names of devices loaded from the cache and not yet 
+# confirmed by live discovery are tracked separately
+gv_cache_dir = None
+gv_cast_devices_cache_file = None
+gv_cast_devices_unconfirmed = set()
+gv_cast_devices_lock = threading.Lock()
+
+# Cast device connection pool
+# Live device objects and their status listeners 
+# keyed by device UUID. Idle entries are evicted after
+# gv_cast_pool_idle_secs and entries disconnected for
+# gv_cast_pool_health_secs are reconnected on next use
+gv_cast_pool_dict = {}
+gv_cast_pool_lock = threading.Lock()
+gv_cast_pool_connecting = set()
+gv_cast_pool_idle_secs = 600
+gv_cast_pool_health_secs = 5
+
+# Egress byte rates
+# Bytes sent to each client (by IP) by the media server
+# and stream relay over a sliding window. The agents use
+# these to tell a stalled cast device (not pulling any 
+# data or pulling less than the stream produces) within 
+# gv_egress_stall_secs of it happening. The grace covers
+# the device connecting after a cast
+gv_egress_dict = {}
+gv_egress_lock = threading.Lock()
+gv_egress_window_secs = 5
+gv_egress_stall_secs = 2
+gv_egress_grace_secs = 5
+gv_egress_underflow_ratio = 0.5
+
+# MPD stream relay (castMode mpd)
+# Keeps one connection to MPD's httpd output and fans
+# it out to any number of cast devices on its own port.
+# A ring buffer of recent stream data gives late joiners
+# a prefill and absorbs brief stalls on either side.
+# Port 0 casts MPD's httpd output directly instead
+gv_stream_relay_port = 8092
+gv_mpd_stream_url = 'http://localhost:8000/'
+gv_stream_relay_buffer_bytes = 4 * 1024 * 1024
+gv_stream_relay_prefill_bytes = 128 * 1024
+gv_stream_relay_chunk_bytes = 16 * 1024
+gv_stream_relay_timeout = 5
+gv_stream_relay_idle_secs = 10
+gv_stream_relay = None
+
+# Stream normaliser (optional, needs ffmpeg)
+# Fixed output format for the stream relay as
+# samplerate:bits:channels so MPD format changes don't 
+# need a recast. ffmpeg input formats by MPD stream 
+# content type (probed if not listed)
+gv_stream_format = None
+gv_stream_input_format_dict = {
+        'audio/flac': 'flac',
+        'audio/mpeg': 'mp3',
+        'audio/ogg': 'ogg',
+        'audio/wav': 'wav',
+        'audio/x-wav': 'wav',
+        }
+
+# Cast latency
+# Learnt per device (by UUID) from the status timestamps
+# seen after each load and seek: the time from issuing 
+# the request until the media clock runs from the 
+# requested position. Only status for the requested 
+# media at a plausible position is taken. Averaged over
+# the first samples, then smoothed, and only used once 
+# there are enough. Kept in the cache dir across runs, 
+# saved from the main loop housekeeping. Starts and 
+# seeks are issued ahead by this lead time so rooms 
+# line up
+gv_cast_latency_file = None
+gv_cast_latency_dict = {}
+gv_cast_latency_lock = threading.Lock()
+gv_cast_latency_changed = False
+gv_cast_latency_max_secs = 10
+gv_cast_latency_position_tolerance = 0.5
+gv_cast_latency_min_samples = 3
+gv_cast_latency_weight = 0.25
+gv_cast_start_max_lead_secs = 5
+
+# Multi-room cast sessions
+# castDevice may be a list of device names. The first
+# is the leader, driven directly by the MPD agents 
+# after being connected by a cast_connector in the 
+# background. The others are followers, each with a 
+# cast_session (by name) that drives its device towards
+# the target state published by the agents on every 
+# loop, which never waits on a device
+gv_cast_session_dict = {}
+gv_cast_session_lock = threading.Lock()
+gv_cast_session_max_backoff_secs = 60
+
+# Config file modification time
+# as last loaded
+gv_cfg_last_modified = 0
 
 # Fixed MPD music location
 # may make this configurable in time
 gv_mpd_music_dir = '/var/lib/mpd/music'
 
+# Album art index
+# Music directory (relative path) -> cover file name
+# or None, built lazily with a single scandir() per
+# directory. Entries are revalidated against the 
+# directory mtime at most every 
+# gv_albumart_index_revalidate_secs so repeat lookups
+# for an album don't touch the filesystem (slow on 
+# NFS/SMB mounts). Least recently used entries are 
+# dropped beyond gv_albumart_index_max_entries
+gv_albumart_names = [
+        'cover.png',
+        'cover.jpg',
+        'cover.tiff',
+        'cover.bmp',
+        'cover.gif',
+        ]
+gv_albumart_index = collections.OrderedDict()
+gv_albumart_index_lock = threading.Lock()
+gv_albumart_index_max_entries = 2000
+gv_albumart_index_revalidate_secs = 30
+gv_albumart_index_stats_dict = {
+        'hits': 0,
+        'revalidations': 0,
+        'scans': 0,
+        'evictions': 0,
+        }
+
 # Global MPD agent deadlock timestamp
+# and generation. A stalled MPD agent is replaced by
+# a new generation and the stale one exits if it ever
+# gets going again
 gv_mpd_agent_timestamp = 0
+gv_mpd_agent_generation = 0
+gv_mpd_agent_deadlock_secs = 15
+
+# Agent loop schedulers by name
+gv_loop_scheduler_dict = {}
+
+# Agent supervision
+# Long-lived agents run on the executor and are 
+# restarted individually with backoff on failure.
+# Spare workers allow for stalled agent threads that
+# have been replaced but not yet exited
+gv_executor = None
+gv_agent_dict = {}
+gv_agent_abandoned_list = []
+gv_agent_spare_workers = 3
+gv_agent_max_backoff_secs = 60
+gv_agent_stable_secs = 60
+
+# Agent wake event
+# set by the MPD idle agent whenever one of the
+# watched subsystems changes, by cast device status
+# listeners and by config changes. Used to wake the
+# MPD agents without waiting on a poll interval
+gv_agent_wake_event = threading.Event()
+gv_mpd_idle_subsystems = [
+        'player',
+        'mixer',
+        'playlist',
+        'options',
+        'database',
+        ]
+
+# Fallback wake intervals for the MPD agents
+# The short interval applies while a cast device is
+# active and is needed for elapsed time drift checks.
+# Otherwise we just wait on MPD events
+gv_mpd_active_interval = 1
+gv_mpd_passive_interval = 5
+
+# Position sync (direct mode)
+# MPD is kept this many seconds behind the cast device 
+# so it never reaches the end of a track first. 
+# Differences of gv_seek_detect_secs or more are treated 
+# as a seek on MPD and pushed to the cast device. Smaller
+# drift is corrected on MPD once it exceeds the 
+# syncThreshold config value (secs) with a hold-off 
+# between corrections
+gv_sync_lag_secs = 1.0
+gv_seek_detect_secs = 10
+gv_sync_holdoff_secs = 5
+
+# Cast launch (direct mode)
+# Timeouts for the event waits of each launch stage
+# and a history of per-stage launch timings
+gv_cast_connect_timeout = 10
+gv_cast_idle_timeout = 5
+gv_cast_load_timeout = 10
+gv_cast_launch_history = collections.deque(maxlen = 50)
+
+# Gapless playback (direct mode)
+# The next MPD track is queued on the cast device 
+# this many seconds before the current track ends
+gv_gapless_queue_secs = 15
+# MPD running ahead of the cast device by up to this
+# many seconds at a track change is left to the cast 
+# device queue to catch up on
+gv_gapless_window_secs = 2
 
 
 def determine_platform_variant():
@@ -89,13 +505,341 @@ def determine_platform_variant():
 
 
 
+class playback_clock(object):
+    # Position model for a playing cast session
+    # Extrapolates a float position from the last reported 
+    # position, the time it was reported and the playback 
+    # rate. Also tracks a smoothed drift against a 
+    # reference position (MPD elapsed)
+
+    def __init__(self):
+        self.base_position = 0.0
+        self.base_timestamp = 0
+        self.rate = 1.0
+        self.running = False
+        self.drift = 0.0
+        self.drift_samples = 0
+
+    def update(self, position, rate, running):
+        self.base_position = float(position)
+        self.base_timestamp = time.monotonic()
+        self.rate = float(rate) if rate else 1.0
+        self.running = running
+
+    def position(self):
+        if not self.base_timestamp:
+            return 0.0
+
+        if not self.running:
+            return self.base_position
+
+        return self.base_position + (
+                self.rate * 
+                (time.monotonic() - self.base_timestamp))
+
+    def track_drift(self, reference, lag):
+        # Drift of the reference from where it should 
+        # be (lag seconds behind this clock)
+        # Returns the instantaneous value and keeps a
+        # smoothed one to filter out status jitter
+        drift = self.position() - lag - reference
+        if self.drift_samples == 0:
+            self.drift = drift
+        else:
+            self.drift = (self.drift + drift) / 2
+        self.drift_samples += 1
+
+        return drift
+
+    def reset_drift(self):
+        self.drift = 0.0
+        self.drift_samples = 0
+
+
+class histogram(object):
+    # Bucketed histogram of durations in secs
+    # Bucket bounds are in msecs with a final 
+    # overflow bucket
+
+    bucket_bounds = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+    def __init__(self):
+        self.bucket_counts = [0] * (len(self.bucket_bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, secs):
+        msecs = secs * 1000
+        index = 0
+        while (index < len(self.bucket_bounds) and 
+                msecs > self.bucket_bounds[index]):
+            index += 1
+        self.bucket_counts[index] += 1
+        self.count += 1
+        self.total += secs
+        self.max = max(self.max, secs)
+
+    def to_dict(self):
+        histogram_dict = {}
+        histogram_dict['count'] = self.count
+        histogram_dict['meanMsecs'] = round(
+                self.total / self.count * 1000, 3) if self.count else 0
+        histogram_dict['maxMsecs'] = round(self.max * 1000, 3)
+        histogram_dict['buckets'] = {}
+        for index in range(len(self.bucket_bounds)):
+            histogram_dict['buckets']['<=%d' % (self.bucket_bounds[index])] = (
+                    self.bucket_counts[index])
+        histogram_dict['buckets']['>%d' % (self.bucket_bounds[-1])] = (
+                self.bucket_counts[-1])
+
+        return histogram_dict
+
+
+class loop_scheduler(object):
+    # Fixed-deadline scheduler for agent loops 
+    # on the monotonic clock. Ticks are due every period 
+    # secs from the last deadline rather than a sleep 
+    # after variable work. An optional event wakes the 
+    # loop early without moving the deadline. 
+    # Records tick period, work time and overrun 
+    # (lateness past the deadline) histograms
+
+    def __init__(self, name):
+        global gv_loop_scheduler_dict
+
+        self.name = name
+        self.last_deadline = time.monotonic()
+        self.wake_timestamp = self.last_deadline
+        self.last_tick_timestamp = self.last_deadline
+        self.ticks = 0
+        self.events = 0
+        self.skipped = 0
+        self.period_histogram = histogram()
+        self.work_histogram = histogram()
+        self.overrun_histogram = histogram()
+
+        gv_loop_scheduler_dict[name] = self
+
+    def wait(self, period, event = None):
+        # Wait for the next deadline or the event
+        # Returns True if woken by the event
+        now = time.monotonic()
+        self.work_histogram.add(now - self.wake_timestamp)
+
+        deadline = self.last_deadline + period
+        timeout = max(0, deadline - now)
+        triggered = False
+        if event:
+            triggered = event.wait(timeout)
+            event.clear()
+        else:
+            time.sleep(timeout)
+
+        now = time.monotonic()
+        self.wake_timestamp = now
+        if (triggered and 
+                now < deadline):
+            self.events += 1
+            return True
+
+        # deadline tick
+        self.ticks += 1
+        self.overrun_histogram.add(now - deadline)
+        self.period_histogram.add(now - self.last_tick_timestamp)
+        self.last_tick_timestamp = now
+
+        # Deadlines missed by a full period 
+        # are skipped rather than run back-to-back
+        if now - deadline >= period:
+            self.skipped += int((now - deadline) / period)
+            self.last_deadline = now
+        else:
+            self.last_deadline = deadline
+
+        return triggered
+
+    def to_dict(self):
+        scheduler_dict = {}
+        scheduler_dict['ticks'] = self.ticks
+        scheduler_dict['events'] = self.events
+        scheduler_dict['skipped'] = self.skipped
+        scheduler_dict['period'] = self.period_histogram.to_dict()
+        scheduler_dict['work'] = self.work_histogram.to_dict()
+        scheduler_dict['overrun'] = self.overrun_histogram.to_dict()
+
+        return scheduler_dict
+
+
+class stage_timer(object):
+    # Records the duration of each named stage
+    # of a multi-step operation
+
+    def __init__(self):
+        self.start_timestamp = time.monotonic()
+        self.last_timestamp = self.start_timestamp
+        self.stages = {}
+
+    def mark(self, stage):
+        now = time.monotonic()
+        self.stages[stage] = round(now - self.last_timestamp, 3)
+        self.last_timestamp = now
+
+    def total(self):
+        return round(self.last_timestamp - self.start_timestamp, 3)
+
+    def summary(self):
+        summary_str = ''
+        for stage in self.stages:
+            summary_str += '%s:%.3f ' % (
+                    stage,
+                    self.stages[stage])
+        summary_str += 'total:%.3f' % (self.total())
+
+        return summary_str
+
+
+class cast_status_listener(object):
+    # Last known state of a cast device as pushed by 
+    # pychromecast media, receiver and connection
+    # status listeners. This avoids any network 
+    # round-trip when the agents need cast state
+
+    def __init__(self, cast_device):
+        self.uuid = str(cast_device.uuid)
+        self.latency_probe = None
+        self.clock = playback_clock()
+        self.duration = None
+        self.player_state = 'UNKNOWN'
+        self.content_id = None
+        self.media_timestamp = 0
+        self.volume_level = None
+        self.app_id = None
+        self.cast_timestamp = 0
+        self.connection_status = 'CONNECTING'
+        self.connection_timestamp = time.monotonic()
+        self.event = threading.Event()
+
+        cast_device.media_controller.register_status_listener(self)
+        cast_device.register_status_listener(self)
+        cast_device.register_connection_listener(self)
+
+    def new_media_status(self, status):
+        # status object is updated in place by pychromecast
+        # so we take a copy of the fields of interest
+        self.clock.update(
+                status.current_time,
+                status.playback_rate,
+                status.player_state == 'PLAYING')
+        self.duration = status.duration
+        self.player_state = status.player_state
+        self.content_id = status.content_id
+        self.media_timestamp = time.monotonic()
+
+        # First playing status after a load or seek
+        # The time lost against the requested position
+        # is the device latency. Status for other media
+        # or from before the request (eg a PLAYING status 
+        # racing a seek) leaves the probe for the next 
+        # one until it expires
+        if (self.latency_probe and 
+                status.player_state == 'PLAYING' and 
+                status.content_id == self.latency_probe[1] and 
+                status.current_time is not None):
+            kind, content_id, position, timestamp = self.latency_probe
+            secs = (self.media_timestamp - timestamp) - (status.current_time - position)
+            if (status.current_time >= position - gv_cast_latency_position_tolerance and 
+                    0 <= secs <= gv_cast_latency_max_secs):
+                self.latency_probe = None
+                cast_latency_record(
+                        self.uuid,
+                        kind,
+                        secs)
+        if (self.latency_probe and 
+                self.media_timestamp - self.latency_probe[3] > gv_cast_latency_max_secs):
+            self.latency_probe = None
+
+        self.event.set()
+        gv_agent_wake_event.set()
+
+    def load_media_failed(self, queue_item_id, error_code):
+        log_message(
+                1,
+                'Cast device failed to load media item:%s error:%s' % (
+                    queue_item_id,
+                    error_code))
+
+    def new_cast_status(self, status):
+        self.volume_level = status.volume_level
+        self.app_id = status.app_id
+        self.cast_timestamp = time.monotonic()
+        self.event.set()
+        gv_agent_wake_event.set()
+
+    def new_connection_status(self, status):
+        self.connection_status = status.status
+        self.connection_timestamp = time.monotonic()
+        self.event.set()
+        gv_agent_wake_event.set()
+
+    def reset_media(self):
+        # Forget the last media status
+        # Used ahead of a new cast on a reused device
+        # so stale status is not mistaken for the new media
+        self.clock = playback_clock()
+        self.duration = None
+        self.player_state = 'UNKNOWN'
+        self.content_id = None
+        self.media_timestamp = 0
+        self.latency_probe = None
+
+    def probe_latency(self, kind, content_id, position):
+        # Note a load or seek of content_id to position
+        # being issued now so its latency is measured 
+        # from the next playing status for it
+        self.latency_probe = (
+                kind, 
+                content_id, 
+                float(position), 
+                time.monotonic())
+
+    def elapsed(self):
+        # Elapsed time extrapolated from the last 
+        # reported position while playing
+        return self.clock.position()
+
+    def wait_for(self, condition, timeout):
+        # Wait on status updates until the condition
+        # is met or the timeout expires. The wait is 
+        # capped so conditions on the extrapolated 
+        # position are also picked up
+        deadline = time.monotonic() + timeout
+        while not condition():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self.event.wait(min(remaining, 0.1))
+            self.event.clear()
+
+        return True
+
+    def disconnected_secs(self):
+        # Time spent without a connection to the device
+        if self.connection_status == 'CONNECTED':
+            return 0
+
+        return time.monotonic() - self.connection_timestamp
+
+
 def get_cast_device(name):
     global gv_cast_devices_dict
     global gv_zconf
+    global gv_cast_pool_dict
+    global gv_cast_pool_lock
 
     if (not name or 
             name == 'Disabled'):
-        return None
+        return None, None
 
     log_message(
             1,
@@ -105,14 +849,39 @@ def get_cast_device(name):
         log_message(
                 1, 
                 'No zconf service active')
-        return None
+        return None, None
 
     if not name in gv_cast_devices_dict:
         log_message(
                 1,
                 'cast device not found in discovered device services')
-        return None
+        return None, None
+
+    cast_info = gv_cast_devices_dict[name]
+    uuid = str(cast_info.uuid)
+
+    with gv_cast_pool_lock:
+        # Reuse a pooled device if still healthy and 
+        # at the same address
+        if uuid in gv_cast_pool_dict:
+            pool_entry = gv_cast_pool_dict[uuid]
+            if (pool_entry['host'] == cast_info.host and 
+                    pool_entry['port'] == cast_info.port and 
+                    pool_entry['listener'].disconnected_secs() < gv_cast_pool_health_secs):
+                log_message(
+                        1,
+                        'Using pooled cast device object')
+                pool_entry['in_use'] = True
+                pool_entry['last_used'] = time.monotonic()
+                return pool_entry['device'], pool_entry['listener']
+
+            log_message(
+                    1,
+                    'Discarding unhealthy pooled cast device object')
+            cast_pool_evict(uuid)
 
+    # Connect outside the pool lock so other
+    # users of the pool are not held up
     try:
         log_message(
                 1,
@@ -120,16 +889,719 @@ def get_cast_device(name):
         # Get the device handle
         # FIXME this call has issues
         device = pychromecast.get_chromecast_from_cast_info(
-                gv_cast_devices_dict[name],
+                cast_info,
                 gv_zconf)
+        # Status listeners registered before the 
+        # connection starts so no update is missed
+        listener = cast_status_listener(device)
+        device.start()
     except:
         traceback.print_exc()
         log_message(
                 1,
                 'Failed to get cast device object')
-        device = None
+        return None, None
+
+    with gv_cast_pool_lock:
+        # Another thread pooled the same device 
+        # while we were connecting
+        if uuid in gv_cast_pool_dict:
+            log_message(
+                    1,
+                    'Using cast device object pooled meanwhile')
+            try:
+                device.disconnect(timeout = 0)
+            except:
+                pass
+            pool_entry = gv_cast_pool_dict[uuid]
+            pool_entry['in_use'] = True
+            pool_entry['last_used'] = time.monotonic()
+            return pool_entry['device'], pool_entry['listener']
+
+        pool_entry = {}
+        pool_entry['name'] = name
+        pool_entry['host'] = cast_info.host
+        pool_entry['port'] = cast_info.port
+        pool_entry['device'] = device
+        pool_entry['listener'] = listener
+        pool_entry['in_use'] = True
+        pool_entry['last_used'] = time.monotonic()
+        gv_cast_pool_dict[uuid] = pool_entry
+
+    return device, listener
+
+
+def release_cast_device(device):
+    global gv_cast_pool_dict
+    global gv_cast_pool_lock
+
+    # Hand a device back to the pool
+    # It stays connected for reuse until evicted
+    uuid = str(device.uuid)
+    with gv_cast_pool_lock:
+        if uuid in gv_cast_pool_dict:
+            gv_cast_pool_dict[uuid]['in_use'] = False
+            gv_cast_pool_dict[uuid]['last_used'] = time.monotonic()
+
+    return
+
+
+def discard_cast_device(device):
+    global gv_cast_pool_lock
+
+    # Drop a broken device from the pool
+    uuid = str(device.uuid)
+    with gv_cast_pool_lock:
+        cast_pool_evict(uuid)
+
+    return
+
+
+def cast_pool_evict(uuid):
+    global gv_cast_pool_dict
+
+    # Remove and disconnect a pooled device
+    # Caller must hold gv_cast_pool_lock
+    if not uuid in gv_cast_pool_dict:
+        return
+
+    pool_entry = gv_cast_pool_dict.pop(uuid)
+    log_message(
+            1,
+            'Evicting cast device [%s] from pool' % (
+                pool_entry['name']))
+    try:
+        pool_entry['device'].disconnect(timeout = 0)
+    except:
+        log_message(
+                1,
+                'Failed to disconnect cast device')
+
+    return
+
+
+def cast_pool_maintenance():
+    global gv_cfg_dict
+    global gv_cast_devices_dict
+    global gv_cast_pool_dict
+    global gv_cast_pool_lock
+    global gv_cast_pool_idle_secs
+
+    # Evict idle devices other than the configured ones
+    # and pre-connect the configured devices so play 
+    # does not wait on a connection
+    # called periodically from the main loop
+    now = time.monotonic()
+    with gv_cast_pool_lock:
+        for uuid in list(gv_cast_pool_dict.keys()):
+            pool_entry = gv_cast_pool_dict[uuid]
+            if pool_entry['in_use']:
+                continue
+
+            if pool_entry['name'] in cast_target_names():
+                # keep unless disconnected for as long 
+                # as the idle time
+                if (pool_entry['listener'].disconnected_secs() >= 
+                        gv_cast_pool_idle_secs):
+                    cast_pool_evict(uuid)
+                continue
+
+            if now - pool_entry['last_used'] >= gv_cast_pool_idle_secs:
+                cast_pool_evict(uuid)
+
+    for name in cast_target_names():
+        cast_pool_preconnect(name)
+
+    return
+
+
+def cast_pool_preconnect(name):
+    global gv_cast_devices_dict
+    global gv_cast_pool_dict
+    global gv_cast_pool_lock
+    global gv_cast_pool_connecting
+
+    # Connect to a device ahead of use
+    # on a background thread so the caller 
+    # (web handler, main loop) is not held up
+    if not name in gv_cast_devices_dict:
+        return
+
+    uuid = str(gv_cast_devices_dict[name].uuid)
+    with gv_cast_pool_lock:
+        if (uuid in gv_cast_pool_dict or 
+                uuid in gv_cast_pool_connecting):
+            return
+        gv_cast_pool_connecting.add(uuid)
+
+    log_message(
+            1,
+            'Pre-connecting to Cast Device [%s]' % (name))
+    threading.Thread(
+            target = cast_pool_connect,
+            args = (name, uuid),
+            daemon = True).start()
+
+    return
+
+
+def cast_pool_connect(name, uuid):
+    global gv_cast_pool_lock
+    global gv_cast_pool_connecting
+
+    try:
+        device, listener = get_cast_device(name)
+        if device:
+            release_cast_device(device)
+    finally:
+        with gv_cast_pool_lock:
+            gv_cast_pool_connecting.discard(uuid)
+
+    return
+
+
+def load_cast_latency():
+    global gv_cast_latency_file
+    global gv_cast_latency_dict
+
+    if not os.path.exists(gv_cast_latency_file):
+        return
+
+    try:
+        latency_file = open(gv_cast_latency_file, 'r')
+        gv_cast_latency_dict = json.loads(latency_file.read())
+        latency_file.close()
+    except:
+        log_message(
+                1,
+                'Failed to load cast latency file %s' % (
+                    gv_cast_latency_file))
+
+    return
+
+
+def save_cast_latency():
+    global gv_cast_latency_file
+    global gv_cast_latency_dict
+    global gv_cast_latency_lock
+    global gv_cast_latency_changed
+
+    # Save if changed since the last save
+    # Called from the main loop housekeeping
+    if not gv_cast_latency_file:
+        return
+
+    with gv_cast_latency_lock:
+        if not gv_cast_latency_changed:
+            return
+        gv_cast_latency_changed = False
+        json_str = json.dumps(gv_cast_latency_dict, indent = 4)
+
+    try:
+        tmp_filename = gv_cast_latency_file + '.tmp'
+        latency_file = open(tmp_filename, 'w')
+        latency_file.write('%s\n' % (json_str))
+        latency_file.close()
+        os.replace(tmp_filename, gv_cast_latency_file)
+    except:
+        log_message(
+                1,
+                'Failed to save cast latency file')
+
+    return
+
+
+def cast_latency_record(uuid, kind, secs):
+    global gv_cast_latency_dict
+    global gv_cast_latency_lock
+    global gv_cast_latency_changed
+    global gv_cast_latency_min_samples
+    global gv_cast_latency_weight
+
+    # Add a latency sample (load or seek) for a device
+    # The first samples are averaged so no single one 
+    # sets the figure, later ones smoothed in
+    with gv_cast_latency_lock:
+        if uuid not in gv_cast_latency_dict:
+            gv_cast_latency_dict[uuid] = {}
+        latency_dict = gv_cast_latency_dict[uuid]
+        samples = latency_dict.get(kind + 'Samples', 0)
+        if samples == 0:
+            latency = secs
+        elif samples < gv_cast_latency_min_samples:
+            latency = latency_dict[kind] + (secs - latency_dict[kind]) / (samples + 1)
+        else:
+            latency = ((1 - gv_cast_latency_weight) * latency_dict[kind] + 
+                    gv_cast_latency_weight * secs)
+        latency_dict[kind] = round(latency, 3)
+        latency_dict[kind + 'Samples'] = samples + 1
+        gv_cast_latency_changed = True
+
+    log_message(
+            1,
+            'Cast device %s %s latency %.3f secs (learnt %.3f)' % (
+                uuid,
+                kind,
+                secs,
+                latency))
+
+    return
+
+
+def cast_latency(uuid, kind):
+    global gv_cast_latency_dict
+    global gv_cast_latency_min_samples
+
+    # Learnt latency (secs) or 0 when not yet known
+    # from enough samples
+    latency_dict = gv_cast_latency_dict.get(uuid, {})
+    if latency_dict.get(kind + 'Samples', 0) < gv_cast_latency_min_samples:
+        return 0.0
+
+    return latency_dict.get(kind, 0.0)
+
+
+def cast_name_latency(name, kind):
+    global gv_cast_devices_dict
+
+    if name not in gv_cast_devices_dict:
+        return 0.0
+
+    return cast_latency(str(gv_cast_devices_dict[name].uuid), kind)
+
+
+def cast_start_time(names):
+    global gv_cfg_dict
+    global gv_cast_start_max_lead_secs
+
+    # Coordinated start for a new track across devices
+    # Returns when (monotonic) all should be heard, 
+    # allowing the slowest device its load latency. None
+    # when the spread of latencies is within tolerance 
+    # and devices may simply start together
+    latency_list = [cast_name_latency(name, 'load') for name in names]
+    if (len(latency_list) < 2 or 
+            max(latency_list) - min(latency_list) <= float(gv_cfg_dict['syncThreshold'])):
+        return None
+
+    return time.monotonic() + min(max(latency_list), gv_cast_start_max_lead_secs)
+
+
+def cast_target_names():
+    global gv_cfg_dict
+
+    # Configured cast devices as a list
+    # castDevice is one name or a list of names for
+    # multi-room with the leader first
+    cast_device = gv_cfg_dict['castDevice']
+    if type(cast_device) == list:
+        names = [name for name in cast_device if name != 'Disabled']
+        if names:
+            return names
+        return ['Disabled']
+
+    return [cast_device]
+
+
+class cast_connector(object):
+    # Leader cast device connection
+    # Discovery, connect and (optionally) quitting any
+    # running app are done on a thread of their own so 
+    # the MPD agents never block on the device and keep
+    # publishing targets to the followers. The agent 
+    # picks up the result once done() and the stages 
+    # are timed as the start of the cast launch
+
+    def __init__(self, name, quit_app):
+        self.name = name
+        self.quit_app = quit_app
+        self.timer = stage_timer()
+        self.result = None
+        self.abandoned = False
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(
+                target = self.run,
+                name = 'cast_connector',
+                daemon = True)
+        self.thread.start()
+
+    def done(self):
+        return self.result is not None
+
+    def abandon(self):
+        # Agent exiting. Releases the device now or
+        # once connected
+        with self.lock:
+            self.abandoned = True
+            if (self.result and 
+                    self.result[0]):
+                release_cast_device(self.result[0])
+
+    def run(self):
+        global gv_agent_wake_event
+
+        try:
+            device, listener = self.connect()
+        except Exception as error:
+            log_message(
+                    1,
+                    'Failed to connect to cast device %s (%s)' % (
+                        self.name,
+                        error))
+            device = None
+            listener = None
+
+        with self.lock:
+            if (self.abandoned and 
+                    device):
+                release_cast_device(device)
+                device = None
+                listener = None
+            self.result = (device, listener)
+
+        gv_agent_wake_event.set()
+
+    def connect(self):
+        global gv_cast_connect_timeout
+        global gv_cast_idle_timeout
+
+        device, listener = get_cast_device(self.name)
+        self.timer.mark('discover')
+        if not device:
+            return (None, None)
+
+        # Wait for the connection
+        # ready on the first receiver status
+        try:
+            device.wait(timeout = gv_cast_connect_timeout)
+        except Exception:
+            log_message(
+                    1,
+                    'Timed out connecting to cast device')
+            discard_cast_device(device)
+            return (None, None)
+        self.timer.mark('connect')
+
+        # Kill off any current app
+        # The media receiver launch will replace 
+        # it anyway if this times out
+        if (self.quit_app and 
+                not device.is_idle):
+            log_message(
+                    1,
+                    'Killing current running cast app')
+            try:
+                device.quit_app()
+            except Exception:
+                discard_cast_device(device)
+                raise
+
+            if not listener.wait_for(
+                    lambda: device.is_idle,
+                    gv_cast_idle_timeout):
+                log_message(
+                        1,
+                        'Timed out waiting for cast device to get ready')
+            self.timer.mark('app_quit')
+
+        return (device, listener)
+
+
+class cast_session(object):
+    # Multi-room follower
+    # Runs its own state machine on a dedicated 
+    # executor, driving one cast device towards the
+    # target state published by the MPD agents: play 
+    # state, media, volume and (for files) the leader's
+    # position. A slow or dead device only holds up its
+    # own session and is retried with backoff
+
+    def __init__(self, name):
+        self.name = name
+        self.target = None
+        self.event = threading.Event()
+        self.closed = False
+        self.device = None
+        self.listener = None
+        self.status = 'none'
+        self.media_id = None
+        self.volume = -1
+        self.sync_timestamp = 0
+        self.failures = 0
+        self.backoff = 0
+        self.retry_at = 0
+        self.hold_until = 0
+        self.last_error = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers = 1,
+                thread_name_prefix = 'cast_session')
+        self.future = self.executor.submit(self.run)
+
+    def set_target(self, target_dict):
+        self.target = target_dict
+        self.event.set()
+
+    def close(self):
+        self.closed = True
+        self.event.set()
+        self.executor.shutdown(wait = False)
+
+    def run(self):
+        global gv_mpd_active_interval
+        global gv_cast_session_max_backoff_secs
+
+        while not self.closed:
+            # woken early for a held cast
+            timeout = gv_mpd_active_interval
+            if self.hold_until:
+                timeout = max(0, min(timeout, self.hold_until - time.monotonic()))
+            self.event.wait(timeout)
+            self.event.clear()
+            if (self.closed or 
+                    time.monotonic() < self.retry_at):
+                continue
+
+            try:
+                self.reconcile(self.target)
+                self.backoff = 0
+            except Exception as error:
+                self.failures += 1
+                self.last_error = repr(error)
+                self.backoff = min(
+                        max(1, self.backoff * 2),
+                        gv_cast_session_max_backoff_secs)
+                self.retry_at = time.monotonic() + self.backoff
+                log_message(
+                        1,
+                        'Cast session [%s] failed (%s).. retrying in %d secs' % (
+                            self.name,
+                            self.last_error,
+                            self.backoff))
+                if self.device:
+                    discard_cast_device(self.device)
+                self.reset()
+
+        self.stop()
+
+    def reset(self):
+        self.device = None
+        self.listener = None
+        self.status = 'none'
+        self.media_id = None
+        self.volume = -1
+        self.hold_until = 0
+
+    def stop(self):
+        if not self.device:
+            return
+
+        log_message(
+                1,
+                'Cast session [%s] stopping cast app' % (
+                    self.name))
+        try:
+            self.device.media_controller.stop()
+            self.device.quit_app()
+            release_cast_device(self.device)
+        except Exception:
+            discard_cast_device(self.device)
+        self.reset()
+
+    def reconcile(self, target_dict):
+        global gv_cfg_dict
+        global gv_cast_connect_timeout
+        global gv_sync_holdoff_secs
+
+        if not target_dict:
+            return
+
+        state = target_dict['state']
+        if state not in ['play', 'pause']:
+            self.stop()
+            return
+
+        if not self.device:
+            if state != 'play':
+                return
+
+            device, listener = get_cast_device(self.name)
+            if not device:
+                raise RuntimeError('cast device not available')
+            self.device = device
+            self.listener = listener
+            try:
+                self.device.wait(timeout = gv_cast_connect_timeout)
+            except Exception:
+                raise RuntimeError('timed out connecting')
+
+        # New media
+        if target_dict['mediaId'] != self.media_id:
+            if state != 'play':
+                return
+
+            if target_dict['file']:
+                incompatible_reason = cast_media_incompatible(
+                        self.name, 
+                        target_dict['file'])
+                if incompatible_reason:
+                    log_message(
+                            1,
+                            'Cast session [%s] not playing %s (%s)' % (
+                                self.name,
+                                target_dict['file'],
+                                incompatible_reason))
+                    self.device.media_controller.stop()
+                    self.media_id = target_dict['mediaId']
+                    self.status = 'skipped'
+                    return
+
+            # Lead times
+            # Joining a track the leader is playing, load 
+            # ahead of it by the load latency. For a 
+            # coordinated start, hold the load until 
+            # this device's latency before the start time
+            # The session loop wakes for it then
+            args = dict(target_dict['args'])
+            load_latency = cast_latency(self.listener.uuid, 'load')
+            start_position = 0.0
+            if target_dict['position'] is not None:
+                start_position = (target_dict['position'] + 
+                        time.monotonic() - target_dict['timestamp'] + 
+                        load_latency)
+                args['current_time'] = start_position
+            elif target_dict['startAt']:
+                hold_until = target_dict['startAt'] - load_latency
+                if hold_until > time.monotonic():
+                    self.hold_until = hold_until
+                    return
+            self.hold_until = 0
+
+            self.media_id = target_dict['mediaId']
+            if target_dict['volume'] != -1:
+                self.device.set_volume(target_dict['volume'] / 100)
+                self.volume = target_dict['volume']
+
+            log_message(
+                    1,
+                    'Cast session [%s] casting URL:%s at %.3f secs' % (
+                        self.name,
+                        target_dict['url'],
+                        start_position))
+            self.listener.reset_media()
+            self.listener.probe_latency(
+                    'load', 
+                    target_dict['url'], 
+                    start_position)
+            self.device.media_controller.play_media(
+                    target_dict['url'],
+                    **args)
+            self.status = 'play'
+            self.sync_timestamp = time.monotonic()
+            return
+
+        if self.status == 'skipped':
+            return
+
+        if (state == 'pause' and 
+                self.status == 'play'):
+            log_message(
+                    1,
+                    'Cast session [%s] pausing' % (
+                        self.name))
+            self.device.media_controller.pause()
+            self.status = 'pause'
+            return
+
+        if (state == 'play' and 
+                self.status == 'pause'):
+            log_message(
+                    1,
+                    'Cast session [%s] resuming' % (
+                        self.name))
+            if target_dict['resumeRecast']:
+                # live stream
+                self.media_id = None
+                self.event.set()
+            else:
+                self.device.media_controller.play()
+                self.status = 'play'
+            return
+
+        if (target_dict['volume'] != -1 and 
+                target_dict['volume'] != self.volume):
+            self.device.set_volume(target_dict['volume'] / 100)
+            self.volume = target_dict['volume']
+
+        # Position sync to the leader
+        now = time.monotonic()
+        if (state == 'play' and 
+                target_dict['position'] is not None and 
+                self.listener.player_state == 'PLAYING' and 
+                self.listener.content_id == target_dict['url'] and 
+                now - self.sync_timestamp >= gv_sync_holdoff_secs):
+            target_position = target_dict['position'] + now - target_dict['timestamp']
+            drift = self.listener.elapsed() - target_position
+            if abs(drift) > float(gv_cfg_dict['syncThreshold']):
+                # lead by the seek latency
+                seek_position = target_position + cast_latency(
+                        self.listener.uuid, 
+                        'seek')
+                log_message(
+                        1,
+                        'Cast session [%s] seeking to %.3f secs (drift %.3f)' % (
+                            self.name,
+                            seek_position,
+                            drift))
+                self.listener.probe_latency(
+                        'seek', 
+                        target_dict['url'], 
+                        seek_position)
+                self.device.media_controller.seek(seek_position)
+                self.sync_timestamp = now
+
+    def to_dict(self):
+        session_dict = {}
+        session_dict['status'] = self.status
+        session_dict['connected'] = self.device is not None
+        session_dict['failures'] = self.failures
+        session_dict['lastError'] = self.last_error
+        return session_dict
+
+
+def cast_sessions_update(target_dict):
+    global gv_cast_session_dict
+    global gv_cast_session_lock
+
+    # Start or close follower sessions to match 
+    # the configured cast devices and hand each the 
+    # target state
+    follower_names = cast_target_names()[1:]
+    with gv_cast_session_lock:
+        for name in list(gv_cast_session_dict.keys()):
+            if name not in follower_names:
+                log_message(
+                        1,
+                        'Closing cast session [%s]' % (name))
+                gv_cast_session_dict.pop(name).close()
+
+        for name in follower_names:
+            if name not in gv_cast_session_dict:
+                log_message(
+                        1,
+                        'Starting cast session [%s]' % (name))
+                gv_cast_session_dict[name] = cast_session(name)
+            gv_cast_session_dict[name].set_target(target_dict)
+
+    return
+
 
-    return device
+def cast_session_stats():
+    global gv_cast_session_dict
+    global gv_cast_session_lock
+
+    with gv_cast_session_lock:
+        return {name: gv_cast_session_dict[name].to_dict() 
+                for name in gv_cast_session_dict}
 
 
 def load_config():
@@ -141,7 +1613,9 @@ def load_config():
             'Loading config from %s' % (gv_cfg_filename))
     cfg_file = open(gv_cfg_filename, 'r')
     json_str = cfg_file.read()
-    gv_cfg_dict = json.loads(json_str)
+    # merged over current values so any key 
+    # missing from the file keeps its default
+    gv_cfg_dict.update(json.loads(json_str))
     cfg_file.close()
 
     log_message(
@@ -166,51 +1640,170 @@ def save_config():
     return 
 
 
-def config_agent():
+def check_config():
     global gv_cfg_filename
+    global gv_cfg_last_modified
+    global gv_agent_wake_event
+
+    # check the config file and react on changes
+    # called periodically from the main loop
+    if os.path.exists(gv_cfg_filename):
+        config_last_modified = os.path.getmtime(gv_cfg_filename)
+        if config_last_modified > gv_cfg_last_modified:
+            log_message(
+                    2,
+                    'Detected update to %s' % (
+                        gv_cfg_filename))
+            load_config()
+            gv_cfg_last_modified = config_last_modified
+
+            # wake agents to apply any change
+            gv_agent_wake_event.set()
+
+    return 
+
+
+def cast_info_to_dict(cast_info):
+    # Serialisable form of a CastInfo record
+    cast_info_dict = {}
+    cast_info_dict['uuid'] = str(cast_info.uuid)
+    cast_info_dict['friendlyName'] = cast_info.friendly_name
+    cast_info_dict['modelName'] = cast_info.model_name
+    cast_info_dict['manufacturer'] = cast_info.manufacturer
+    cast_info_dict['castType'] = cast_info.cast_type
+    cast_info_dict['host'] = cast_info.host
+    cast_info_dict['port'] = cast_info.port
+
+    return cast_info_dict
+
+
+def dict_to_cast_info(cast_info_dict):
+    # CastInfo record from its serialised form
+    # Uses a host service so the device can be 
+    # reached without an mDNS lookup
+    return pychromecast.models.CastInfo(
+            {pychromecast.models.HostServiceInfo(
+                cast_info_dict['host'],
+                cast_info_dict['port'])},
+            uuid.UUID(cast_info_dict['uuid']),
+            cast_info_dict['modelName'],
+            cast_info_dict['friendlyName'],
+            cast_info_dict['host'],
+            cast_info_dict['port'],
+            cast_info_dict['castType'],
+            cast_info_dict['manufacturer'])
+
+
+def load_cast_devices_cache():
+    global gv_cast_devices_dict
+    global gv_cast_devices_cache_file
+    global gv_cast_devices_unconfirmed
+
+    # Preload discovered cast devices from the last run
+    # These are used optimistically until confirmed 
+    # or refreshed by live discovery
+    if not os.path.exists(gv_cast_devices_cache_file):
+        return
+
+    log_message(
+            1,
+            'Loading cast devices from %s' % (
+                gv_cast_devices_cache_file))
+    try:
+        cache_file = open(gv_cast_devices_cache_file, 'r')
+        cache_dict = json.loads(cache_file.read())
+        cache_file.close()
+
+        for cast_info_dict in cache_dict.values():
+            cast_info = dict_to_cast_info(cast_info_dict)
+            gv_cast_devices_dict[cast_info.friendly_name] = cast_info
+            gv_cast_devices_unconfirmed.add(cast_info.friendly_name)
+    except:
+        traceback.print_exc()
+        log_message(
+                1,
+                'Failed to load cast devices cache')
 
-    # monitor the config file and react on changes
-    home = os.path.expanduser('~')
-    gv_cfg_filename = home + '/.mpd2chromecast'   
     log_message(
             1,
-            'Config file is %s' % (gv_cfg_filename))
+            'Cached cast devices: %s' % (
+                sorted(list(gv_cast_devices_unconfirmed))))
 
-    last_check = 0
+    return
 
-    # 5-second check for config changes
-    while (True):
-        if os.path.exists(gv_cfg_filename):
-            config_last_modified = os.path.getmtime(gv_cfg_filename)
-            if config_last_modified > last_check:
-                log_message(
-                        2,
-                        'Detected update to %s' % (
-                            gv_cfg_filename))
-                load_config()
-                last_check = config_last_modified
 
-        time.sleep(5)
+def save_cast_devices_cache():
+    global gv_cast_devices_dict
+    global gv_cast_devices_cache_file
 
-    return 
+    # Persist discovered cast devices keyed by UUID
+    # written via a temp file so a crash cannot 
+    # leave a partial cache
+    cache_dict = {}
+    for cast_info in list(gv_cast_devices_dict.values()):
+        cache_dict[str(cast_info.uuid)] = cast_info_to_dict(cast_info)
+
+    try:
+        tmp_filename = gv_cast_devices_cache_file + '.tmp'
+        cache_file = open(tmp_filename, 'w')
+        cache_file.write('%s\n' % (json.dumps(cache_dict, indent = 4)))
+        cache_file.close()
+        os.replace(tmp_filename, gv_cast_devices_cache_file)
+    except:
+        log_message(
+                1,
+                'Failed to save cast devices cache')
+
+    return
 
 
-def cast_device_discovery_agent():
+def start_cast_device_discovery():
     global gv_cast_devices_dict
+    global gv_cast_devices_unconfirmed
+    global gv_cast_devices_lock
     global gv_zconf
+    global gv_cast_browser
 
     def cast_device_add_callback(uuid, name):
         # Add discovered device to global dict
         # keyed on friendly name and stores the full 
         # service record
-        friendly_name = cast_listener.services[uuid][3]
-        gv_cast_devices_dict[friendly_name] = cast_listener.services[uuid]
+        cast_info = cast_listener.services[uuid]
+        friendly_name = cast_info.friendly_name
+
+        with gv_cast_devices_lock:
+            if friendly_name in gv_cast_devices_unconfirmed:
+                log_message(
+                        1,
+                        'Confirmed cached cast device [%s]' % (
+                            friendly_name))
+                gv_cast_devices_unconfirmed.discard(friendly_name)
+            elif not friendly_name in gv_cast_devices_dict:
+                log_message(
+                        1,
+                        'Discovered cast device [%s]' % (
+                            friendly_name))
+
+            # Only persist when the record has changed
+            if (not friendly_name in gv_cast_devices_dict or 
+                    cast_info_to_dict(gv_cast_devices_dict[friendly_name]) != 
+                    cast_info_to_dict(cast_info)):
+                gv_cast_devices_dict[friendly_name] = cast_info
+                save_cast_devices_cache()
+            else:
+                gv_cast_devices_dict[friendly_name] = cast_info
 
     def cast_device_remove_callback(uuid, name, service):
         # purge removed devices from the global dict
-        friendly_name = cast_listener.services[uuid][3]
-        if friendly_name in gv_cast_devices_dict:
-            del gv_cast_devices_dict[friendly_name]
+        friendly_name = service.friendly_name
+        with gv_cast_devices_lock:
+            if friendly_name in gv_cast_devices_dict:
+                log_message(
+                        1,
+                        'Removed cast device [%s]' % (
+                            friendly_name))
+                del gv_cast_devices_dict[friendly_name]
+                save_cast_devices_cache()
 
     # cast listener (add, remove, update)
     # treat update as add
@@ -219,18 +1812,13 @@ def cast_device_discovery_agent():
             cast_device_remove_callback,
             cast_device_add_callback)
 
+    # zeroconf runs its own threads for discovery
+    # so there is nothing more to do here
     gv_zconf = zeroconf.Zeroconf()
-    cast_browser = pychromecast.discovery.start_discovery(
+    gv_cast_browser = pychromecast.discovery.start_discovery(
             cast_listener, 
             gv_zconf)
 
-    while (True):
-        time.sleep(30)
-        log_message(
-                0,
-                'All discovered cast devices: %s' % (
-            list(gv_cast_devices_dict.keys())))
-
     return 
 
 
@@ -306,8 +1894,11 @@ def build_cast_web_page(refresh_interval = 10000):
     # action code for combos
     # click function resets refresh timer to 
     # 2 minutes
+    # __CONFIRM__ is an optional check ahead of
+    # making the change
     change_get_reload_template = """
         $('#__ID__').on('change', function() {
+            __CONFIRM__
             $.get('/cast?__ID__=' + this.value, function(data, status) {
                 // clear refresh timer before reload
                 clearInterval(refresh_timer);
@@ -323,6 +1914,17 @@ def build_cast_web_page(refresh_interval = 10000):
 
     """
 
+    # confirm template for replacing the 
+    # multi-room set with another device
+    # the combo goes back to the leader if declined
+    confirm_replace_template = """
+            if (this.value != __LEADER__ &&
+                    !confirm(__PROMPT__ + this.value + '?')) {
+                $(this).val(__LEADER__);
+                return;
+            }
+    """
+
 
     dashboard_str = ''
     jquery_str = ''
@@ -334,13 +1936,15 @@ def build_cast_web_page(refresh_interval = 10000):
             '<div class="card-body">'
             ) 
 
+    cast_names = cast_target_names()
+
     # Cast Device Combo
     dashboard_str += (
             '<div class="input-group mb-3">'
             '<i class="material-icons md-36">%s</i>&nbsp;'
             '<select class="custom-select custom-select" id="castDevice" name="castDevice">'
             ) % (
-                    'cast_connected' if gv_cfg_dict['castDevice'] != 'Disabled' else 'cast'
+                    'cast_connected' if cast_names[0] != 'Disabled' else 'cast'
                     )
 
     # Construct a sorted list of discovered device names
@@ -349,7 +1953,7 @@ def build_cast_web_page(refresh_interval = 10000):
     device_list += sorted(list(gv_cast_devices_dict.keys()))
 
     for device in device_list:
-        if device == gv_cfg_dict['castDevice']:
+        if device == cast_names[0]:
             selected_str = 'selected'
         else:
             selected_str = ''
@@ -366,8 +1970,31 @@ def build_cast_web_page(refresh_interval = 10000):
             '</div>'
             )
 
+    # Multi-room set (leader first) under the combo
+    # as the combo only shows the leader
+    if len(cast_names) > 1:
+        dashboard_str += (
+                '<div class="input-group mb-3">'
+                '<i class="material-icons md-36">speaker_group</i>&nbsp;'
+                'Multi-room: %s'
+                '</div>'
+                ) % (
+                        ', '.join(cast_names)
+                        )
+
     # action code for selecting a cast device
+    # confirming first if it would replace the 
+    # multi-room set
+    confirm_str = ''
+    if len(cast_names) > 1:
+        confirm_str = confirm_replace_template
+        confirm_str = confirm_str.replace('__LEADER__', json.dumps(cast_names[0]))
+        confirm_str = confirm_str.replace(
+                '__PROMPT__', 
+                json.dumps('Replace multi-room set %s with ' % (', '.join(cast_names))))
+
     action_str = change_get_reload_template
+    action_str = action_str.replace('__CONFIRM__', confirm_str)
     action_str = action_str.replace('__ID__', 'castDevice')
     jquery_str += action_str
 
@@ -404,6 +2031,7 @@ def build_cast_web_page(refresh_interval = 10000):
 
     # action code for selecting a cast mode
     action_str = change_get_reload_template
+    action_str = action_str.replace('__CONFIRM__', '')
     action_str = action_str.replace('__ID__', 'castMode')
     jquery_str += action_str
 
@@ -426,11 +2054,6 @@ def build_cast_web_page(refresh_interval = 10000):
     return web_page_str
 
 
-# dummy stream handler object for cherrypy
-class stream_handler(object):
-    pass
-
-
 class cast_handler(object):
     @cherrypy.expose()
 
@@ -441,6 +2064,7 @@ class cast_handler(object):
 
         global gv_verbose
         global gv_cfg_dict
+        global gv_agent_wake_event
 
         log_message(
                 gv_verbose,
@@ -464,8 +2088,14 @@ class cast_handler(object):
                         castDevice))
 
             # Make change instantly and save
-            gv_cfg_dict['castDevice'] = castDevice
-            save_required = True
+            # Selecting the current leader keeps its 
+            # multi-room set
+            if castDevice != cast_target_names()[0]:
+                gv_cfg_dict['castDevice'] = castDevice
+                save_required = True
+
+                # connect ahead of playback
+                cast_pool_preconnect(castDevice)
 
         if castMode:
             log_message(
@@ -480,17 +2110,67 @@ class cast_handler(object):
         if save_required:
             save_config()
 
+            # wake agents to apply the change
+            gv_agent_wake_event.set()
+
         return build_cast_web_page(refresh_interval)
 
     # Force trailling slash off on called URL
     index._cp_config = {'tools.trailing_slash.on': False}
 
 
+class stats_handler(object):
+    @cherrypy.expose()
+
+    def index(self):
+        global gv_cast_launch_history
+        global gv_agent_dict
+        global gv_loop_scheduler_dict
+
+        # Runtime stats as JSON
+        stats_dict = {}
+        stats_dict['castLaunch'] = list(gv_cast_launch_history)
+
+        stats_dict['loops'] = {}
+        for name in list(gv_loop_scheduler_dict.keys()):
+            stats_dict['loops'][name] = gv_loop_scheduler_dict[name].to_dict()
+
+        stats_dict['agents'] = {}
+        for name in gv_agent_dict:
+            agent_dict = gv_agent_dict[name]
+            agent_stats_dict = {}
+            agent_stats_dict['running'] = agent_dict['future'] is not None
+            agent_stats_dict['started'] = agent_dict['started_time']
+            agent_stats_dict['restarts'] = agent_dict['restarts']
+            agent_stats_dict['lastFailure'] = agent_dict['last_failure']
+            agent_stats_dict['recoverySecs'] = agent_dict['recovery_secs']
+            stats_dict['agents'][name] = agent_stats_dict
+
+        stats_dict['media'] = media_stats()
+        stats_dict['albumartIndex'] = albumart_index_stats()
+        stats_dict['artCache'] = art_cache_stats()
+        stats_dict['thumbnails'] = thumb_stats()
+        stats_dict['artStore'] = art_store_stats()
+        stats_dict['library'] = library_stats()
+        stats_dict['mediaInfo'] = dict(gv_media_info_stats_dict)
+        stats_dict['castSessions'] = cast_session_stats()
+        stats_dict['castLatency'] = dict(gv_cast_latency_dict)
+        if gv_stream_relay:
+            stats_dict['streamRelay'] = gv_stream_relay.to_dict()
+        stats_dict['egress'] = egress_stats()
+
+        return stats_dict
+
+    # Force trailling slash off on called URL
+    # and JSON encode the returned dict
+    index._cp_config = {
+            'tools.trailing_slash.on': False,
+            'tools.json_out.on': True,
+            }
+
+
 def web_server():
     global gv_cast_port
-    global gv_mpd_music_dir
-    global gv_stream_albumart_dir
-    global gv_stream_albumart_file
 
     # engine config
     cherrypy.config.update(
@@ -512,37 +2192,1628 @@ def web_server():
     cherrypy.tree.mount(cast_handler(), '/cast', cast_conf)
     cherrypy.tree.mount(cast_handler(), '/', cast_conf)
 
-    # /music handler for streaming
-    # and file artwork
-    stream_conf = {
-        '/' : {
-            'tools.staticdir.on': True,
-            'tools.staticdir.dir': gv_mpd_music_dir,
-            'tools.staticdir.index': 'index.html',
-        }
-    }
-    cherrypy.tree.mount(stream_handler(), '/music', stream_conf)
-
-    # Stream Albumart dir used to serve static
-    # splash for MPD streams
-    if gv_stream_albumart_file:
-        stream_albumart_conf = {
-                '/' : {
-                    'tools.staticdir.on': True,
-                    'tools.staticdir.dir': gv_stream_albumart_dir,
-                    'tools.staticdir.index': 'index.html',
-                    }
-                }
-        cherrypy.tree.mount(stream_handler(), '/albumart', stream_albumart_conf)
+    # /stats API
+    cherrypy.tree.mount(stats_handler(), '/stats', {})
 
     # Cherrypy main loop blocking
     cherrypy.engine.start()
     cherrypy.engine.block()
 
 
+def media_path_to_file(url_path):
+    global gv_mpd_music_dir
+    global gv_stream_albumart_dir
+
+    # Map a (decoded) media server URL path onto a file 
+    # under the music dir (/music) or the stream albumart 
+    # dir (/albumart). Paths with '..' components, outside
+    # those dirs or to non-files give None. Symlinks 
+    # within the dirs are followed as moOde and Volumio
+    # link in NAS and USB storage that way
+    root_dict = {}
+    root_dict['/music/'] = gv_mpd_music_dir
+    if gv_stream_albumart_dir:
+        root_dict['/albumart/'] = gv_stream_albumart_dir
+
+    for prefix in root_dict:
+        if not url_path.startswith(prefix):
+            continue
+
+        root_dir = os.path.normpath(root_dict[prefix])
+        rel_path = url_path[len(prefix):]
+        if '..' in rel_path.split('/'):
+            return None
+        file_path = os.path.normpath(os.path.join(root_dir, rel_path))
+        if not file_path.startswith(root_dir + os.sep):
+            return None
+        if not os.path.isfile(file_path):
+            return None
+        return file_path
+
+    return None
+
+
+def parse_http_range(range_header, size):
+    # Parse a Range header against a file size
+    # Returns an inclusive (start, end) for a single 
+    # byte range or None to serve the whole file. Multiple 
+    # ranges are not supported and get the whole file as 
+    # do invalid ones (RFC 7233 2.1), eg last before first
+    # Raises ValueError for an unsatisfiable range
+    if not range_header:
+        return None
+
+    range_header = range_header.strip()
+    if (not range_header.startswith('bytes=') or 
+            ',' in range_header):
+        return None
+
+    start_str, sep, end_str = range_header[6:].partition('-')
+    if not sep:
+        return None
+
+    start_str = start_str.strip()
+    end_str = end_str.strip()
+    if ((start_str and not start_str.isdigit()) or 
+            (end_str and not end_str.isdigit()) or
+            (not start_str and not end_str)):
+        # malformed, ignored
+        return None
+
+    if not start_str:
+        # suffix range, last N bytes
+        start = max(0, size - int(end_str))
+        end = size - 1
+        if int(end_str) == 0:
+            raise ValueError('empty suffix range')
+    else:
+        start = int(start_str)
+        if (end_str and 
+                int(end_str) < start):
+            # invalid, ignored
+            return None
+        end = min(int(end_str), size - 1) if end_str else size - 1
+
+    if start >= size:
+        raise ValueError('unsatisfiable range')
+
+    return (start, end)
+
+
+def write_cache_file(filename, data):
+    # Write a cache file then rename it into place 
+    # so concurrent readers (including other media 
+    # worker processes) never see a partial file
+    # Returns True on success
+    tmp_filename = '%s.%d.%d.tmp' % (
+            filename,
+            os.getpid(),
+            threading.get_ident())
+    try:
+        with open(tmp_filename, 'wb') as cache_file:
+            cache_file.write(data)
+        os.replace(tmp_filename, filename)
+    except OSError as error:
+        log_message(
+                1,
+                'Failed to write cache file %s (%s)' % (
+                    filename,
+                    error))
+        return False
+
+    return True
+
+
+def art_cache_key(file_path, file_stat):
+    # Cache key for a track's embedded art
+    key_str = '%s:%d:%d' % (
+            file_path,
+            file_stat.st_mtime_ns,
+            file_stat.st_size)
+
+    return hashlib.sha1(key_str.encode('utf-8')).hexdigest()
+
+
+def art_disk_cache_load(key):
+    global gv_art_cache_dir
+
+    # Disk cache files hold the mime type line
+    # followed by the image data. An empty mime 
+    # type records a track without art
+    # Returns (mime type, data) or None if not cached
+    if not gv_art_cache_dir:
+        return None
+
+    try:
+        with open('%s/%s.art' % (gv_art_cache_dir, key), 'rb') as art_file:
+            art_bytes = art_file.read()
+    except OSError:
+        return None
+
+    albumart_mime, sep, albumart_data = art_bytes.partition(b'\n')
+    if not albumart_mime:
+        return (None, None)
+
+    return (albumart_mime.decode('utf-8'), albumart_data)
+
+
+def art_disk_cache_save(key, albumart):
+    global gv_art_cache_dir
+
+    if not gv_art_cache_dir:
+        return
+
+    albumart_mime, albumart_data = albumart
+    art_bytes = (albumart_mime or '').encode('utf-8') + b'\n' + (albumart_data or b'')
+
+    write_cache_file(
+            '%s/%s.art' % (gv_art_cache_dir, key),
+            art_bytes)
+
+    return
+
+
+def get_embedded_albumart(file_path):
+    global gv_art_cache
+    global gv_art_cache_lock
+    global gv_art_cache_bytes
+    global gv_art_cache_max_bytes
+    global gv_art_cache_max_entries
+    global gv_art_cache_stats_dict
+
+    # First embedded picture of a track
+    # from the memory cache, disk cache or the 
+    # track itself
+    # Returns (mime type, data) or (None, None)
+    try:
+        file_stat = os.stat(file_path)
+    except OSError:
+        return (None, None)
+
+    key = art_cache_key(file_path, file_stat)
+    with gv_art_cache_lock:
+        if key in gv_art_cache:
+            gv_art_cache.move_to_end(key)
+            gv_art_cache_stats_dict['memoryHits'] += 1
+            return gv_art_cache[key]
+
+    albumart = art_disk_cache_load(key)
+    if albumart:
+        with gv_art_cache_lock:
+            gv_art_cache_stats_dict['diskHits'] += 1
+    else:
+        albumart = extract_albumart.extract_embedded_albumart(file_path)
+        with gv_art_cache_lock:
+            gv_art_cache_stats_dict['extractions'] += 1
+        art_disk_cache_save(key, albumart)
+
+    albumart_mime, albumart_data = albumart
+    art_bytes = len(albumart_data) if albumart_data else 0
+    with gv_art_cache_lock:
+        if key not in gv_art_cache:
+            gv_art_cache[key] = albumart
+            gv_art_cache_bytes += art_bytes
+        # Bounded by entries as well as bytes as 
+        # tracks with no art are cached at no size
+        while ((gv_art_cache_bytes > gv_art_cache_max_bytes or 
+                    len(gv_art_cache) > gv_art_cache_max_entries) and 
+                len(gv_art_cache) > 1):
+            evicted_key, evicted_albumart = gv_art_cache.popitem(last = False)
+            if evicted_albumart[1]:
+                gv_art_cache_bytes -= len(evicted_albumart[1])
+            gv_art_cache_stats_dict['evictions'] += 1
+
+    return albumart
+
+
+def art_cache_stats():
+    global gv_art_cache
+    global gv_art_cache_lock
+    global gv_art_cache_bytes
+    global gv_art_cache_stats_dict
+
+    with gv_art_cache_lock:
+        cache_stats_dict = dict(gv_art_cache_stats_dict)
+        cache_stats_dict['entries'] = len(gv_art_cache)
+        cache_stats_dict['bytes'] = gv_art_cache_bytes
+
+    return cache_stats_dict
+
+
+def get_albumart_thumb(track_path, cover_path):
+    global gv_thumb_max_size
+    global gv_thumb_quality
+    global gv_thumb_cache_dir
+    global gv_thumb_stats_dict
+    global gv_thumb_stats_lock
+
+    # Thumbnail file for a track's art
+    # made from the cover file if given or else the
+    # track's embedded art. Returns None if there is 
+    # no art or it could not be decoded
+    source_path = cover_path if cover_path else track_path
+    try:
+        source_stat = os.stat(source_path)
+    except OSError:
+        return None
+
+    key_str = '%s:%d:%d:%d' % (
+            source_path,
+            source_stat.st_mtime_ns,
+            source_stat.st_size,
+            gv_thumb_max_size)
+    key = hashlib.sha1(key_str.encode('utf-8')).hexdigest()
+    thumb_filename = '%s/%s.jpg' % (gv_thumb_cache_dir, key)
+
+    if os.path.exists(thumb_filename):
+        with gv_thumb_stats_lock:
+            gv_thumb_stats_dict['hits'] += 1
+        return thumb_filename
+
+    source_data = None
+    if cover_path:
+        try:
+            with open(cover_path, 'rb') as cover_file:
+                source_data = cover_file.read()
+        except OSError:
+            pass
+    elif extract_albumart:
+        albumart_mime, source_data = get_embedded_albumart(track_path)
+
+    if not source_data:
+        return None
+
+    try:
+        image = Image.open(io.BytesIO(source_data))
+        image.thumbnail((gv_thumb_max_size, gv_thumb_max_size))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        thumb_buffer = io.BytesIO()
+        image.save(
+                thumb_buffer, 
+                'JPEG', 
+                quality = gv_thumb_quality)
+    except Exception as error:
+        log_message(
+                1,
+                'Failed to thumbnail art for %s (%s)' % (
+                    source_path,
+                    error))
+        with gv_thumb_stats_lock:
+            gv_thumb_stats_dict['failures'] += 1
+        return None
+
+    if not write_cache_file(thumb_filename, thumb_buffer.getvalue()):
+        return None
+
+    with gv_thumb_stats_lock:
+        gv_thumb_stats_dict['created'] += 1
+        gv_thumb_stats_dict['sourceBytes'] += len(source_data)
+        gv_thumb_stats_dict['thumbBytes'] += thumb_buffer.tell()
+
+    return thumb_filename
+
+
+def thumb_stats():
+    global gv_thumb_stats_dict
+    global gv_thumb_stats_lock
+
+    with gv_thumb_stats_lock:
+        return dict(gv_thumb_stats_dict)
+
+
+def albumart_source_key(rel_source):
+    global gv_mpd_music_dir
+    global gv_thumb_max_size
+
+    # Key for an art source (cover file or track
+    # with embedded art) from its MPD-relative path 
+    # and mtime. A single stat so it's cheap on the 
+    # cast path and it changes whenever the source 
+    # does, so the art stored under it never changes
+    try:
+        source_mtime = os.stat(
+                os.path.join(gv_mpd_music_dir, rel_source)).st_mtime_ns
+    except OSError:
+        return None
+
+    key_str = '%s:%d:%d' % (
+            rel_source,
+            source_mtime,
+            gv_thumb_max_size)
+
+    return hashlib.sha1(key_str.encode('utf-8')).hexdigest()
+
+
+def albumart_store_get(key, rel_source, source_path):
+    global gv_albumart_names
+    global gv_art_store_dir
+    global gv_art_store_dict
+    global gv_art_store_exts
+    global gv_art_store_lock
+    global gv_art_store_max_entries
+    global gv_art_store_stats_dict
+
+    # Stored art file name (<key>.<ext>) for 
+    # an art source, made on first request. A 
+    # thumbnail if possible, else the cover file or 
+    # the embedded art as is
+    # Returns None if there is no art or the source 
+    # has changed since the key was made
+    with gv_art_store_lock:
+        if key in gv_art_store_dict:
+            gv_art_store_dict.move_to_end(key)
+            return gv_art_store_dict[key]
+
+    # Made by this or another worker process
+    art_filename = None
+    for art_ext in gv_art_store_exts:
+        if os.path.isfile('%s/%s.%s' % (gv_art_store_dir, key, art_ext)):
+            art_filename = '%s.%s' % (key, art_ext)
+            break
+
+    if (not art_filename and 
+            albumart_source_key(rel_source) == key):
+        track_path = None
+        cover_path = None
+        source_ext = os.path.splitext(source_path)[1].lower().lstrip('.')
+        if os.path.basename(source_path) in gv_albumart_names:
+            cover_path = source_path
+        elif (extract_albumart and 
+                source_ext in extract_albumart.music_file_exts):
+            track_path = source_path
+
+        art_data = None
+        art_ext = None
+        thumb_path = None
+        if Image:
+            thumb_path = get_albumart_thumb(track_path, cover_path)
+
+        try:
+            if thumb_path:
+                with open(thumb_path, 'rb') as art_file:
+                    art_data = art_file.read()
+                art_ext = 'jpg'
+            elif cover_path:
+                with open(cover_path, 'rb') as art_file:
+                    art_data = art_file.read()
+                art_ext = source_ext
+            elif track_path:
+                albumart_mime, art_data = get_embedded_albumart(track_path)
+                if art_data:
+                    art_ext = extract_albumart.albumart_mime_to_ext(albumart_mime)
+        except OSError:
+            art_data = None
+
+        if art_data:
+            art_filename = '%s.%s' % (key, art_ext)
+            if not write_cache_file(
+                    '%s/%s' % (gv_art_store_dir, art_filename), 
+                    art_data):
+                return None
+            with gv_art_store_lock:
+                gv_art_store_stats_dict['stored'] += 1
+
+    if not art_filename:
+        return None
+
+    with gv_art_store_lock:
+        gv_art_store_dict[key] = art_filename
+        gv_art_store_dict.move_to_end(key)
+        while len(gv_art_store_dict) > gv_art_store_max_entries:
+            gv_art_store_dict.popitem(last = False)
+
+    return art_filename
+
+
+def art_store_stats():
+    global gv_art_store_dict
+    global gv_art_store_lock
+    global gv_art_store_stats_dict
+
+    with gv_art_store_lock:
+        store_stats_dict = dict(gv_art_store_stats_dict)
+        store_stats_dict['sources'] = len(gv_art_store_dict)
+
+    return store_stats_dict
+
+
+class byte_rate_window(object):
+    # Bytes over a sliding window of 
+    # gv_egress_window_secs
+
+    def __init__(self):
+        self.samples = collections.deque()
+        self.total = 0
+        self.last_timestamp = 0
+
+    def add(self, nbytes, timestamp):
+        self.samples.append((timestamp, nbytes))
+        self.total += nbytes
+        self.last_timestamp = max(self.last_timestamp, timestamp)
+        self.prune(timestamp)
+
+    def prune(self, now):
+        global gv_egress_window_secs
+
+        while (self.samples and 
+                now - self.samples[0][0] > gv_egress_window_secs):
+            self.total -= self.samples.popleft()[1]
+
+    def rate(self, window = None):
+        global gv_egress_window_secs
+
+        # bytes/sec over the window 
+        # or the last window secs of it
+        now = time.monotonic()
+        self.prune(now)
+        if not window:
+            return self.total / gv_egress_window_secs
+
+        window_bytes = 0
+        for timestamp, nbytes in self.samples:
+            if now - timestamp <= window:
+                window_bytes += nbytes
+
+        return window_bytes / window
+
+    def idle_secs(self):
+        # time since the last bytes
+        if not self.last_timestamp:
+            return None
+
+        return time.monotonic() - self.last_timestamp
+
+
+def egress_record(client, nbytes, timestamp = None):
+    global gv_egress_dict
+    global gv_egress_lock
+    global gv_media_worker_index
+    global gv_media_stats_queue
+
+    # Bytes sent to a client
+    # Workers pass these on to the main process
+    # with the media request stats
+    if not timestamp:
+        timestamp = time.monotonic()
+
+    if gv_media_worker_index is not None:
+        gv_media_stats_queue.put({
+            'egress': client,
+            'bytes': nbytes,
+            'timestamp': timestamp})
+        return
+
+    with gv_egress_lock:
+        if client not in gv_egress_dict:
+            gv_egress_dict[client] = byte_rate_window()
+        gv_egress_dict[client].add(nbytes, timestamp)
+
+    return
+
+
+def egress_rate(client, window = None):
+    global gv_egress_dict
+    global gv_egress_lock
+
+    # bytes/sec sent to a client
+    with gv_egress_lock:
+        if client not in gv_egress_dict:
+            return 0.0
+        return gv_egress_dict[client].rate(window)
+
+
+def egress_idle_secs(client):
+    global gv_egress_dict
+    global gv_egress_lock
+
+    # secs since a client was last sent data
+    # None if never
+    with gv_egress_lock:
+        if client not in gv_egress_dict:
+            return None
+        return gv_egress_dict[client].idle_secs()
+
+
+def egress_stats():
+    global gv_egress_dict
+    global gv_egress_lock
+
+    stats_dict = {}
+    with gv_egress_lock:
+        for client in gv_egress_dict:
+            rate_window = gv_egress_dict[client]
+            client_dict = {}
+            client_dict['rate'] = int(rate_window.rate())
+            idle_secs = rate_window.idle_secs()
+            client_dict['idleSecs'] = round(idle_secs, 1)
+            stats_dict[client] = client_dict
+
+    return stats_dict
+
+
+def media_stats_record(request_dict):
+    global gv_media_request_history
+    global gv_media_stats_dict
+    global gv_media_stats_lock
+    global gv_media_worker_index
+    global gv_media_stats_queue
+
+    # Workers pass the request on
+    # to the main process
+    if gv_media_worker_index is not None:
+        request_dict['worker'] = gv_media_worker_index
+        gv_media_stats_queue.put(request_dict)
+        return
+
+    # Add a completed media request to the
+    # history and running totals
+    with gv_media_stats_lock:
+        gv_media_request_history.append(request_dict)
+        gv_media_stats_dict['requests'] += 1
+        if request_dict['status'] == 206:
+            gv_media_stats_dict['rangeRequests'] += 1
+        if request_dict['aborted']:
+            gv_media_stats_dict['aborted'] += 1
+        if request_dict['status'] >= 400:
+            gv_media_stats_dict['errors'] += 1
+        if request_dict['path'].startswith('/cover/'):
+            if request_dict['status'] == 304:
+                gv_media_stats_dict['artNotModified'] += 1
+            elif request_dict['status'] == 200:
+                gv_media_stats_dict['artTransfers'] += 1
+        gv_media_stats_dict['bytes'] += request_dict['bytes']
+        gv_media_stats_dict['secs'] += request_dict['secs']
+        gv_media_stats_dict['cpuSecs'] += request_dict['cpuSecs']
+
+    return
+
+
+def media_stats():
+    global gv_media_request_history
+    global gv_media_stats_dict
+    global gv_media_stats_lock
+    global gv_media_worker_list
+
+    # Media server totals and recent requests
+    # for /stats with derived throughput and CPU
+    # cost per MB
+    with gv_media_stats_lock:
+        totals_dict = dict(gv_media_stats_dict)
+        request_list = list(gv_media_request_history)
+
+    mbytes = totals_dict['bytes'] / (1024 * 1024)
+    totals_dict['secs'] = round(totals_dict['secs'], 3)
+    totals_dict['cpuSecs'] = round(totals_dict['cpuSecs'], 3)
+    totals_dict['mbytesPerSec'] = round(
+            mbytes / totals_dict['secs'], 3) if totals_dict['secs'] else 0
+    totals_dict['cpuMsecsPerMbyte'] = round(
+            totals_dict['cpuSecs'] * 1000 / mbytes, 3) if mbytes else 0
+    totals_dict['recent'] = request_list
+
+    totals_dict['workers'] = []
+    for worker_dict in gv_media_worker_list:
+        if not worker_dict['pid']:
+            continue
+        worker_stats_dict = {}
+        worker_stats_dict['pid'] = worker_dict['pid']
+        worker_stats_dict['alive'] = media_worker_alive(worker_dict['pid'])
+        worker_stats_dict['started'] = worker_dict['started_time']
+        worker_stats_dict['restarts'] = worker_dict['restarts']
+        totals_dict['workers'].append(worker_stats_dict)
+
+    return totals_dict
+
+
+class media_request_handler(http.server.BaseHTTPRequestHandler):
+    # Static file handler for cast devices
+    # HTTP/1.1 keeps connections alive across the
+    # many Range requests made when buffering and seeking.
+    # File bodies go out with os.sendfile() so data is 
+    # copied in the kernel and not through the interpreter
+    # Idle reads and stalled writes time out so a dead 
+    # client doesn't hold a handler thread forever
+    protocol_version = 'HTTP/1.1'
+    server_version = 'mpd2chromecast'
+    timeout = 30
+
+    def log_message(self, format, *args):
+        global gv_verbose
+
+        log_message(
+                gv_verbose,
+                'Media server %s %s' % (
+                    self.address_string(),
+                    format % args))
+
+    def do_GET(self):
+        self.serve_file(send_body = True)
+
+    def do_HEAD(self):
+        self.serve_file(send_body = False)
+
+    def serve_file(self, send_body):
+        request_dict = {}
+        request_dict['path'] = urllib.parse.unquote(
+                urllib.parse.urlsplit(self.path).path)
+        request_dict['method'] = self.command
+        request_dict['client'] = self.client_address[0]
+        request_dict['range'] = self.headers.get('Range')
+        request_dict['status'] = 200
+        request_dict['bytes'] = 0
+        request_dict['aborted'] = False
+        request_dict['secs'] = 0.0
+        request_dict['cpuSecs'] = 0.0
+        request_dict['mbytesPerSec'] = 0
+        request_dict['cpuMsecsPerMbyte'] = 0
+
+        start_time = time.monotonic()
+        start_cpu = time.thread_time()
+        try:
+            if request_dict['path'].startswith('/art/'):
+                self.send_art(request_dict, send_body)
+            elif request_dict['path'].startswith('/cover/'):
+                self.send_stored_art(request_dict, send_body)
+            else:
+                self.send_file(request_dict, send_body)
+        except (BrokenPipeError, ConnectionResetError, TimeoutError):
+            # cast devices routinely drop connections
+            # when seeking or skipping
+            request_dict['aborted'] = True
+            self.close_connection = True
+
+        request_dict['secs'] = time.monotonic() - start_time
+        request_dict['cpuSecs'] = time.thread_time() - start_cpu
+        mbytes = request_dict['bytes'] / (1024 * 1024)
+        if request_dict['secs'] > 0:
+            request_dict['mbytesPerSec'] = round(
+                    mbytes / request_dict['secs'], 3)
+        if mbytes > 0:
+            request_dict['cpuMsecsPerMbyte'] = round(
+                    request_dict['cpuSecs'] * 1000 / mbytes, 3)
+        request_dict['secs'] = round(request_dict['secs'], 6)
+        request_dict['cpuSecs'] = round(request_dict['cpuSecs'], 6)
+        media_stats_record(request_dict)
+
+    def send_art(self, request_dict, send_body):
+        global gv_mpd_music_dir
+
+        # Art for the track at /art/<track path>
+        # A thumbnail if possible, else the cover file 
+        # or embedded art as is
+        rel_track = request_dict['path'][len('/art/'):]
+        track_path = media_path_to_file('/music/' + rel_track)
+        if not track_path:
+            request_dict['status'] = 404
+            self.send_error(404)
+            return
+
+        cover_path = None
+        rel_dir = os.path.dirname(rel_track)
+        cover_name = albumart_index_lookup(rel_dir)
+        if cover_name:
+            cover_path = os.path.join(gv_mpd_music_dir, rel_dir, cover_name)
+
+        if Image:
+            thumb_path = get_albumart_thumb(track_path, cover_path)
+            if thumb_path:
+                self.send_file(request_dict, send_body, thumb_path)
+                return
+
+        if cover_path:
+            self.send_file(request_dict, send_body, cover_path)
+            return
+
+        albumart_mime = None
+        if extract_albumart:
+            albumart_mime, albumart_data = get_embedded_albumart(track_path)
+
+        if not albumart_mime:
+            request_dict['status'] = 404
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', albumart_mime)
+        self.send_header('Content-Length', str(len(albumart_data)))
+        self.end_headers()
+
+        if send_body:
+            self.wfile.write(albumart_data)
+            request_dict['bytes'] = len(albumart_data)
+
+    def send_stored_art(self, request_dict, send_body):
+        global gv_art_store_dir
+
+        # Art at /cover/<key>/<source>, made from 
+        # the source on first request. The key changes 
+        # whenever the source does so the content is 
+        # cacheable forever and the key makes a 
+        # strong ETag
+        art_key, sep, rel_source = request_dict['path'][len('/cover/'):].partition('/')
+        source_path = media_path_to_file('/music/' + rel_source)
+        art_filename = None
+        if (len(art_key) == 40 and 
+                not art_key.strip('0123456789abcdef') and 
+                source_path):
+            art_filename = albumart_store_get(
+                    art_key, 
+                    rel_source, 
+                    source_path)
+        if not art_filename:
+            request_dict['status'] = 404
+            self.send_error(404)
+            return
+
+        etag = '"%s"' % (art_key)
+        header_dict = {}
+        header_dict['ETag'] = etag
+        header_dict['Cache-Control'] = 'public, max-age=31536000, immutable'
+
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            etag_list = [tag.strip().replace('W/', '', 1) 
+                    for tag in if_none_match.split(',')]
+            if (etag in etag_list or 
+                    '*' in etag_list):
+                request_dict['status'] = 304
+                self.send_response(304)
+                for header in header_dict:
+                    self.send_header(header, header_dict[header])
+                self.end_headers()
+                return
+
+        self.send_file(
+                request_dict, 
+                send_body, 
+                '%s/%s' % (gv_art_store_dir, art_filename),
+                header_dict)
+
+    def send_file(self, request_dict, send_body, file_path = None, header_dict = None):
+        global gv_media_chunk_bytes
+
+        # File from the request path 
+        # unless given
+        if not file_path:
+            file_path = media_path_to_file(request_dict['path'])
+        if not file_path:
+            request_dict['status'] = 404
+            self.send_error(404)
+            return
+
+        try:
+            media_file = open(file_path, 'rb')
+        except OSError:
+            request_dict['status'] = 404
+            self.send_error(404)
+            return
+
+        with media_file:
+            file_stat = os.fstat(media_file.fileno())
+            size = file_stat.st_size
+
+            try:
+                byte_range = parse_http_range(
+                        request_dict['range'],
+                        size)
+            except ValueError:
+                request_dict['status'] = 416
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % (size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            if byte_range:
+                start, end = byte_range
+                request_dict['status'] = 206
+            else:
+                start, end = 0, size - 1
+            count = end - start + 1
+
+            mime_type = media_mime_type(file_path)
+
+            self.send_response(request_dict['status'])
+            self.send_header('Content-Type', mime_type)
+            self.send_header('Content-Length', str(count))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header(
+                    'Last-Modified', 
+                    self.date_time_string(file_stat.st_mtime))
+            if byte_range:
+                self.send_header(
+                        'Content-Range', 
+                        'bytes %d-%d/%d' % (start, end, size))
+            if header_dict:
+                for header in header_dict:
+                    self.send_header(header, header_dict[header])
+            self.end_headers()
+
+            if not send_body:
+                return
+
+            # Kernel copy in chunks so the sent byte
+            # count is known if the client drops
+            self.wfile.flush()
+            offset = start
+            remaining = count
+            while remaining > 0:
+                sent = os.sendfile(
+                        self.connection.fileno(),
+                        media_file.fileno(),
+                        offset,
+                        min(remaining, gv_media_chunk_bytes))
+                if sent == 0:
+                    # file truncated under us
+                    self.close_connection = True
+                    break
+                offset += sent
+                remaining -= sent
+                request_dict['bytes'] += sent
+                egress_record(request_dict['client'], sent)
+
+
+class media_http_server(http.server.ThreadingHTTPServer):
+    # Threaded server for the media handler
+    # Worker processes all bind the same port with
+    # SO_REUSEPORT and the kernel spreads connections
+    # across them
+    daemon_threads = True
+
+    def server_bind(self):
+        global gv_media_worker_index
+
+        if gv_media_worker_index is not None:
+            self.socket.setsockopt(
+                    socket.SOL_SOCKET, 
+                    socket.SO_REUSEPORT, 
+                    1)
+        super().server_bind()
+
+
+def media_server():
+    global gv_media_port
+
+    # In-process media server
+    # blocking
+    server = media_http_server(
+            ('0.0.0.0', gv_media_port),
+            media_request_handler)
+    log_message(
+            1,
+            'Media server listening on port %d' % (
+                gv_media_port))
+    server.serve_forever()
+
+
+class stream_relay(object):
+    # Single upstream connection to MPD's httpd output
+    # shared by all relay clients
+    # Stream data is kept in a ring of chunks addressed 
+    # by byte offset in the stream. Clients each read at 
+    # their own offset so a slow client only holds up 
+    # itself and one that falls out of the ring is moved 
+    # on to the oldest data. The stream header (FLAC 
+    # metadata) is kept aside and sent to each client 
+    # ahead of its first frame
+
+    def __init__(self, url):
+        self.url = url
+        self.condition = threading.Condition()
+        self.chunks = collections.deque()
+        self.start_offset = 0
+        self.end_offset = 0
+        self.header = None
+        self.content_type = 'audio/flac'
+        self.generation = 0
+        self.clients = 0
+        self.last_client_timestamp = 0
+        self.upstream_thread = None
+        self.normaliser = None
+        self.ingress = byte_rate_window()
+        self.stats_dict = {
+                'upstreamConnects': 0,
+                'upstreamErrors': 0,
+                'upstreamBytes': 0,
+                'clientConnects': 0,
+                'clientBytes': 0,
+                'overruns': 0,
+                }
+
+    def attach(self):
+        global gv_stream_relay_prefill_bytes
+        global gv_stream_relay_timeout
+
+        # New client
+        # Starts the upstream if needed and waits for
+        # the stream header
+        # Returns (generation, header, offset) or None
+        with self.condition:
+            self.clients += 1
+            self.stats_dict['clientConnects'] += 1
+            if not (self.upstream_thread and 
+                    self.upstream_thread.is_alive()):
+                self.header = None
+                self.upstream_thread = threading.Thread(
+                        target = self.upstream,
+                        daemon = True)
+                self.upstream_thread.start()
+
+            if not self.condition.wait_for(
+                    lambda: self.header is not None,
+                    gv_stream_relay_timeout):
+                return None
+
+            offset = max(
+                    self.start_offset, 
+                    self.end_offset - gv_stream_relay_prefill_bytes)
+
+            return (self.generation, self.header, offset)
+
+    def detach(self):
+        with self.condition:
+            self.clients -= 1
+            self.last_client_timestamp = time.monotonic()
+
+    def read(self, generation, offset):
+        global gv_stream_relay_timeout
+
+        # Stream data from offset 
+        # Returns (offset, data) with the offset moved
+        # on if the client fell out of the ring, empty 
+        # data on a timeout, or None once the stream 
+        # has changed format
+        with self.condition:
+            self.condition.wait_for(
+                    lambda: (self.generation != generation or 
+                        self.end_offset > offset),
+                    gv_stream_relay_timeout)
+
+            if self.generation != generation:
+                return None
+
+            if offset < self.start_offset:
+                self.stats_dict['overruns'] += 1
+                offset = self.start_offset
+
+            data_list = []
+            chunk_offset = self.start_offset
+            for chunk in self.chunks:
+                chunk_end = chunk_offset + len(chunk)
+                if chunk_end > offset:
+                    data_list.append(chunk[max(0, offset - chunk_offset):])
+                chunk_offset = chunk_end
+
+            data = b''.join(data_list)
+            self.stats_dict['clientBytes'] += len(data)
+
+            return (offset, data)
+
+    def read_header(self, response, content_type):
+        # FLAC stream header (signature and metadata 
+        # blocks up to the last block)
+        # Other formats need no header
+        if 'flac' not in content_type:
+            return b''
+
+        header = response.read(4)
+        if header != b'fLaC':
+            raise ValueError('no FLAC signature')
+
+        last_block = False
+        while not last_block:
+            block_header = response.read(4)
+            if len(block_header) != 4:
+                raise ValueError('truncated FLAC header')
+            last_block = block_header[0] & 0x80
+            block_length = struct.unpack('>I', b'\0' + block_header[1:])[0]
+            header += block_header + response.read(block_length)
+
+        return header
+
+    def upstream(self):
+        global gv_stream_relay_buffer_bytes
+        global gv_stream_relay_chunk_bytes
+        global gv_stream_relay_timeout
+        global gv_stream_relay_idle_secs
+
+        # Upstream connection
+        # Reconnects on errors and stalls while there 
+        # are clients and exits once idle. Clients carry
+        # on across a reconnect unless the stream header
+        # (format) has changed
+        url_parts = urllib.parse.urlsplit(self.url)
+        while True:
+            with self.condition:
+                if (self.clients == 0 and 
+                        time.monotonic() - self.last_client_timestamp >= gv_stream_relay_idle_secs):
+                    log_message(
+                            1,
+                            'Stream relay idle.. closing upstream')
+                    self.header = None
+                    self.upstream_thread = None
+                    self.generation += 1
+                    self.condition.notify_all()
+                    if self.normaliser:
+                        self.normaliser.stop()
+                    return
+
+            connection = None
+            try:
+                log_message(
+                        1,
+                        'Stream relay connecting to %s' % (
+                            self.url))
+                connection = http.client.HTTPConnection(
+                        url_parts.hostname,
+                        url_parts.port or 80,
+                        timeout = gv_stream_relay_timeout)
+                connection.request('GET', url_parts.path or '/')
+                response = connection.getresponse()
+                if response.status != 200:
+                    raise ValueError('HTTP status %d' % (response.status))
+
+                content_type = response.getheader('Content-Type', 'audio/flac')
+                header = self.read_header(response, content_type)
+                self.stats_dict['upstreamConnects'] += 1
+
+                # With the normaliser, each connection gets a 
+                # new decoder and the relay stream (format and 
+                # header) comes from its encoder
+                if self.normaliser:
+                    if not self.normaliser.encoder_running():
+                        threading.Thread(
+                                target = self.normalised_output,
+                                args = (self.normaliser.start_encoder(),),
+                                daemon = True).start()
+                    self.normaliser.start_decoder(content_type, header)
+                else:
+                    self.content_type = content_type
+                    self.set_header(header)
+
+                while True:
+                    data = response.read1(gv_stream_relay_chunk_bytes)
+                    if not data:
+                        # MPD reopens its stream on a format
+                        # change so reconnect straight away
+                        log_message(
+                                1,
+                                'Stream relay upstream closed')
+                        break
+
+                    self.stats_dict['upstreamBytes'] += len(data)
+                    if self.normaliser:
+                        self.normaliser.write(data)
+                    else:
+                        self.append(data)
+
+                    with self.condition:
+                        if (self.clients == 0 and 
+                                time.monotonic() - self.last_client_timestamp >= gv_stream_relay_idle_secs):
+                            break
+
+            except Exception as error:
+                self.stats_dict['upstreamErrors'] += 1
+                log_message(
+                        1,
+                        'Stream relay upstream problem (%s)' % (
+                            error))
+                time.sleep(1)
+
+            finally:
+                if connection:
+                    connection.close()
+
+    def set_header(self, header):
+        # New stream header
+        # A change of format closes the clients
+        with self.condition:
+            if header != self.header:
+                if self.header is not None:
+                    log_message(
+                            1,
+                            'Stream relay format change.. closing clients')
+                self.header = header
+                self.generation += 1
+                self.chunks.clear()
+                self.start_offset = self.end_offset
+            self.condition.notify_all()
+
+    def append(self, data):
+        global gv_stream_relay_buffer_bytes
+
+        # Add stream data to the ring
+        with self.condition:
+            self.chunks.append(data)
+            self.end_offset += len(data)
+            self.ingress.add(len(data), time.monotonic())
+            while (self.end_offset - self.start_offset > gv_stream_relay_buffer_bytes):
+                self.start_offset += len(self.chunks.popleft())
+            self.condition.notify_all()
+
+    def normalised_output(self, encoder_output):
+        global gv_stream_relay_chunk_bytes
+
+        # Normaliser encoder output into the ring
+        # Runs for the life of the encoder
+        try:
+            header = self.read_header(encoder_output, 'audio/flac')
+            self.content_type = 'audio/flac'
+            self.set_header(header)
+            while True:
+                data = encoder_output.read1(gv_stream_relay_chunk_bytes)
+                if not data:
+                    break
+                self.append(data)
+        except Exception as error:
+            log_message(
+                    1,
+                    'Stream normaliser output problem (%s)' % (
+                        error))
+
+        log_message(
+                1,
+                'Stream normaliser encoder exited')
+
+    def ingress_rate(self):
+        # upstream bytes/sec
+        with self.condition:
+            return self.ingress.rate()
+
+    def to_dict(self):
+        relay_dict = dict(self.stats_dict)
+        relay_dict['clients'] = self.clients
+        relay_dict['bufferedBytes'] = self.end_offset - self.start_offset
+        relay_dict['upstreamRate'] = int(self.ingress_rate())
+        relay_dict['upstream'] = bool(
+                self.upstream_thread and 
+                self.upstream_thread.is_alive())
+        if self.normaliser:
+            relay_dict['normaliser'] = self.normaliser.to_dict()
+
+        return relay_dict
+
+
+class stream_normaliser(object):
+    # Fixed format stage for the stream relay
+    # Each upstream connection to MPD gets an ffmpeg 
+    # decoder that resamples to the fixed PCM format and 
+    # feeds one long-running ffmpeg FLAC encoder. MPD 
+    # reopens its stream on a format change, which then
+    # only replaces the decoder. Cast devices see one 
+    # unbroken stream in one format
+
+    def __init__(self, samplerate, bits, channels):
+        self.samplerate = samplerate
+        self.bits = bits
+        self.channels = channels
+        if bits == 16:
+            self.pcm_format = 's16le'
+            self.frame_bytes = 2 * channels
+        else:
+            self.pcm_format = 's32le'
+            self.frame_bytes = 4 * channels
+        self.encoder = None
+        self.decoder = None
+        self.pump_thread = None
+        self.encoder_lock = threading.Lock()
+        self.stats_dict = {
+                'encoders': 0,
+                'decoders': 0,
+                'pcmBytes': 0,
+                }
+
+    def format_str(self):
+        # as MPD reports its audio format
+        return '%d:%d:%d' % (
+                self.samplerate,
+                self.bits,
+                self.channels)
+
+    def pcm_args(self):
+        return [
+                '-f', self.pcm_format,
+                '-ar', str(self.samplerate),
+                '-ac', str(self.channels),
+                ]
+
+    def encoder_running(self):
+        return (self.encoder is not None and 
+                self.encoder.poll() is None)
+
+    def start_encoder(self):
+        # Returns the encoder output
+        args = ['ffmpeg', '-hide_banner', '-loglevel', 'error']
+        args += self.pcm_args() + ['-i', 'pipe:0']
+        if self.bits == 24:
+            args += ['-sample_fmt', 's32', '-bits_per_raw_sample', '24']
+        args += ['-c:a', 'flac', '-f', 'flac', 'pipe:1']
+
+        log_message(
+                1,
+                'Starting stream normaliser encoder (%s)' % (
+                    self.format_str()))
+        self.encoder = subprocess.Popen(
+                args,
+                stdin = subprocess.PIPE,
+                stdout = subprocess.PIPE)
+        self.stats_dict['encoders'] += 1
+
+        return self.encoder.stdout
+
+    def start_decoder(self, content_type, header):
+        global gv_stream_input_format_dict
+
+        # Decoder for a new upstream connection
+        # fed with its stream header
+        self.stop_decoder()
+
+        args = ['ffmpeg', '-hide_banner', '-loglevel', 'error']
+        if content_type in gv_stream_input_format_dict:
+            args += ['-f', gv_stream_input_format_dict[content_type]]
+        args += ['-i', 'pipe:0'] + self.pcm_args() + ['pipe:1']
+
+        self.decoder = subprocess.Popen(
+                args,
+                stdin = subprocess.PIPE,
+                stdout = subprocess.PIPE)
+        self.stats_dict['decoders'] += 1
+        self.pump_thread = threading.Thread(
+                target = self.pump,
+                args = (self.decoder,),
+                daemon = True)
+        self.pump_thread.start()
+        self.write(header)
+
+    def pump(self, decoder):
+        # Decoded PCM on to the encoder
+        # Topped up to whole sample frames at the 
+        # end so the next decoder stays aligned
+        pcm_bytes = 0
+        try:
+            while True:
+                data = decoder.stdout.read1(65536)
+                if not data:
+                    break
+                pcm_bytes += len(data)
+                with self.encoder_lock:
+                    self.encoder.stdin.write(data)
+                    self.encoder.stdin.flush()
+
+            remainder = pcm_bytes % self.frame_bytes
+            if remainder:
+                with self.encoder_lock:
+                    self.encoder.stdin.write(b'\0' * (self.frame_bytes - remainder))
+                    self.encoder.stdin.flush()
+        except (OSError, ValueError, AttributeError):
+            pass
+
+        self.stats_dict['pcmBytes'] += pcm_bytes
+
+    def write(self, data):
+        # Upstream data into the decoder
+        # Raises if the decoder has gone
+        self.decoder.stdin.write(data)
+        self.decoder.stdin.flush()
+
+    def stop_decoder(self):
+        if not self.decoder:
+            return
+
+        # Let the decoder drain into the encoder
+        try:
+            self.decoder.stdin.close()
+        except OSError:
+            pass
+        if self.pump_thread:
+            self.pump_thread.join(timeout = 2)
+        self.decoder.kill()
+        self.decoder.wait()
+        self.decoder = None
+
+    def stop(self):
+        self.stop_decoder()
+        if self.encoder:
+            self.encoder.kill()
+            self.encoder.wait()
+            self.encoder = None
+
+    def to_dict(self):
+        normaliser_dict = dict(self.stats_dict)
+        normaliser_dict['format'] = self.format_str()
+        normaliser_dict['encoder'] = self.encoder_running()
+
+        return normaliser_dict
+
+
+def stream_frame_sync(data):
+    # Offset of the first FLAC frame sync code 
+    # so a client joining mid-stream starts on a 
+    # frame boundary
+    for index in range(len(data) - 1):
+        if (data[index] == 0xFF and 
+                data[index + 1] in (0xF8, 0xF9)):
+            return index
+
+    return -1
+
+
+class stream_relay_handler(http.server.BaseHTTPRequestHandler):
+    # Relay client
+    # HTTP/1.0 with the stream running until
+    # either side closes or a write stalls
+    server_version = 'mpd2chromecast'
+    timeout = 30
+
+    def log_message(self, format, *args):
+        global gv_verbose
+
+        log_message(
+                gv_verbose,
+                'Stream relay %s %s' % (
+                    self.address_string(),
+                    format % args))
+
+    def do_HEAD(self):
+        global gv_stream_relay
+
+        self.send_response(200)
+        self.send_header('Content-Type', gv_stream_relay.content_type)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+
+    def do_GET(self):
+        global gv_stream_relay
+
+        relay = gv_stream_relay
+        attach_result = relay.attach()
+        try:
+            if not attach_result:
+                self.send_error(503, 'MPD stream not available')
+                return
+
+            generation, header, offset = attach_result
+            log_message(
+                    1,
+                    'Stream relay client %s joined' % (
+                        self.client_address[0]))
+
+            self.send_response(200)
+            self.send_header('Content-Type', relay.content_type)
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            self.wfile.write(header)
+
+            # Joining or moved on mid-stream
+            # skips to the next frame
+            frame_sync = bool(header)
+            while True:
+                read_result = relay.read(generation, offset)
+                if not read_result:
+                    break
+
+                read_offset, data = read_result
+                if read_offset != offset:
+                    frame_sync = bool(header)
+                offset = read_offset + len(data)
+
+                if frame_sync:
+                    sync_index = stream_frame_sync(data)
+                    if sync_index < 0:
+                        continue
+                    data = data[sync_index:]
+                    frame_sync = False
+
+                self.wfile.write(data)
+                egress_record(self.client_address[0], len(data))
+
+        except (BrokenPipeError, ConnectionResetError, TimeoutError):
+            pass
+
+        finally:
+            relay.detach()
+            log_message(
+                    1,
+                    'Stream relay client %s left' % (
+                        self.client_address[0]))
+
+
+def stream_relay_server():
+    global gv_stream_relay_port
+
+    # Stream relay server
+    # blocking
+    server = http.server.ThreadingHTTPServer(
+            ('0.0.0.0', gv_stream_relay_port),
+            stream_relay_handler)
+    server.daemon_threads = True
+    log_message(
+            1,
+            'Stream relay listening on port %d' % (
+                gv_stream_relay_port))
+    server.serve_forever()
+
+
+def media_worker_process(index):
+    global gv_media_port
+    global gv_media_worker_index
+    global gv_media_stats_queue
+
+    # Media server worker process
+    # Serves on its own threads and exits when 
+    # the supervisor process goes away
+    gv_media_worker_index = index
+    parent_pid = os.getppid()
+
+    server = media_http_server(
+            ('0.0.0.0', gv_media_port),
+            media_request_handler)
+    server_thread = threading.Thread(
+            target = server.serve_forever,
+            daemon = True)
+    server_thread.start()
+    log_message(
+            1,
+            'Media worker %d (pid %d) listening on port %d' % (
+                index,
+                os.getpid(),
+                gv_media_port))
+
+    # Let the main process know for /stats
+    gv_media_stats_queue.put({
+        'workerStarted': index,
+        'pid': os.getpid(),
+        'time': int(time.time())})
+
+    while os.getppid() == parent_pid:
+        time.sleep(1)
+
+    os._exit(0)
+
+
+def start_media_worker(index):
+    # Fork a media worker process
+    # Only called in the supervisor process
+    pid = os.fork()
+    if pid == 0:
+        try:
+            media_worker_process(index)
+        finally:
+            os._exit(0)
+
+    return pid
+
+
+def media_supervisor_process(num_workers):
+    # Media worker supervisor
+    # Stays single-threaded so forks are safe. Restarts
+    # workers that exit and exits when the main process
+    # goes away (the workers follow)
+    parent_pid = os.getppid()
+    worker_dict = {}
+    for index in range(num_workers):
+        worker_dict[start_media_worker(index)] = index
+
+    while os.getppid() == parent_pid:
+        time.sleep(1)
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+
+            index = worker_dict.pop(pid, None)
+            if index is None:
+                continue
+            log_message(
+                    1,
+                    'Media worker %d (pid %d) exited with status %d.. restarting' % (
+                        index,
+                        pid,
+                        status))
+            worker_dict[start_media_worker(index)] = index
+
+    os._exit(0)
+
+
+def start_media_workers(num_workers):
+    global gv_media_stats_queue
+    global gv_media_supervisor
+
+    gv_media_stats_queue = multiprocessing.get_context('fork').Queue()
+    gv_media_supervisor = multiprocessing.get_context('fork').Process(
+            target = media_supervisor_process,
+            args = (num_workers,),
+            name = 'Media Supervisor',
+            daemon = True)
+    gv_media_supervisor.start()
+
+    return
+
+
+def media_worker_alive(pid):
+    # Workers are not our children
+    # so probe with signal 0
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+
+    return True
+
+
+def supervise_media_workers():
+    global gv_media_stats_queue
+    global gv_media_supervisor
+    global gv_media_supervisor_reported
+
+    if not gv_media_stats_queue:
+        return
+
+    # Pull request stats from the workers
+    while True:
+        try:
+            request_dict = gv_media_stats_queue.get_nowait()
+        except queue.Empty:
+            break
+        if 'egress' in request_dict:
+            egress_record(
+                    request_dict['egress'],
+                    request_dict['bytes'],
+                    request_dict['timestamp'])
+            continue
+        if 'workerStarted' in request_dict:
+            media_worker_started(request_dict)
+            continue
+        media_stats_record(request_dict)
+
+    # Workers can't be restarted safely from here
+    # once the supervisor is gone
+    if (gv_media_supervisor.exitcode is not None and 
+            not gv_media_supervisor_reported):
+        log_message(
+                1,
+                'Media worker supervisor exited with code %s.. workers not restarted' % (
+                    gv_media_supervisor.exitcode))
+        gv_media_supervisor_reported = True
+
+    return
+
+
+def media_worker_started(request_dict):
+    global gv_media_worker_list
+
+    # Track worker starts and restarts 
+    # as reported by the workers
+    index = request_dict['workerStarted']
+    while len(gv_media_worker_list) <= index:
+        worker_dict = {}
+        worker_dict['pid'] = None
+        worker_dict['restarts'] = -1
+        gv_media_worker_list.append(worker_dict)
+
+    worker_dict = gv_media_worker_list[index]
+    worker_dict['pid'] = request_dict['pid']
+    worker_dict['started_time'] = request_dict['time']
+    worker_dict['restarts'] += 1
+
+    return
+
+
+def media_mime_type(file_path):
+    # MIME type by file extension
+    mime_type, encoding = mimetypes.guess_type(file_path)
+    if not mime_type:
+        mime_type = 'application/octet-stream'
+
+    return mime_type
+
+
 def mpd_file_to_url(mpd_file):
     global gv_server_ip
-    global gv_cast_port
+    global gv_media_port
 
     # Radio/external stream
     # URL will start with http
@@ -556,76 +3827,995 @@ def mpd_file_to_url(mpd_file):
         # mpd_file path is also made web-safe
         cast_url = 'http://%s:%d/music/%s' % (
                 gv_server_ip,
-                gv_cast_port,
+                gv_media_port,
                 urllib.parse.quote(mpd_file))
 
-        # Split out extension of file
-        file, ext = os.path.splitext(mpd_file)
-        mime_type = 'audio/%s' % (ext.replace('.', ''))
+        # MIME type from the file content
+        mime_type = media_file_info(mpd_file)['mime']
         stream_type = 'file'
 
     return (cast_url, mime_type, stream_type)
 
 
+def albumart_dir_mtime(rel_dir):
+    global gv_mpd_music_dir
+
+    # Modification time of a music directory
+    # or None if it can't be read
+    try:
+        return os.stat(os.path.join(gv_mpd_music_dir, rel_dir)).st_mtime_ns
+    except OSError:
+        return None
+
+
+def albumart_dir_scan(rel_dir, dir_mtime, embedded = False):
+    global gv_mpd_music_dir
+    global gv_albumart_names
+
+    # Cover file name found by listing a music 
+    # directory or None if it has none
+    # With embedded set, a directory without one
+    # falls back to its first track if that has
+    # embedded art
+    file_names = set()
+    if dir_mtime is not None:
+        try:
+            with os.scandir(os.path.join(gv_mpd_music_dir, rel_dir)) as dir_iter:
+                for dir_entry in dir_iter:
+                    file_names.add(dir_entry.name)
+        except OSError:
+            pass
+
+    for name in gv_albumart_names:
+        if name in file_names:
+            return name
+
+    if (embedded and 
+            extract_albumart):
+        for name in sorted(file_names):
+            if (os.path.splitext(name)[1].lower().lstrip('.') not in 
+                    extract_albumart.music_file_exts):
+                continue
+            albumart_mime, albumart_data = get_embedded_albumart(
+                    os.path.join(gv_mpd_music_dir, rel_dir, name))
+            if albumart_data:
+                return name
+            break
+
+    return None
+
+
+def albumart_index_lookup(rel_dir):
+    global gv_albumart_index
+    global gv_albumart_index_lock
+    global gv_albumart_index_max_entries
+    global gv_albumart_index_revalidate_secs
+    global gv_albumart_index_stats_dict
+
+    # Cover file name for a music directory
+    # or None if it has none
+    now = time.monotonic()
+    with gv_albumart_index_lock:
+        entry = gv_albumart_index.get(rel_dir)
+        if entry:
+            gv_albumart_index.move_to_end(rel_dir)
+            if now - entry['checked'] < gv_albumart_index_revalidate_secs:
+                gv_albumart_index_stats_dict['hits'] += 1
+                return entry['cover']
+
+    dir_mtime = albumart_dir_mtime(rel_dir)
+
+    # Unchanged directory
+    if (entry and 
+            dir_mtime == entry['mtime']):
+        with gv_albumart_index_lock:
+            entry['checked'] = now
+            gv_albumart_index_stats_dict['revalidations'] += 1
+        return entry['cover']
+
+    # (Re)scan directory
+    cover = albumart_dir_scan(rel_dir, dir_mtime)
+
+    entry = {}
+    entry['cover'] = cover
+    entry['mtime'] = dir_mtime
+    entry['checked'] = now
+
+    with gv_albumart_index_lock:
+        gv_albumart_index_stats_dict['scans'] += 1
+        gv_albumart_index[rel_dir] = entry
+        gv_albumart_index.move_to_end(rel_dir)
+        while len(gv_albumart_index) > gv_albumart_index_max_entries:
+            gv_albumart_index.popitem(last = False)
+            gv_albumart_index_stats_dict['evictions'] += 1
+
+    return cover
+
+
+def albumart_index_stats():
+    global gv_albumart_index
+    global gv_albumart_index_lock
+    global gv_albumart_index_stats_dict
+
+    with gv_albumart_index_lock:
+        index_stats_dict = dict(gv_albumart_index_stats_dict)
+        index_stats_dict['entries'] = len(gv_albumart_index)
+
+    return index_stats_dict
+
+
 def get_albumart_url(mpd_file):
     global gv_server_ip
-    global gv_cast_port
+    global gv_media_port
+    global gv_mpd_music_dir
     global gv_verbose
 
-    # Ignore URLs
-    if mpd_file.startswith('http'):
-        return None
+    # Ignore URLs
+    if mpd_file.startswith('http'):
+        return None
+
+    albumart_url = None
+
+    # Art source (cover file or the album's first 
+    # track with embedded art) from the library index.
+    # Tracks not yet indexed only get a cover file 
+    # from the directory as checking for embedded art
+    # means reading the track. No art, no URL, rather 
+    # than one the device gets a 404 for
+    rel_dir = os.path.dirname(mpd_file)
+    track_dict = library_lookup(mpd_file)
+    if track_dict:
+        rel_source = track_dict['art']
+    else:
+        cover_name = albumart_index_lookup(rel_dir)
+        rel_source = os.path.join(rel_dir, cover_name) if cover_name else None
+
+    # Keyed by source so every track of an album 
+    # shares the URL. Made by the media server when
+    # the device first asks for it
+    if rel_source:
+        key = albumart_source_key(rel_source)
+        if key:
+            albumart_url = 'http://%s:%d/cover/%s/%s' % (
+                    gv_server_ip,
+                    gv_media_port,
+                    key,
+                    urllib.parse.quote(rel_source))
+
+    return albumart_url
+
+
+def get_mpd_stream_albumart_url():
+    global gv_server_ip
+    global gv_media_port
+    global gv_verbose
+    global gv_stream_albumart_file
+
+    if not gv_stream_albumart_file:
+        return None
+
+    albumart_url = 'http://%s:%d/albumart/%s' % (
+            gv_server_ip,
+            gv_media_port,
+            urllib.parse.quote(gv_stream_albumart_file))
+
+    return albumart_url
+
+
+def mpd_song_to_cast_media(mpd_song):
+    # Resolve the cast URL and play_media() arguments
+    # for an MPD song record
+    mpd_file = mpd_song['file']
+    cast_url, cast_mime_type, stream_type = mpd_file_to_url(mpd_file)
+
+    artist = ''
+    album = ''
+    title = ''
+    if 'artist' in mpd_song:
+        artist = mpd_song['artist']
+        # Take first artist if is a list
+        if type(artist) == list:
+            artist = artist[0]
+    if 'album' in mpd_song:
+        album = mpd_song['album']
+    if 'title' in mpd_song:
+        title = mpd_song['title']
+
+    args = {}
+    args['content_type'] = cast_mime_type
+    args['title'] = title
+    args['autoplay'] = True
+
+    # metadata MusicTrackMediaMetadata (3)
+    # Lets us push Artist and Album name
+    args['metadata'] = {}
+    args['metadata']['metadataType'] = 3 
+    args['metadata']['artist'] = artist
+    args['metadata']['albumName'] = album
+
+    albumart_url = get_albumart_url(mpd_file)
+    if albumart_url:
+        args['thumb'] = albumart_url
+
+    return (cast_url, stream_type, args)
+
+
+def library_db():
+    global gv_library_db_file
+    global gv_library_local
+
+    # Library database connection 
+    # for the calling thread
+    db = getattr(gv_library_local, 'db', None)
+    if not db:
+        db = sqlite3.connect(gv_library_db_file, timeout = 10)
+        db.row_factory = sqlite3.Row
+        gv_library_local.db = db
+
+    return db
+
+
+def library_init():
+    global gv_library_schema_version
+
+    # Create the library schema
+    # WAL lets the cast path read while a sync writes
+    db = library_db()
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute(
+            'CREATE TABLE IF NOT EXISTS meta ('
+            'key TEXT PRIMARY KEY, '
+            'value TEXT)')
+
+    # The tracks table is only an index of MPD's
+    # database so an older layout is dropped and 
+    # resynced rather than migrated
+    row = db.execute(
+            'SELECT value FROM meta WHERE key = ?',
+            ('schema',)).fetchone()
+    if (not row or 
+            row['value'] != gv_library_schema_version):
+        db.execute('DROP TABLE IF EXISTS tracks')
+        db.execute('DROP TABLE IF EXISTS dirs')
+        db.execute(
+                'DELETE FROM meta WHERE key = ?',
+                ('db_update',))
+        db.execute(
+                'INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                ('schema', gv_library_schema_version))
+
+    db.execute(
+            'CREATE TABLE IF NOT EXISTS tracks ('
+            'path TEXT PRIMARY KEY, '
+            'last_modified TEXT, '
+            'format TEXT, '
+            'samplerate INTEGER, '
+            'bits INTEGER, '
+            'channels INTEGER, '
+            'art TEXT)')
+    db.execute(
+            'CREATE TABLE IF NOT EXISTS dirs ('
+            'path TEXT PRIMARY KEY, '
+            'mtime INTEGER, '
+            'art TEXT)')
+    db.execute(
+            'CREATE TABLE IF NOT EXISTS media_info ('
+            'path TEXT PRIMARY KEY, '
+            'mtime INTEGER, '
+            'mime TEXT, '
+            'container TEXT, '
+            'codec TEXT, '
+            'samplerate INTEGER, '
+            'bits INTEGER, '
+            'channels INTEGER)')
+    db.commit()
+
+    return
+
+
+def library_lookup(mpd_file):
+    global gv_library_stats_dict
+
+    # Library entry for an MPD file as a dict
+    # or None if not indexed
+    try:
+        row = library_db().execute(
+                'SELECT * FROM tracks WHERE path = ?',
+                (mpd_file,)).fetchone()
+    except sqlite3.Error as error:
+        log_message(
+                1,
+                'Library lookup failed for %s (%s)' % (
+                    mpd_file,
+                    error))
+        row = None
+
+    gv_library_stats_dict['lookups'] += 1
+    if not row:
+        gv_library_stats_dict['misses'] += 1
+        return None
+
+    return dict(row)
+
+
+def mpd_format_to_fields(audio_format):
+    # Split an MPD audio format of 
+    # samplerate:bits:channels
+    # Bits may be 'f' (32-bit float) and DSD formats 
+    # are given as dsd64 etc, leaving samplerate unknown
+    samplerate = None
+    bits = None
+    channels = None
+
+    fields = audio_format.split(':')
+    if len(fields) == 3:
+        if fields[0].isdigit():
+            samplerate = int(fields[0])
+        if fields[1].isdigit():
+            bits = int(fields[1])
+        elif fields[1] == 'f':
+            bits = 32
+        if fields[2].isdigit():
+            channels = int(fields[2])
+
+    return (samplerate, bits, channels)
+
+
+def library_sync():
+    global gv_albumart_names
+    global gv_library_stats_dict
+    global gv_library_sync_batch
+
+    # Bring the library index in step with the 
+    # MPD database
+    mpd_client = mpd.MPDClient()
+    mpd_client.connect('localhost', 6600)
+
+    try:
+        db = library_db()
+        db_update = mpd_client.stats().get('db_update')
+        row = db.execute(
+                'SELECT value FROM meta WHERE key = ?',
+                ('db_update',)).fetchone()
+        if (row and 
+                row['value'] == db_update):
+            log_message(
+                    gv_verbose,
+                    'Library index up to date')
+            return
+
+        start_time = time.monotonic()
+        log_message(
+                1,
+                'Syncing library index with MPD database...')
+
+        indexed_dict = {}
+        for row in db.execute('SELECT path, last_modified, art FROM tracks'):
+            indexed_dict[row['path']] = (row['last_modified'], row['art'])
+
+        # Directory mtimes from the last sync so only
+        # changed directories are listed again
+        dir_dict = {}
+        for row in db.execute('SELECT path, mtime, art FROM dirs'):
+            dir_dict[row['path']] = (row['mtime'], row['art'])
+        dir_art_dict = {}
+        rescanned_dirs = set()
+
+        # Stream the listing rather than building
+        # the whole list for large libraries
+        # Commits go in batches and the MPD db_update 
+        # is only recorded at the end so an interrupted
+        # sync picks up where it left off
+        updated = 0
+        writes = 0
+        mpd_client.iterate = True
+        for item in mpd_client.listallinfo():
+            if 'file' not in item:
+                continue
+
+            mpd_file = item['file']
+            last_modified = item.get('last-modified')
+            rel_dir = os.path.dirname(mpd_file)
+            indexed = indexed_dict.pop(mpd_file, None)
+            track_changed = not (indexed and 
+                    indexed[0] == last_modified)
+
+            # The art source for a directory is its cover
+            # file, else its first track if that has 
+            # embedded art, so all its tracks share one
+            # art URL. Cover files come and go without 
+            # touching the tracks so each directory is
+            # checked once per sync and listed again only
+            # when its mtime has changed. This goes direct
+            # rather than through the cast path index
+            # which a sync would otherwise flush
+            rescan = False
+            if rel_dir not in dir_art_dict:
+                dir_entry = dir_dict.pop(rel_dir, None)
+                dir_mtime = albumart_dir_mtime(rel_dir)
+                if (dir_entry and 
+                        dir_entry[0] == dir_mtime):
+                    dir_art_dict[rel_dir] = dir_entry[1]
+                else:
+                    rescan = True
+
+            # Embedded art can be added to or removed
+            # from a track without its directory changing
+            if (not rescan and 
+                    track_changed and 
+                    rel_dir not in rescanned_dirs and 
+                    dir_art_dict.get(rel_dir) not in gv_albumart_names):
+                dir_mtime = albumart_dir_mtime(rel_dir)
+                rescan = True
+
+            if rescan:
+                art_name = albumart_dir_scan(rel_dir, dir_mtime, embedded = True)
+                db.execute(
+                        'INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)',
+                        (rel_dir, dir_mtime, art_name))
+                writes += 1
+                dir_art_dict[rel_dir] = art_name
+                rescanned_dirs.add(rel_dir)
+
+            art_name = dir_art_dict[rel_dir]
+            rel_art = os.path.join(rel_dir, art_name) if art_name else None
+
+            if not track_changed:
+                if indexed[1] != rel_art:
+                    db.execute(
+                            'UPDATE tracks SET art = ? WHERE path = ?',
+                            (rel_art, mpd_file))
+                    writes += 1
+                    if writes % gv_library_sync_batch == 0:
+                        db.commit()
+                continue
+
+            samplerate, bits, channels = mpd_format_to_fields(
+                    item.get('format', ''))
+
+            db.execute(
+                    'INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (
+                        mpd_file,
+                        last_modified,
+                        item.get('format'),
+                        samplerate,
+                        bits,
+                        channels,
+                        rel_art,
+                        ))
+            updated += 1
+            writes += 1
+            if writes % gv_library_sync_batch == 0:
+                db.commit()
+
+        # Anything left is gone from MPD
+        for mpd_file in indexed_dict:
+            db.execute(
+                    'DELETE FROM tracks WHERE path = ?',
+                    (mpd_file,))
+            writes += 1
+            if writes % gv_library_sync_batch == 0:
+                db.commit()
+
+        for rel_dir in dir_dict:
+            db.execute(
+                    'DELETE FROM dirs WHERE path = ?',
+                    (rel_dir,))
+
+        db.execute(
+                'INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                ('db_update', db_update))
+        db.commit()
+
+        gv_library_stats_dict['syncs'] += 1
+        gv_library_stats_dict['lastSyncSecs'] = round(
+                time.monotonic() - start_time, 3)
+        gv_library_stats_dict['lastSyncUpdated'] = updated
+        gv_library_stats_dict['lastSyncRemoved'] = len(indexed_dict)
+        log_message(
+                1,
+                'Library index synced in %.3f secs (%d updated, %d removed)' % (
+                    gv_library_stats_dict['lastSyncSecs'],
+                    updated,
+                    len(indexed_dict)))
+    finally:
+        library_db().rollback()
+        mpd_client.iterate = False
+        mpd_client.disconnect()
+
+    return
+
+
+def sniff_mp4_sample_entry(data, media_info):
+    # Codec and stream parameters from the first 
+    # audio sample entry found in MP4 data
+    for fourcc, codec in [
+            (b'mp4a', 'aac'), 
+            (b'alac', 'alac'), 
+            (b'fLaC', 'flac'), 
+            (b'Opus', 'opus'), 
+            (b'ac-3', 'ac3'), 
+            (b'ec-3', 'eac3')]:
+        index = data.find(fourcc)
+        if (index < 4 or 
+                len(data) < index + 32):
+            continue
+        # Sample entry fields following the fourcc
+        # reserved(6) data ref(2) version(2) revision(2)
+        # vendor(4) channels(2) bits(2) compression(2)
+        # packet size(2) sample rate(16.16)
+        media_info['codec'] = codec
+        entry = data[index + 4:index + 32]
+        channels, bits = struct.unpack('>HH', entry[16:20])
+        samplerate = struct.unpack('>I', entry[24:28])[0] >> 16
+        media_info['channels'] = channels
+        media_info['bits'] = bits
+        media_info['samplerate'] = samplerate
+        return True
+
+    return False
+
+
+def sniff_media_file(file_path):
+    global gv_sniff_bytes
+
+    # Identify the container and codec of an audio 
+    # file from its content with the sample rate, 
+    # bits and channels where the header gives them.
+    # Unknown values are left as None
+    media_info = {}
+    media_info['mime'] = None
+    media_info['container'] = None
+    media_info['codec'] = None
+    media_info['samplerate'] = None
+    media_info['bits'] = None
+    media_info['channels'] = None
+
+    try:
+        with open(file_path, 'rb') as media_file:
+            data = media_file.read(gv_sniff_bytes)
+
+            # Skip any ID3v2 tag (MP3, AAC and some FLAC)
+            # which may be larger than the initial read
+            if (data[:3] == b'ID3' and 
+                    len(data) >= 10):
+                tag_size = (((data[6] & 0x7f) << 21) | 
+                        ((data[7] & 0x7f) << 14) | 
+                        ((data[8] & 0x7f) << 7) | 
+                        (data[9] & 0x7f)) + 10
+                if data[5] & 0x10:
+                    # footer present
+                    tag_size += 10
+                media_file.seek(tag_size)
+                data = media_file.read(gv_sniff_bytes)
+
+            # MP4 metadata (moov) may be at the end
+            tail = b''
+            if data[4:8] == b'ftyp':
+                media_file.seek(0, os.SEEK_END)
+                size = media_file.tell()
+                media_file.seek(max(0, size - gv_sniff_bytes))
+                tail = media_file.read(gv_sniff_bytes)
+    except OSError:
+        return media_info
+
+    if data[:4] == b'fLaC':
+        media_info['mime'] = 'audio/flac'
+        media_info['container'] = 'flac'
+        media_info['codec'] = 'flac'
+        # STREAMINFO is always the first metadata block
+        if len(data) >= 26:
+            value = int.from_bytes(data[18:26], 'big')
+            media_info['samplerate'] = value >> 44
+            media_info['channels'] = ((value >> 41) & 0x07) + 1
+            media_info['bits'] = ((value >> 36) & 0x1f) + 1
+
+    elif (len(data) >= 4 and 
+            data[0] == 0xff and 
+            (data[1] & 0xf6) == 0xf0):
+        # ADTS AAC
+        samplerates = [96000, 88200, 64000, 48000, 44100, 32000, 
+                24000, 22050, 16000, 12000, 11025, 8000, 7350]
+        media_info['mime'] = 'audio/aac'
+        media_info['container'] = 'adts'
+        media_info['codec'] = 'aac'
+        samplerate_index = (data[2] >> 2) & 0x0f
+        if samplerate_index < len(samplerates):
+            media_info['samplerate'] = samplerates[samplerate_index]
+        media_info['channels'] = ((data[2] & 0x01) << 2) | (data[3] >> 6)
+
+    elif (len(data) >= 4 and 
+            data[0] == 0xff and 
+            (data[1] & 0xe0) == 0xe0 and 
+            (data[1] >> 1) & 0x03 != 0):
+        # MPEG audio frame
+        samplerates = {
+                3: [44100, 48000, 32000], # MPEG 1
+                2: [22050, 24000, 16000], # MPEG 2
+                0: [11025, 12000, 8000],  # MPEG 2.5
+                }
+        version = (data[1] >> 3) & 0x03
+        layer = (data[1] >> 1) & 0x03
+        samplerate_index = (data[2] >> 2) & 0x03
+        media_info['mime'] = 'audio/mpeg'
+        media_info['container'] = 'mpeg'
+        media_info['codec'] = 'mp3' if layer == 1 else 'mp%d' % (4 - layer)
+        if (version in samplerates and 
+                samplerate_index < 3):
+            media_info['samplerate'] = samplerates[version][samplerate_index]
+        media_info['channels'] = 1 if (data[3] >> 6) == 3 else 2
+
+    elif data[:4] == b'OggS':
+        media_info['mime'] = 'audio/ogg'
+        media_info['container'] = 'ogg'
+        # first packet follows the page segment table
+        if len(data) >= 27:
+            packet = data[27 + data[26]:]
+            if packet[:8] == b'OpusHead' and len(packet) >= 10:
+                media_info['codec'] = 'opus'
+                media_info['channels'] = packet[9]
+                media_info['samplerate'] = 48000
+            elif packet[:7] == b'\x01vorbis' and len(packet) >= 16:
+                media_info['codec'] = 'vorbis'
+                media_info['channels'] = packet[11]
+                media_info['samplerate'] = struct.unpack('<I', packet[12:16])[0]
+            elif packet[:5] == b'\x7fFLAC':
+                media_info['codec'] = 'flac'
+
+    elif (data[:4] == b'RIFF' and 
+            data[8:12] == b'WAVE'):
+        media_info['mime'] = 'audio/wav'
+        media_info['container'] = 'wav'
+        offset = 12
+        while offset + 8 <= len(data):
+            chunk_id = data[offset:offset + 4]
+            chunk_size = struct.unpack('<I', data[offset + 4:offset + 8])[0]
+            if (chunk_id == b'fmt ' and 
+                    offset + 24 <= len(data)):
+                format_tag, channels, samplerate = struct.unpack(
+                        '<HHI', data[offset + 8:offset + 16])
+                bits = struct.unpack('<H', data[offset + 22:offset + 24])[0]
+                # PCM, IEEE float and extensible
+                media_info['codec'] = 'pcm' if format_tag in [1, 3, 0xfffe] else 'wav-%d' % (format_tag)
+                media_info['channels'] = channels
+                media_info['samplerate'] = samplerate
+                media_info['bits'] = bits
+                break
+            offset += 8 + chunk_size + (chunk_size & 1)
+
+    elif data[4:8] == b'ftyp':
+        media_info['mime'] = 'audio/mp4'
+        media_info['container'] = 'mp4'
+        if not sniff_mp4_sample_entry(data, media_info):
+            sniff_mp4_sample_entry(tail, media_info)
+
+    elif (data[:4] == b'FORM' and 
+            data[8:12] in [b'AIFF', b'AIFC']):
+        media_info['mime'] = 'audio/aiff'
+        media_info['container'] = 'aiff'
+        media_info['codec'] = 'pcm'
+        index = data.find(b'COMM')
+        if index > 0 and len(data) >= index + 26:
+            channels, frames, bits = struct.unpack('>HIH', data[index + 8:index + 16])
+            # 80-bit extended float sample rate
+            exponent = int.from_bytes(data[index + 16:index + 18], 'big') & 0x7fff
+            mantissa = int.from_bytes(data[index + 18:index + 26], 'big')
+            media_info['channels'] = channels
+            media_info['bits'] = bits
+            media_info['samplerate'] = int(mantissa * 2.0 ** (exponent - 16383 - 63))
+
+    elif data[:4] == b'DSD ':
+        media_info['mime'] = 'audio/x-dsf'
+        media_info['container'] = 'dsf'
+        media_info['codec'] = 'dsd'
+        if len(data) >= 64:
+            channels, samplerate, bits = struct.unpack('<III', data[52:64])
+            media_info['channels'] = channels
+            media_info['samplerate'] = samplerate
+            media_info['bits'] = bits
+
+    elif (data[:4] == b'FRM8' and 
+            data[12:16] == b'DSD '):
+        media_info['mime'] = 'audio/x-dff'
+        media_info['container'] = 'dff'
+        media_info['codec'] = 'dsd'
+
+    elif data[:4] == b'MAC ':
+        media_info['mime'] = 'audio/x-ape'
+        media_info['container'] = 'ape'
+        media_info['codec'] = 'ape'
+
+    elif data[:4] == b'wvpk':
+        media_info['mime'] = 'audio/x-wavpack'
+        media_info['container'] = 'wavpack'
+        media_info['codec'] = 'wavpack'
+
+    return media_info
+
+
+def media_file_info(mpd_file):
+    global gv_mpd_music_dir
+    global gv_media_info_cache
+    global gv_media_info_cache_max_entries
+    global gv_media_info_pending_dict
+    global gv_media_info_lock
+    global gv_media_info_stats_dict
+
+    # Format of an MPD file, sniffed from its 
+    # content and cached by path and mtime. Gaps are
+    # filled from the library index and the MIME 
+    # type falls back on the file extension
+    file_path = os.path.join(gv_mpd_music_dir, mpd_file)
+    try:
+        mtime = os.stat(file_path).st_mtime_ns
+    except OSError:
+        mtime = None
+
+    with gv_media_info_lock:
+        media_info = gv_media_info_cache.get(mpd_file)
+        if (media_info and 
+                mtime is not None and 
+                media_info['mtime'] == mtime):
+            gv_media_info_cache.move_to_end(mpd_file)
+            gv_media_info_stats_dict['cached'] += 1
+            return media_info
+
+    # Reads don't wait on a sync with WAL
+    try:
+        row = library_db().execute(
+                'SELECT * FROM media_info WHERE path = ?',
+                (mpd_file,)).fetchone()
+    except sqlite3.Error:
+        row = None
+
+    if (row and 
+            mtime is not None and 
+            row['mtime'] == mtime):
+        media_info = dict(row)
+        with gv_media_info_lock:
+            gv_media_info_stats_dict['cached'] += 1
+    else:
+        media_info = sniff_media_file(file_path)
+        with gv_media_info_lock:
+            gv_media_info_stats_dict['sniffed'] += 1
+
+        track_dict = library_lookup(mpd_file)
+        if track_dict:
+            for field in ['samplerate', 'bits', 'channels']:
+                if media_info[field] is None:
+                    media_info[field] = track_dict[field]
+        if not media_info['mime']:
+            media_info['mime'] = media_mime_type(mpd_file)
+
+        media_info['path'] = mpd_file
+        media_info['mtime'] = mtime
+
+        # Left for the Library Agent to write
+        if mtime is not None:
+            with gv_media_info_lock:
+                gv_media_info_pending_dict[mpd_file] = media_info
+
+    with gv_media_info_lock:
+        gv_media_info_cache[mpd_file] = media_info
+        gv_media_info_cache.move_to_end(mpd_file)
+        while len(gv_media_info_cache) > gv_media_info_cache_max_entries:
+            gv_media_info_cache.popitem(last = False)
+
+    return media_info
+
+
+def media_info_flush():
+    global gv_media_info_pending_dict
+    global gv_media_info_lock
+
+    # Write sniffed media info to the library
+    # database in one transaction. Called from the
+    # Library Agent. Failed writes are dropped as the
+    # file is just sniffed again next run
+    with gv_media_info_lock:
+        pending_dict = gv_media_info_pending_dict
+        gv_media_info_pending_dict = {}
+
+    if not pending_dict:
+        return
+
+    try:
+        db = library_db()
+        db.executemany(
+                'INSERT OR REPLACE INTO media_info VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [
+                    (
+                        media_info['path'],
+                        media_info['mtime'],
+                        media_info['mime'],
+                        media_info['container'],
+                        media_info['codec'],
+                        media_info['samplerate'],
+                        media_info['bits'],
+                        media_info['channels'],
+                        ) 
+                    for media_info in pending_dict.values()
+                    ])
+        db.commit()
+    except sqlite3.Error as error:
+        library_db().rollback()
+        log_message(
+                1,
+                'Failed to cache media info for %d files (%s)' % (
+                    len(pending_dict),
+                    error))
+
+    return
+
+
+def cast_device_profile(name):
+    global gv_cast_devices_dict
+    global gv_cast_profile_dict
+    global gv_cast_model_profile_dict
+    global gv_cast_type_profile_dict
+
+    # Capability profile for a cast device
+    # by model name, then cast type
+    profile_name = 'video'
+    cast_info = gv_cast_devices_dict.get(name)
+    if cast_info:
+        if cast_info.model_name in gv_cast_model_profile_dict:
+            profile_name = gv_cast_model_profile_dict[cast_info.model_name]
+        elif cast_info.cast_type in gv_cast_type_profile_dict:
+            profile_name = gv_cast_type_profile_dict[cast_info.cast_type]
+
+    return gv_cast_profile_dict[profile_name]
+
+
+def cast_media_incompatible(name, mpd_file):
+    # Reason an MPD file can't be played on 
+    # a cast device or None if it should play
+    # Values that could not be sniffed are not held 
+    # against the file
+    profile = cast_device_profile(name)
+    media_info = media_file_info(mpd_file)
+
+    if (media_info['container'] and 
+            media_info['container'] not in profile['containers']):
+        return 'unsupported container %s' % (media_info['container'])
+    if (media_info['codec'] and 
+            media_info['codec'] not in profile['codecs']):
+        return 'unsupported codec %s' % (media_info['codec'])
+    if (media_info['samplerate'] and 
+            media_info['samplerate'] > profile['maxSamplerate']):
+        return 'sample rate %d above %d' % (
+                media_info['samplerate'],
+                profile['maxSamplerate'])
+    if (media_info['bits'] and 
+            media_info['bits'] > profile['maxBits']):
+        return '%d-bit above %d-bit' % (
+                media_info['bits'],
+                profile['maxBits'])
+    if (media_info['channels'] and 
+            media_info['channels'] > profile['maxChannels']):
+        return '%d channels above %d' % (
+                media_info['channels'],
+                profile['maxChannels'])
+
+    return None
+
+
+def library_stats():
+    global gv_library_stats_dict
+
+    library_stats_dict = dict(gv_library_stats_dict)
+    try:
+        library_stats_dict['tracks'] = library_db().execute(
+                'SELECT COUNT(*) FROM tracks').fetchone()[0]
+    except sqlite3.Error:
+        library_stats_dict['tracks'] = None
+
+    return library_stats_dict
+
+
+def library_agent():
+    global gv_library_update_event
+    global gv_library_retry_secs
+    global gv_media_info_flush_secs
+
+    # Sync the library index at startup and
+    # whenever the MPD idle agent sees a database 
+    # change. Failed syncs are retried
+    # Sniffed media info is written in between
+    gv_library_update_event.set()
+    while (True):
+        sync_due = gv_library_update_event.wait(gv_media_info_flush_secs)
+        media_info_flush()
+        if not sync_due:
+            continue
+
+        gv_library_update_event.clear()
+        try:
+            library_sync()
+        except (mpd.MPDError, OSError, sqlite3.Error) as error:
+            log_message(
+                    1,
+                    'Library sync failed (%s).. retrying in %d secs' % (
+                        error,
+                        gv_library_retry_secs))
+            gv_library_update_event.wait(gv_library_retry_secs)
+            gv_library_update_event.set()
+
 
-    art_names = [
-            'cover.png',
-            'cover.jpg',
-            'cover.tiff',
-            'cover.bmp',
-            'cover.gif',
-            ]
+def mpd_idle_agent():
+    global gv_agent_wake_event
+    global gv_mpd_idle_subsystems
+    global gv_library_update_event
 
-    albumart_url = None
+    # Dedicated MPD connection that sits in idle mode
+    # and signals the MPD agents when anything of
+    # interest changes
+    mpd_client = None
 
-    mpd_rel_path = pathlib.Path(mpd_file)
-    mpd_full_path = pathlib.Path(gv_mpd_music_dir + '/' + mpd_file)
+    while (True):
+        if not mpd_client:
+            log_message(
+                    1,
+                    'Connecting to MPD (idle)...')
+            try:
+                mpd_client = mpd.MPDClient()
+                mpd_client.connect('localhost', 6600)
+            except:
+                log_message(
+                        1,
+                        'Problem getting mpd idle client')
+                mpd_client = None
+                time.sleep(5)
+                continue
 
-    for name in art_names:
-        cover_file = str(mpd_full_path.parent / name)
-        cover_rel_file = str(mpd_rel_path.parent / name)
-        if os.path.exists(cover_file):
-            albumart_url = 'http://%s:%d/music/%s' % (
-                    gv_server_ip,
-                    gv_cast_port,
-                    urllib.parse.quote(cover_rel_file))
-            break
+        changes = None
+        try:
+            # Blocks until one or more subsystems change
+            changes = mpd_client.idle(*gv_mpd_idle_subsystems)
+            log_message(
+                    gv_verbose,
+                    'MPD idle event: %s' % (
+                        changes))
+        except:
+            log_message(
+                    1,
+                    'Problem waiting on mpd idle')
+            mpd_client = None
+            time.sleep(1)
 
-    return albumart_url
+        # wake agents
+        # also done on failure so they can pick up
+        # the state directly
+        gv_agent_wake_event.set()
 
+        # MPD database updated
+        if (changes and 
+                'database' in changes):
+            gv_library_update_event.set()
 
-def get_mpd_stream_albumart_url():
-    global gv_server_ip
-    global gv_cast_port
-    global gv_verbose
-    global gv_stream_albumart_file
 
-    if not gv_stream_albumart_file:
-        return None
+def mpd_agent_heartbeat():
+    global gv_mpd_agent_timestamp
 
-    albumart_url = 'http://%s:%d/albumart/%s' % (
-            gv_server_ip,
-            gv_cast_port,
-            urllib.parse.quote(gv_stream_albumart_file))
+    # Timestamp loop activity for MPD agent
+    # acts as a deadlock detection in the supervisor
+    gv_mpd_agent_timestamp = time.monotonic()
 
-    return albumart_url
+    return
 
 
-def mpd_file_agent():
+def mpd_file_agent(generation):
     global gv_server_ip
     global gv_verbose
-    global gv_mpd_agent_timestamp
+    global gv_mpd_agent_generation
     global gv_cfg_dict
+    global gv_cast_launch_history
+    global gv_media_info_stats_dict
+    global gv_egress_stall_secs
 
-    now = int(time.time())
+    now = time.monotonic()
+    scheduler = loop_scheduler('MPD File Agent')
 
     # MPD inits
     mpd_client = None
@@ -638,33 +4828,65 @@ def mpd_file_agent():
     cast_id = -1
     cast_volume = 0
     cast_confirmed = False
-    cast_failed_update_count = 0
-    max_cast_failed_updates = 20
+    cast_listener = None
+    cast_next_id = -1
+    cast_queued_id = -1
+    cast_sync_timestamp = 0
+    cast_launch_timer = None
+    cast_launch_deadline = None
+    leader_connector = None
+    max_cast_disconnected_secs = 20
+    session_start_id = -1
+    session_start_at = None
+    cast_hold_id = -1
+    cast_buffering_timestamp = 0
+    cast_media_id = -1
+    cast_media = (None, None)
 
     loop_count = -1
     
     while (True):
         loop_count += 1
 
+        if generation != gv_mpd_agent_generation:
+            # replaced by the supervisor
+            # the new agent owns the cast device now
+            log_message(1, 'Exiting stale MPD File agent')
+            if leader_connector:
+                leader_connector.abandon()
+            return
+
         if gv_cfg_dict['castMode'] != 'direct':
             log_message(1, 'Exiting MPD File agent (config change)')
+            if cast_device:
+                release_cast_device(cast_device)
+            if leader_connector:
+                leader_connector.abandon()
             return
 
-        # 1 sec delay per iteration
-        time.sleep(1)
+        # Wait on MPD events with a short fallback
+        # tick interval while casting or reconnecting
+        if (cast_device or 
+                leader_connector or 
+                not mpd_client):
+            scheduler.wait(gv_mpd_active_interval, gv_agent_wake_event)
+        else:
+            scheduler.wait(gv_mpd_passive_interval, gv_agent_wake_event)
 
         print() # log output separator
-        now = int(time.time())
+        now = time.monotonic()
 
-        # Timestamp loop activity for MPD agent
-        # acts as a deadlock detection in main loop
-        gv_mpd_agent_timestamp = now
+        mpd_agent_heartbeat()
 
         # MPD healthcheck
         if now - mpd_last_status > 60:
             log_message(
                     1,
                     'No MPD contact in 60 seconds... exiting')
+            if cast_device:
+                release_cast_device(cast_device)
+            if leader_connector:
+                leader_connector.abandon()
             return
 
         if not mpd_client:
@@ -727,6 +4949,13 @@ def mpd_file_agent():
             mpd_file = mpd_client_song['file']
             mpd_id = mpd_client_song['id']
 
+        # Next track in the playlist (if any)
+        # used for gapless queueing
+        if 'nextsongid' in mpd_client_status:
+            mpd_next_id = mpd_client_status['nextsongid']
+        else:
+            mpd_next_id = -1
+
         # mandatory fields
         mpd_status = mpd_client_status['state']
 
@@ -738,10 +4967,12 @@ def mpd_file_agent():
 
         # optionals (will depend on given state and stream vs file
         mpd_elapsed = 0
+        mpd_position = 0.0
         mpd_duration = 0
 
         if 'elapsed' in mpd_client_status:
-            mpd_elapsed = int(float(mpd_client_status['elapsed']))
+            mpd_position = float(mpd_client_status['elapsed'])
+            mpd_elapsed = int(mpd_position)
         if 'duration' in mpd_client_status:
             mpd_duration = int(float(mpd_client_status['duration']))
 
@@ -789,42 +5020,35 @@ def mpd_file_agent():
         # Cast Device Status
         if (cast_device):
 
-            # We need an updated status from the Cast Device
-            # This can fail sometimes when nothing is really wrong and 
-            # then other times when things are wrong :)
-            #
-            # So we give it a tolerance of 20 consecutive failures
-            try:
-                cast_device.media_controller.update_status()
-                # Reset failed status count
-                cast_failed_update_count = 0
-            except:
-                cast_failed_update_count += 1
+            # Cast device status is pushed to the listener 
+            # so no round-trip is needed here. pychromecast
+            # will reconnect on a lost connection but we give
+            # it a tolerance of 20 seconds to recover
+            if (cast_listener.disconnected_secs() >= max_cast_disconnected_secs):
                 log_message(
                         1,
-                        'Failed to get cast device status... %d/%d' % (
-                            cast_failed_update_count,
-                            max_cast_failed_updates))
-
-                if (cast_failed_update_count >= max_cast_failed_updates):
-                    log_message(
-                            1,
-                            'Detected broken controller after %d status failures' % (
-                                max_cast_failed_updates))
-                    cast_device = None
-                    cast_status = 'none'
-                    cast_id = -1
-                    cast_volume = 0
-                    cast_failed_update_count = 0
-                    continue
+                        'Detected broken controller after %d secs (%s)' % (
+                            max_cast_disconnected_secs,
+                            cast_listener.connection_status))
+                discard_cast_device(cast_device)
+                cast_device = None
+                cast_listener = None
+                cast_status = 'none'
+                cast_id = -1
+                cast_volume = 0
+                cast_launch_timer = None
+                cast_launch_deadline = None
+                continue
 
             # Elapsed time as reported by the cast device
-            cast_elapsed = int(cast_device.media_controller.status.current_time)
+            # extrapolated to now
+            cast_position = cast_listener.elapsed()
+            cast_elapsed = int(cast_position)
             # Cast player state as reported by the device
-            cast_player_state = cast_device.media_controller.status.player_state
+            cast_player_state = cast_listener.player_state
             # Length and progress calculation
-            if cast_device.media_controller.status.duration is not None:
-                cast_duration = int(cast_device.media_controller.status.duration)
+            if cast_listener.duration:
+                cast_duration = int(cast_listener.duration)
                 cast_progress = int(cast_elapsed / cast_duration * 100)
             else:
                 cast_duration = 0
@@ -851,7 +5075,7 @@ def mpd_file_agent():
 
         # Configured Cast Device change
         # Clear existing device handle
-        if (cast_name != gv_cfg_dict['castDevice']):
+        if (cast_name != cast_target_names()[0]):
             # Stop media player of existing device
             # if it exists
             if (cast_device):
@@ -859,19 +5083,31 @@ def mpd_file_agent():
                         1,
                         'Detected Cast Device change from %s -> %s' % (
                             cast_name,
-                            gv_cfg_dict['castDevice']))
+                            cast_target_names()[0]))
                 cast_device.media_controller.stop()
                 cast_device.quit_app()
                 cast_status = mpd_status
+                release_cast_device(cast_device)
                 cast_device = None
+                cast_listener = None
                 cast_volume = 0
                 continue
 
         # Cast Device URL for media
         # derived into a file URL (streaming)
+        # Resolved once per track (MPD song id) as it 
+        # looks up the media details and albumart
         if mpd_file:
-            cast_url, cast_mime_type, stream_type = mpd_file_to_url(mpd_file)
+            if (cast_media_id != mpd_id or 
+                    cast_media[0] != mpd_file):
+                cast_media = (
+                        mpd_file, 
+                        mpd_song_to_cast_media(mpd_client_song))
+                cast_media_id = mpd_id
+            cast_url, stream_type, cast_args = cast_media[1]
         else:
+            cast_sessions_update({'state': 'stop'})
+
             # no file to stream -> stop casting 
             if (cast_device):
                 log_message(
@@ -880,40 +5116,88 @@ def mpd_file_agent():
                 cast_device.media_controller.stop()
                 cast_device.quit_app()
                 cast_status = mpd_status
+                release_cast_device(cast_device)
                 cast_device = None
+                cast_listener = None
                 cast_volume = 0
 
             continue
 
+        # Multi-room followers
+        # Target state is what MPD wants, held at play 
+        # while the initial cast has MPD paused. Position 
+        # is the leader's, once it is confirmed playing 
+        # this track
+        session_target = {}
+        session_target['state'] = mpd_status
+        if (stream_type == 'file' and 
+                cast_device and 
+                not cast_confirmed and 
+                cast_status == 'play'):
+            session_target['state'] = 'play'
+        session_target['url'] = cast_url
+        session_target['args'] = cast_args
+        session_target['file'] = mpd_file
+        session_target['mediaId'] = mpd_id
+        session_target['resumeRecast'] = stream_type != 'file'
+        session_target['volume'] = mpd_volume
+        session_target['position'] = None
+        session_target['startAt'] = None
+        if stream_type == 'file':
+            if cast_device:
+                if (cast_confirmed and 
+                        cast_listener.content_id == cast_url and 
+                        cast_listener.player_state == 'PLAYING'):
+                    session_target['position'] = cast_listener.elapsed()
+            elif mpd_status == 'play':
+                session_target['position'] = mpd_position
+
+        # Coordinated start
+        # A new track that the leader is about to cast
+        # gets one start time for all devices
+        if mpd_id != session_start_id:
+            session_start_id = mpd_id
+            session_start_at = None
+            if (mpd_status == 'play' and 
+                    session_target['position'] is None and 
+                    (not cast_device or 
+                        cast_status != 'play' or 
+                        mpd_id != cast_queued_id)):
+                session_start_at = cast_start_time(cast_target_names())
+        session_target['startAt'] = session_start_at
+        session_target['timestamp'] = time.monotonic()
+        cast_sessions_update(session_target)
+
         # Get cast device when in play state and 
         # no device curently present
+        # This is the start of the cast launch. The 
+        # connection is made in the background and 
+        # picked up here on a later loop so followers 
+        # keep getting targets while the leader is slow
         if (mpd_status == 'play' and 
-                not cast_device):
-            cast_device = get_cast_device(gv_cfg_dict['castDevice'])
-            cast_name = gv_cfg_dict['castDevice']
+                not cast_device and 
+                not leader_connector):
+            leader_connector = cast_connector(
+                    cast_target_names()[0],
+                    quit_app = True)
+
+        if (leader_connector and 
+                leader_connector.done()):
+            cast_device, cast_listener = leader_connector.result
+            cast_name = leader_connector.name
+            cast_launch_timer = leader_connector.timer
+            cast_launch_deadline = None
+            leader_connector = None
 
             # nothing to do if this fails
             if not cast_device:
+                cast_launch_timer = None
                 continue
 
-            # Kill off any current app
-            if not cast_device.is_idle:
-                log_message(
-                        1,
-                        'Killing current running cast app')
-                cast_device.quit_app()
-
-            while not cast_device.is_idle:
-                log_message(
-                        1,
-                        'Waiting for cast device to get ready...')
-                time.sleep(1)
-
             # Cast state inits
             cast_status = 'none'
             cast_id = -1
             cast_volume = 0
-            continue
 
 
         # MPD -> Cast Device Events
@@ -925,6 +5209,40 @@ def mpd_file_agent():
         if (not cast_device):
             continue
 
+        # Cast launch stages
+        # Marked as the cast device reports them after
+        # the initial cast and recorded once it's 
+        # confirmed playing (or for radio streams, 
+        # loaded) or the launch times out
+        if cast_launch_deadline:
+            if ('app_launch' not in cast_launch_timer.stages and 
+                    cast_listener.app_id == pychromecast.config.APP_MEDIA_RECEIVER):
+                cast_launch_timer.mark('app_launch')
+            if ('media_load' not in cast_launch_timer.stages and 
+                    cast_listener.content_id == cast_url and 
+                    cast_listener.player_state in ['BUFFERING', 'PLAYING']):
+                cast_launch_timer.mark('media_load')
+
+            if (cast_confirmed or 
+                    (stream_type != 'file' and 
+                        'media_load' in cast_launch_timer.stages) or 
+                    time.monotonic() >= cast_launch_deadline):
+                log_message(
+                        1,
+                        'Cast launch timings %s' % (
+                            cast_launch_timer.summary()))
+
+                launch_dict = {}
+                launch_dict['time'] = int(time.time())
+                launch_dict['device'] = cast_name
+                launch_dict['url'] = cast_url
+                launch_dict['stages'] = cast_launch_timer.stages
+                launch_dict['total'] = cast_launch_timer.total()
+                launch_dict['confirmed'] = cast_confirmed
+                gv_cast_launch_history.append(launch_dict)
+                cast_launch_timer = None
+                cast_launch_deadline = None
+
         # Volume change only while playing
         if (cast_status == 'play' and 
                 mpd_volume != -1 and 
@@ -950,33 +5268,41 @@ def mpd_file_agent():
             cast_device.media_controller.stop()
             cast_device.quit_app()
             cast_status = mpd_status
+            release_cast_device(cast_device)
             cast_device = None
+            cast_listener = None
             cast_volume = 0
             continue  
 
         # Initial Cast protection for file streaming
         # After an initial cast we pause MPD 
         # only unpausing and re-seeking to 
-        # cast_elapsed - 1 when the 
-        # cast device is reporting elapsed time
+        # the sync lag behind the cast device 
+        # when it is reporting elapsed time
         # Does not apply for radio streams
         if (stream_type == 'file' and 
                 not cast_confirmed and 
                 mpd_status == 'pause' and 
                 cast_status == 'play'):
-            if (cast_elapsed == 0):
+            if (cast_listener.content_id != cast_url or 
+                    cast_listener.elapsed() == 0):
                 log_message(
                         1,
                         'Initial cast... Waiting for cast device elapsed time')
             else:
+                if cast_launch_deadline:
+                    cast_launch_timer.mark('first_elapsed')
                 log_message(
                         1,
                         'Initial cast... elapsed time detected.. Unpausing mpd')
-                # sync 1 second behind
-                mpd_client.seekcur(cast_elapsed - 1)
+                # sync behind the cast device
+                mpd_client.seekcur(
+                        max(0, cast_listener.elapsed() - gv_sync_lag_secs))
                 # play (pause 0)
                 mpd_client.pause(0)
                 cast_confirmed = True
+                cast_listener.clock.reset_drift()
+                cast_sync_timestamp = time.monotonic()
             continue
 
         # Pause file stream only
@@ -1008,6 +5334,43 @@ def mpd_file_agent():
             cast_status = mpd_status
             continue
         
+        # Gapless track change
+        # MPD has moved on to the track queued on the 
+        # cast device. A next track that wasn't queued 
+        # (eg not playable) is left for the cast path 
+        # below. The cast device will normally
+        # have got there first as MPD runs behind it. If MPD 
+        # skipped ahead (next pressed), the cast device queue 
+        # is moved on to match
+        if (stream_type == 'file' and 
+                mpd_status == 'play' and 
+                cast_status == 'play' and 
+                cast_confirmed and 
+                mpd_id != cast_id and 
+                mpd_id == cast_queued_id):
+
+            if cast_listener.content_id != cast_url:
+                if (cast_duration > 0 and 
+                        cast_duration - cast_listener.elapsed() <= gv_gapless_window_secs):
+                    log_message(
+                            1,
+                            'Gapless track change.. waiting on Cast Device')
+                    continue
+
+                log_message(
+                        1,
+                        'Skipping Cast Device to queued track')
+                cast_device.media_controller.queue_next()
+            else:
+                log_message(
+                        1,
+                        'Gapless track change on Cast Device')
+
+            cast_id = mpd_id
+            cast_next_id = -1
+            cast_queued_id = -1
+            continue
+
         # Play a song/stream or next in playlist
         # triggered by:
         # 1) different play states between mpd and cast device,
@@ -1019,36 +5382,63 @@ def mpd_file_agent():
                     (mpd_elapsed == 0 and 
                         cast_player_state == 'IDLE'))):
 
+            # Skip tracks the cast device can't play
+            # rather than sending them to fail on it
+            if stream_type == 'file':
+                incompatible_reason = cast_media_incompatible(
+                        cast_name, 
+                        mpd_file)
+                if incompatible_reason:
+                    log_message(
+                            1,
+                            'Skipping track not playable on %s (%s): %s' % (
+                                cast_name,
+                                incompatible_reason,
+                                mpd_file))
+                    gv_media_info_stats_dict['skipped'] += 1
+                    mpd_client.next()
+                    continue
+
+            # Coordinated start with other devices
+            # Hold the cast until this device's load
+            # latency before the start time. The loop
+            # carries on meanwhile and is woken when due
+            if (session_start_at and 
+                    session_start_id == mpd_id):
+                lead_secs = (session_start_at - 
+                        cast_latency(cast_listener.uuid, 'load') - 
+                        time.monotonic())
+                if lead_secs > 0:
+                    if cast_hold_id != mpd_id:
+                        log_message(
+                                1,
+                                'Coordinated start.. holding cast for %.3f secs' % (
+                                    lead_secs))
+                        cast_hold_id = mpd_id
+                        hold_timer = threading.Timer(
+                                lead_secs, 
+                                gv_agent_wake_event.set)
+                        hold_timer.daemon = True
+                        hold_timer.start()
+                    continue
+
             log_message(
                     1,
                     'Casting URL:%s type:%s' % (
                         cast_url,
-                        cast_mime_type))
+                        cast_args['content_type']))
 
-            args = {}
-            args['content_type'] = cast_mime_type
-            args['title'] = title
-            args['autoplay'] = True
-
-            # metadata MusicTrackMediaMetadata (3)
-            # Lets us push Artist and Album name
-            args['metadata'] = {}
-            args['metadata']['metadataType'] = 3 
-            args['metadata']['artist'] = artist
-            args['metadata']['albumName'] = album
-
-            albumart_url = get_albumart_url(mpd_file)
-            if albumart_url:
-                args['thumb'] = albumart_url
+            if 'thumb' in cast_args:
                 log_message(
                         1,
                         'Albumart URL:%s' % (
-                            albumart_url))
+                            cast_args['thumb']))
 
-            # Let the magic happen
-            # Wait for the connection and then issue the 
-            # URL to stream
-            cast_device.wait()
+            # Timing for recasts within a session
+            # starts here
+            if (not cast_launch_timer or 
+                    cast_launch_deadline):
+                cast_launch_timer = stage_timer()
 
             if (mpd_volume != -1 and 
                     cast_volume != mpd_volume):
@@ -1063,14 +5453,18 @@ def mpd_file_agent():
                 cast_volume = mpd_volume
 
             # Initiate the cast
-            print(args)
+            # this also replaces any queued track
+            cast_listener.reset_media()
+            cast_listener.probe_latency('load', cast_url, 0)
             cast_device.media_controller.play_media(
                     cast_url, 
-                    **args)
+                    **cast_args)
 
             # Note the various specifics of play 
             cast_status = mpd_status
             cast_id = mpd_id
+            cast_next_id = -1
+            cast_queued_id = -1
 
             # Pause and seek to start of track
             # applies to local files and radio streams
@@ -1081,57 +5475,179 @@ def mpd_file_agent():
             mpd_client.seekcur(0)
             cast_confirmed = False
 
+            # The media receiver app, media load and 
+            # first elapsed time are then picked up from
+            # the cast device on later loops
+            cast_launch_deadline = time.monotonic() + gv_cast_load_timeout
+
             # no more to do until next loop
             continue
 
+        # Queue the next MPD track on the cast device 
+        # ahead of the end of the current track
+        # The cast device then moves straight on to it
+        # without a recast. Skipped for repeat of the
+        # same track and radio streams
+        if (stream_type == 'file' and 
+                mpd_status == 'play' and 
+                cast_status == 'play' and 
+                cast_confirmed and 
+                cast_next_id == -1 and 
+                mpd_next_id != -1 and 
+                mpd_next_id != mpd_id and 
+                mpd_duration > 0 and 
+                mpd_duration - mpd_elapsed <= gv_gapless_queue_secs):
+
+            mpd_next_song = mpd_client.playlistid(mpd_next_id)
+            if (len(mpd_next_song) > 0 and 
+                    'file' in mpd_next_song[0]):
+                next_url, next_stream_type, next_args = mpd_song_to_cast_media(
+                        mpd_next_song[0])
+
+                # Incompatible tracks are left for the
+                # cast path to skip
+                if (next_stream_type == 'file' and 
+                        not cast_media_incompatible(
+                            cast_name, 
+                            mpd_next_song[0]['file'])):
+                    log_message(
+                            1,
+                            'Queueing next track URL:%s type:%s' % (
+                                next_url,
+                                next_args['content_type']))
+                    next_args['enqueue'] = True
+                    cast_device.media_controller.play_media(
+                            next_url, 
+                            **next_args)
+                    cast_queued_id = mpd_next_id
+
+            # Only one attempt per track
+            # whether queued or not
+            cast_next_id = mpd_next_id
+            continue
+
+        # Stall detection
+        # Buffering with nothing being sent to the cast 
+        # device means its connection to the media server 
+        # has stalled or gone. A seek to where it is makes
+        # it request the file again
+        if (stream_type == 'file' and 
+                cast_status == 'play' and 
+                cast_confirmed and 
+                cast_listener.content_id == cast_url and 
+                cast_player_state == 'BUFFERING'):
+            if not cast_buffering_timestamp:
+                cast_buffering_timestamp = now
+            idle_secs = egress_idle_secs(cast_device.cast_info.host)
+            if (now - cast_buffering_timestamp >= gv_egress_stall_secs and 
+                    (idle_secs is None or 
+                        idle_secs >= gv_egress_stall_secs)):
+                log_message(
+                        1,
+                        'Stalled Cast Device.. seeking to %.3f secs' % (
+                            cast_position))
+                cast_listener.probe_latency('seek', cast_url, cast_position)
+                cast_device.media_controller.seek(cast_position)
+                cast_buffering_timestamp = now
+                continue
+        else:
+            cast_buffering_timestamp = 0
+
+        # Position sync for file streams only
+        # Radio streams are ignored for this
+        # Also only while the cast device is on MPD's 
+        # track. It moves on to a queued track ahead of
+        # MPD and the positions are then not comparable
+        if not (stream_type == 'file' and
+                mpd_status == 'play' and 
+                cast_status == 'play' and 
+                cast_player_state == 'PLAYING' and
+                cast_listener.content_id == cast_url and 
+                cast_confirmed and 
+                cast_position > 0):
+            continue
+
+        # Drift of MPD from its target position 
+        # (sync lag behind the cast device)
+        mpd_drift = cast_listener.clock.track_drift(
+                mpd_position,
+                gv_sync_lag_secs)
+
+        log_message(
+                gv_verbose,
+                'Sync drift %.3f secs (smoothed %.3f)' % (
+                    mpd_drift,
+                    cast_listener.clock.drift))
+
         # Detect a skip on MPD and issue a seek request on 
         # the cast device.
         #
-        # Make sure the cast is confirmed and only perform the
-        # seek if there is a difference of min 10 seconds
+        # Only perform the seek if there is a large difference
         # That prevents mis-fire if the two elapsed times are 
         # just out of sync versus an actual mpd seek being performed
-        if (stream_type == 'file' and
-                mpd_status == 'play' and 
-                cast_status == 'play' and 
-                cast_confirmed and 
-                cast_elapsed > 0 and 
-                abs(mpd_elapsed - cast_elapsed) >= 10):
+        if abs(mpd_drift) >= gv_seek_detect_secs:
             log_message(
                     1,
-                    'Sync MPD elapsed %d secs to Cast Device' % (
-                        mpd_elapsed))
-            cast_device.media_controller.seek(mpd_elapsed)
+                    'Sync MPD elapsed %.3f secs to Cast Device' % (
+                        mpd_position))
+            # lead by the seek latency
+            seek_position = (mpd_position + gv_sync_lag_secs + 
+                    cast_latency(cast_listener.uuid, 'seek'))
+            cast_listener.probe_latency('seek', cast_url, seek_position)
+            cast_device.media_controller.seek(seek_position)
+            cast_listener.clock.reset_drift()
+            cast_sync_timestamp = time.monotonic()
             continue 
     
-        # Every 10 seconds sync cast device playback 
-        # back to MPD elapsed time if mpd
-        # is at the same time or further on.
-        # Radio streams ignored for this.
-        # The value we then set on mpd is 1 second 
-        # behind the cast device elapsed time.
-        if (stream_type == 'file' and
-                mpd_status == 'play' and 
-                cast_elapsed > 0 and 
-                cast_elapsed % 10 == 0 and
-                (mpd_elapsed >= cast_elapsed or
-                    mpd_elapsed < cast_elapsed - 1)):
-                log_message(
-                        1,
-                        'Sync Cast Device elapsed %d secs to MPD' % (
-                            cast_elapsed))
+        # Correct MPD drift from the cast device once the 
+        # smoothed drift exceeds the configured threshold. 
+        # The hold-off gives each correction time to settle
+        # before the next is considered
+        if (abs(cast_listener.clock.drift) > float(gv_cfg_dict['syncThreshold']) and 
+                time.monotonic() - cast_sync_timestamp >= gv_sync_holdoff_secs):
+            log_message(
+                    1,
+                    'Sync Cast Device elapsed %.3f secs to MPD (drift %.3f)' % (
+                        cast_position,
+                        cast_listener.clock.drift))
+
+            mpd_client.seekcur(
+                    max(0, cast_listener.elapsed() - gv_sync_lag_secs))
+            cast_listener.clock.reset_drift()
+            cast_sync_timestamp = time.monotonic()
+
+
+def mpd_stream_cast_args(cast_mime_type):
+    global gv_platform_variant
+
+    # play_media() arguments for the MPD stream
+    args = {}
+    args['content_type'] = cast_mime_type
 
-                # Value for seek is 1 second behind
-                mpd_client.seekcur(cast_elapsed - 1)
+    # For stream, artwork is a graphic splash with fallback 
+    # of platform title
+    albumart_url = get_mpd_stream_albumart_url()
+    args['title'] = gv_platform_variant
+    if albumart_url:
+        args['thumb'] = albumart_url
 
+    return args
 
-def mpd_stream_agent():
+
+def mpd_stream_agent(generation):
     global gv_server_ip
     global gv_verbose
-    global gv_mpd_agent_timestamp
+    global gv_mpd_agent_generation
     global gv_cfg_dict
+    global gv_stream_relay_port
+    global gv_stream_relay
+    global gv_egress_stall_secs
+    global gv_egress_grace_secs
+    global gv_egress_window_secs
+    global gv_egress_underflow_ratio
 
-    now = int(time.time())
+    now = time.monotonic()
+    scheduler = loop_scheduler('MPD Stream Agent')
 
     # MPD inits
     mpd_client = None
@@ -1145,33 +5661,55 @@ def mpd_stream_agent():
     cast_id = -1
     cast_volume = 0
     cast_confirmed = False
-    cast_failed_update_count = 0
-    max_cast_failed_updates = 20
-    cast_nudge_count = 0
-    max_cast_nudges = 10
+    cast_listener = None
+    leader_connector = None
+    max_cast_disconnected_secs = 20
+    cast_play_timestamp = 0
 
     loop_count = -1
 
     # Fixed stream details
-    cast_url = 'http://%s:8000/' % (gv_server_ip)
+    # via the stream relay if enabled
+    if gv_stream_relay_port:
+        cast_url = 'http://%s:%d/' % (
+                gv_server_ip,
+                gv_stream_relay_port)
+    else:
+        cast_url = 'http://%s:8000/' % (gv_server_ip)
     cast_mime_type = 'audio/flac'
     
     while (True):
+        if generation != gv_mpd_agent_generation:
+            # replaced by the supervisor
+            # the new agent owns the cast device now
+            log_message(1, 'Exiting stale MPD Stream agent')
+            if leader_connector:
+                leader_connector.abandon()
+            return
+
         if gv_cfg_dict['castMode'] != 'mpd':
             log_message(1, 'Exiting MPD Stream agent (config change)')
+            if cast_device:
+                release_cast_device(cast_device)
+            if leader_connector:
+                leader_connector.abandon()
             return
 
         loop_count += 1
 
-        # 1 sec delay per iteration
-        time.sleep(1)
+        # Wait on MPD events with a short fallback
+        # tick interval while casting or reconnecting
+        if (cast_device or 
+                leader_connector or 
+                not mpd_client):
+            scheduler.wait(gv_mpd_active_interval, gv_agent_wake_event)
+        else:
+            scheduler.wait(gv_mpd_passive_interval, gv_agent_wake_event)
 
         print() # log output separator
-        now = int(time.time())
+        now = time.monotonic()
 
-        # Timestamp loop activity for MPD agent
-        # acts as a deadlock detection in main loop
-        gv_mpd_agent_timestamp = now
+        mpd_agent_heartbeat()
 
         if not mpd_client:
             log_message(
@@ -1291,39 +5829,28 @@ def mpd_stream_agent():
         # Cast Device Status
         if (cast_device):
 
-            # We need an updated status from the Cast Device
-            # This can fail sometimes when nothing is really wrong and 
-            # then other times when things are wrong :)
-            #
-            # So we give it a tolerance of 20 consecutive failures
-            try:
-                cast_device.media_controller.update_status()
-                # Reset failed status count
-                cast_failed_update_count = 0
-            except:
-                cast_failed_update_count += 1
+            # Cast device status is pushed to the listener 
+            # so no round-trip is needed here. pychromecast
+            # will reconnect on a lost connection but we give
+            # it a tolerance of 20 seconds to recover
+            if (cast_listener.disconnected_secs() >= max_cast_disconnected_secs):
                 log_message(
                         1,
-                        'Failed to get cast device status... %d/%d' % (
-                            cast_failed_update_count,
-                            max_cast_failed_updates))
-
-                if (cast_failed_update_count >= max_cast_failed_updates):
-                    log_message(
-                            1,
-                            'Detected broken controller after %d status failures' % (
-                                max_cast_failed_updates))
-                    cast_device = None
-                    cast_status = 'none'
-                    cast_id = -1
-                    cast_volume = 0
-                    cast_failed_update_count = 0
-                    continue
+                        'Detected broken controller after %d secs (%s)' % (
+                            max_cast_disconnected_secs,
+                            cast_listener.connection_status))
+                discard_cast_device(cast_device)
+                cast_device = None
+                cast_listener = None
+                cast_status = 'none'
+                cast_id = -1
+                cast_volume = 0
+                continue
 
             # Elapsed time as reported by the cast device
-            cast_elapsed = int(cast_device.media_controller.status.current_time)
+            cast_elapsed = int(cast_listener.elapsed())
             # Cast player state as reported by the device
-            cast_player_state = cast_device.media_controller.status.player_state
+            cast_player_state = cast_listener.player_state
 
             cast_elapsed_mins = int(cast_elapsed / 60)
             cast_elapsed_secs = cast_elapsed % 60
@@ -1340,7 +5867,7 @@ def mpd_stream_agent():
 
         # Configured Cast Device change
         # Clear existing device handle
-        if (cast_name != gv_cfg_dict['castDevice']):
+        if (cast_name != cast_target_names()[0]):
             # Stop media player of existing device
             # if it exists
             if (cast_device):
@@ -1348,47 +5875,86 @@ def mpd_stream_agent():
                         1,
                         'Detected Cast Device change from %s -> %s' % (
                             cast_name,
-                            gv_cfg_dict['castDevice']))
+                            cast_target_names()[0]))
                 cast_device.media_controller.stop()
                 cast_device.quit_app()
                 cast_status = mpd_status
+                release_cast_device(cast_device)
                 cast_device = None
+                cast_listener = None
                 cast_volume = 0
                 continue
 
-
+        # Multi-room followers
+        # Each follower pulls the live stream itself and
+        # recasts on resume or a PCM format change
+        session_target = {}
+        session_target['state'] = mpd_status
+        session_target['url'] = cast_url
+        session_target['args'] = mpd_stream_cast_args(cast_mime_type)
+        session_target['file'] = None
+        session_target['mediaId'] = mpd_audio_format
+        if gv_stream_relay and gv_stream_relay.normaliser:
+            session_target['mediaId'] = gv_stream_relay.normaliser.format_str()
+        session_target['resumeRecast'] = True
+        session_target['volume'] = mpd_volume
+        session_target['position'] = None
+        session_target['startAt'] = None
+        session_target['timestamp'] = time.monotonic()
+        cast_sessions_update(session_target)
 
         # Get cast device when in play state and 
         # no device curently present
+        # Connected in the background and picked up 
+        # here on a later loop so followers keep 
+        # getting targets while the leader is slow
         if (mpd_status == 'play' and 
-                gv_cfg_dict['castDevice'] != 'Disabled' and 
-                not cast_device):
-            cast_device = get_cast_device(gv_cfg_dict['castDevice'])
+                cast_target_names()[0] != 'Disabled' and 
+                not cast_device and 
+                not leader_connector):
+            leader_connector = cast_connector(
+                    cast_target_names()[0],
+                    quit_app = False)
+
+        if (leader_connector and 
+                leader_connector.done()):
+            cast_device, cast_listener = leader_connector.result
+            cast_name = leader_connector.name
+            leader_connector = None
 
             # nothing to do if this fails
             if not cast_device:
                 continue
 
-            cast_name = gv_cfg_dict['castDevice']
-            cast_device.wait()
-            force_cast = True
+            force_cast = mpd_status == 'play'
 
 
         # MPD audio PCM change
-        # simply forces a recast
+        # simply forces a recast unless the stream 
+        # normaliser keeps the cast format fixed
         if (mpd_audio_format and cast_device and 
                 mpd_audio_format != cast_audio_format):
-            log_message(
-                    1,
-                    'Forcing recast.. PCM audio change from %s -> %s' % (
-                        cast_audio_format, 
-                        mpd_audio_format)
-                    )
-            force_cast = True
+            if gv_stream_relay and gv_stream_relay.normaliser:
+                log_message(
+                        1,
+                        'PCM audio change from %s -> %s (normalised to %s)' % (
+                            cast_audio_format, 
+                            mpd_audio_format,
+                            gv_stream_relay.normaliser.format_str())
+                        )
+                cast_audio_format = mpd_audio_format
+            else:
+                log_message(
+                        1,
+                        'Forcing recast.. PCM audio change from %s -> %s' % (
+                            cast_audio_format, 
+                            mpd_audio_format)
+                        )
+                force_cast = True
 
-            # Also rewind track to start
-            # We can lose 1-2 seconds playback otherwise
-            mpd_client.seekcur(0)
+                # Also rewind track to start
+                # We can lose 1-2 seconds playback otherwise
+                mpd_client.seekcur(0)
 
         # MPD -> Cast Device Events
         # Anything that is driven from detecting changes
@@ -1407,21 +5973,12 @@ def mpd_stream_agent():
                         cast_url,
                         cast_mime_type))
 
-            args = {}
-            args['content_type'] = cast_mime_type
-
-            # For stream, artwork is a graphic splash with fallback 
-            # of platform title
-            albumart_url = get_mpd_stream_albumart_url()
-            args['title'] = gv_platform_variant
-            if albumart_url:
-                args['thumb'] = albumart_url
+            args = mpd_stream_cast_args(cast_mime_type)
+            if 'thumb' in args:
                 log_message(
                         1,
                         'Stream Albumart URL:%s' % (
-                            albumart_url))
-            else:
-                args['title'] = gv_platform_variant
+                            args['thumb']))
 
             # Volume sync before we cast
             if (mpd_volume != -1):
@@ -1441,6 +5998,7 @@ def mpd_stream_agent():
                     **args)
             cast_status = mpd_status
             cast_audio_format = mpd_audio_format
+            cast_play_timestamp = time.monotonic()
             force_cast = False
             continue
 
@@ -1457,38 +6015,43 @@ def mpd_stream_agent():
             cast_volume = mpd_volume
             continue
 
-        # Gentle play nudge on stream
-        # if elapsed time is not incrementing
+        # Stall detection
+        # A playing cast device keeps pulling the stream 
+        # from the relay at the rate MPD produces it. One 
+        # that has stopped pulling or is falling behind 
+        # is recast. Without the relay, elapsed time not
+        # moving is all there is to go on
         if (cast_status == 'play' and 
-                mpd_status == 'play' and
-                cast_elapsed == 0):
-
-            # 5-second grace and we will force a recast
-            if cast_nudge_count >= max_cast_nudges:
+                mpd_status == 'play' and 
+                now - cast_play_timestamp >= gv_egress_grace_secs):
+
+            stall_reason = None
+            if gv_stream_relay:
+                cast_host = cast_device.cast_info.host
+                idle_secs = egress_idle_secs(cast_host)
+                stream_rate = gv_stream_relay.ingress_rate()
+                cast_rate = egress_rate(cast_host)
+                if (idle_secs is None or 
+                        idle_secs >= gv_egress_stall_secs):
+                    stall_reason = 'no stream data sent'
+                elif (stream_rate > 0 and 
+                        now - cast_play_timestamp >= gv_egress_window_secs and 
+                        cast_rate < stream_rate * gv_egress_underflow_ratio):
+                    stall_reason = 'underflow %d/%d bytes/sec' % (
+                            cast_rate,
+                            stream_rate)
+            elif (cast_elapsed == 0 and 
+                    now - cast_play_timestamp >= gv_egress_grace_secs + gv_egress_stall_secs):
+                stall_reason = 'elapsed time not moving'
+
+            if stall_reason:
                 log_message(
                         1,
-                        'Forcing recast.. max nudge count %d exceeded' % (
-                            max_cast_nudges)
-                        )
+                        'Forcing recast.. stalled cast device (%s)' % (
+                            stall_reason))
                 force_cast = True
-                cast_nudge_count = 0
                 continue
 
-            # Normal nudge to try and get the stream playing
-            cast_nudge_count += 1
-            log_message(
-                    1,
-                    'Nudging cast device to play #%d/%d' % (
-                        cast_nudge_count,
-                        max_cast_nudges))
-            cast_device.media_controller.play()
-
-        # Nudge count reset
-        if (cast_status == 'play' and 
-                mpd_status == 'play' and
-                cast_elapsed > 0):
-            cast_nudge_count = 0
-
         # Pause
         if (cast_status != 'pause' and
             mpd_status == 'pause'):
@@ -1523,30 +6086,187 @@ def mpd_stream_agent():
             cast_device.media_controller.stop()
             cast_device.quit_app()
             cast_status = mpd_status
+            release_cast_device(cast_device)
             cast_device = None
+            cast_listener = None
             cast_volume = 0
             continue  
 
 
 def mpd_cast_wrapper_agent():
     global gv_cfg_dict
+    global gv_mpd_agent_generation
 
-    while (True):
+    # generation this agent was started under
+    generation = gv_mpd_agent_generation
+
+    while (generation == gv_mpd_agent_generation):
 
         if gv_cfg_dict['castMode'] == 'direct':
             # MPD File Agent
             log_message(1, 'Starting MPD File Agent')
-            mpd_file_agent()
+            mpd_file_agent(generation)
             continue
 
         if gv_cfg_dict['castMode'] == 'mpd':
             # MPD Stream Agent
             log_message(1, 'Starting MPD Stream Agent')
-            mpd_stream_agent()
+            mpd_stream_agent(generation)
             continue
 
+        mpd_agent_heartbeat()
         time.sleep(5)
 
+
+def register_agent(name, func, heartbeat_func = None):
+    global gv_agent_dict
+
+    # Add a long-lived agent for supervision
+    # heartbeat_func returns the time of last activity
+    # for agents subject to stall detection
+    agent_dict = {}
+    agent_dict['func'] = func
+    agent_dict['heartbeat_func'] = heartbeat_func
+    agent_dict['future'] = None
+    agent_dict['started'] = 0
+    agent_dict['started_time'] = 0
+    agent_dict['restarts'] = 0
+    agent_dict['backoff'] = 0
+    agent_dict['restart_at'] = 0
+    agent_dict['failed_at'] = 0
+    agent_dict['last_failure'] = None
+    agent_dict['recovery_secs'] = None
+    gv_agent_dict[name] = agent_dict
+
+    start_agent(name)
+
+    return
+
+
+def start_agent(name):
+    global gv_agent_dict
+    global gv_executor
+
+    agent_dict = gv_agent_dict[name]
+    log_message(
+            1,
+            'Starting agent [%s]' % (name))
+    agent_dict['future'] = gv_executor.submit(agent_dict['func'])
+    agent_dict['started'] = time.monotonic()
+    agent_dict['started_time'] = int(time.time())
+
+    if agent_dict['failed_at']:
+        agent_dict['recovery_secs'] = round(
+                time.monotonic() - agent_dict['failed_at'], 3)
+        agent_dict['failed_at'] = 0
+        log_message(
+                1,
+                'Agent [%s] recovered in %.3f secs (restart #%d)' % (
+                    name,
+                    agent_dict['recovery_secs'],
+                    agent_dict['restarts']))
+
+    return
+
+
+def agent_failed(name, reason):
+    global gv_agent_dict
+    global gv_agent_max_backoff_secs
+    global gv_agent_stable_secs
+
+    # Schedule a restart of a failed agent
+    # Backoff doubles on repeated failures and resets 
+    # once an agent has run for a stable period
+    agent_dict = gv_agent_dict[name]
+    now = time.monotonic()
+
+    if now - agent_dict['started'] >= gv_agent_stable_secs:
+        agent_dict['backoff'] = 0
+    elif agent_dict['backoff'] == 0:
+        agent_dict['backoff'] = 1
+    else:
+        agent_dict['backoff'] = min(
+                agent_dict['backoff'] * 2,
+                gv_agent_max_backoff_secs)
+
+    agent_dict['future'] = None
+    agent_dict['restarts'] += 1
+    agent_dict['failed_at'] = now
+    agent_dict['restart_at'] = now + agent_dict['backoff']
+    agent_dict['last_failure'] = reason
+
+    log_message(
+            1,
+            'Agent [%s] failed (%s).. restarting in %d secs' % (
+                name,
+                reason,
+                agent_dict['backoff']))
+
+    return
+
+
+def supervise_agents():
+    global gv_agent_dict
+    global gv_agent_abandoned_list
+    global gv_agent_spare_workers
+    global gv_mpd_agent_generation
+    global gv_mpd_agent_deadlock_secs
+
+    now = time.monotonic()
+
+    for name in gv_agent_dict:
+        agent_dict = gv_agent_dict[name]
+        future = agent_dict['future']
+
+        # pending restart
+        if not future:
+            if now >= agent_dict['restart_at']:
+                start_agent(name)
+            continue
+
+        if future.done():
+            exception = future.exception()
+            if exception:
+                traceback.print_exception(
+                        type(exception),
+                        exception,
+                        exception.__traceback__)
+                agent_failed(name, repr(exception))
+            else:
+                agent_failed(name, 'exited')
+            continue
+
+        # Stall detection
+        # The MPD loop runs more or less on a 
+        # 1-second interval. It will delay and 
+        # potentially lock-up if either an MPD or pychromecast
+        # call goes bad. A stalled agent thread can't be killed
+        # so it is abandoned and replaced by a new generation
+        if not agent_dict['heartbeat_func']:
+            continue
+
+        heartbeat = agent_dict['heartbeat_func']()
+        if (heartbeat > 0 and 
+                heartbeat > agent_dict['started'] and 
+                now - heartbeat >= gv_mpd_agent_deadlock_secs):
+            gv_mpd_agent_generation += 1
+            gv_agent_abandoned_list.append(future)
+            agent_failed(name, 'stalled for %d secs' % (now - heartbeat))
+
+    # Last resort if stalled threads are not exiting 
+    # and we run out of spare workers
+    gv_agent_abandoned_list = [future for future in gv_agent_abandoned_list 
+            if not future.done()]
+    if len(gv_agent_abandoned_list) >= gv_agent_spare_workers:
+        log_message(
+                1,
+                'Detected %d stalled agents... exiting' % (
+                    len(gv_agent_abandoned_list)))
+        os._exit(1) 
+
+    return
+
+
 # main()
 
 parser = argparse.ArgumentParser(
@@ -1557,9 +6277,35 @@ parser.add_argument(
         help = 'Enable verbose output', 
         action = 'store_true')
 
+parser.add_argument(
+        '--media_workers', 
+        help = 'Serve media files from this many worker processes (default 0, in-process)', 
+        type = int,
+        default = 0)
+
+parser.add_argument(
+        '--stream_relay_port', 
+        help = 'Relay MPD stream output to cast devices on this port (default 8092, 0 to cast MPD directly)', 
+        type = int,
+        default = 8092)
+
+parser.add_argument(
+        '--stream_format', 
+        help = 'Normalise the relayed MPD stream to this samplerate:bits:channels, eg 48000:16:2 (needs ffmpeg)', 
+        default = None)
+
+parser.add_argument(
+        '--mpd_stream_url', 
+        help = 'MPD httpd stream output URL (default http://localhost:8000/)', 
+        default = 'http://localhost:8000/')
+
 
 args = vars(parser.parse_args())
 gv_verbose = args['verbose']
+gv_media_workers = args['media_workers']
+gv_stream_relay_port = args['stream_relay_port']
+gv_mpd_stream_url = args['mpd_stream_url']
+gv_stream_format = args['stream_format']
 
 # Determine the main IP address of the server
 s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -1570,61 +6316,128 @@ s.close()
 # Determine variant
 determine_platform_variant()
 
-# Thread management 
-executor = concurrent.futures.ThreadPoolExecutor(
-        max_workers = 20)
-future_dict = {}
+# Config file
+home = os.path.expanduser('~')
+gv_cfg_filename = home + '/.mpd2chromecast'   
+log_message(
+        1,
+        'Config file is %s' % (gv_cfg_filename))
+check_config()
+
+# Cache dir
+gv_cache_dir = home + '/.cache/mpd2chromecast'
+os.makedirs(gv_cache_dir, exist_ok = True)
+if gv_art_disk_cache:
+    gv_art_cache_dir = gv_cache_dir + '/art'
+    os.makedirs(gv_art_cache_dir, exist_ok = True)
+gv_thumb_cache_dir = gv_cache_dir + '/thumbs'
+os.makedirs(gv_thumb_cache_dir, exist_ok = True)
+gv_art_store_dir = gv_cache_dir + '/artstore'
+os.makedirs(gv_art_store_dir, exist_ok = True)
+
+# Media server worker processes
+# forked ahead of any threads and
+# the library database connection
+if gv_media_workers > 0:
+    start_media_workers(gv_media_workers)
+
+# Library index
+gv_library_db_file = gv_cache_dir + '/library.db'
+library_init()
+
+# Cast Device Discovery
+# preloaded from the cache of the last run
+# and then runs on zeroconf threads
+gv_cast_devices_cache_file = gv_cache_dir + '/cast_devices.json'
+load_cast_devices_cache()
+start_cast_device_discovery()
+
+# Learnt cast device latencies
+gv_cast_latency_file = gv_cache_dir + '/cast_latency.json'
+load_cast_latency()
 
-# Config Agent
-future_dict['Config Agent'] = executor.submit(
-        config_agent)
+# Thread management 
+# one worker per long-lived agent plus spares 
+# for replaced stalled agents
+gv_executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers = 6 + gv_agent_spare_workers)
 
 # Cherry Py web server
-future_dict['Web Server'] = executor.submit(
+register_agent(
+        'Web Server', 
         web_server)
 
-# Cast Device Discovery Agent
-future_dict['Cast Device Discovery Agent'] = executor.submit(
-        cast_device_discovery_agent)
+# Media server
+# in-process unless running as worker processes
+if gv_media_workers == 0:
+    register_agent(
+            'Media Server', 
+            media_server)
+
+# MPD stream relay
+if gv_stream_relay_port:
+    gv_stream_relay = stream_relay(gv_mpd_stream_url)
+    if gv_stream_format:
+        try:
+            samplerate, bits, channels = [int(value) for value in gv_stream_format.split(':')]
+            if bits not in [16, 24]:
+                raise ValueError('bits must be 16 or 24')
+            if not shutil.which('ffmpeg'):
+                raise ValueError('ffmpeg not found')
+            gv_stream_relay.normaliser = stream_normaliser(
+                    samplerate,
+                    bits,
+                    channels)
+        except ValueError as error:
+            log_message(
+                    1,
+                    'Stream format %s not used (%s)' % (
+                        gv_stream_format,
+                        error))
+    register_agent(
+            'Stream Relay', 
+            stream_relay_server)
+
+# MPD Idle Agent
+register_agent(
+        'MPD Idle Agent', 
+        mpd_idle_agent)
+
+# Library index agent
+register_agent(
+        'Library Agent', 
+        library_agent)
 
 # MPD Cast Wrapper Agent
-future_dict['MPD Cast Wrapper Agent'] = executor.submit(
-        mpd_cast_wrapper_agent)
+register_agent(
+        'MPD Cast Wrapper Agent', 
+        mpd_cast_wrapper_agent,
+        lambda: gv_mpd_agent_timestamp)
 
 # main loop
+# 1-second agent supervision with
+# 5-second housekeeping
+loop_count = -1
+scheduler = loop_scheduler('Main')
 while (True):
-    exception_dict = {}
-    log_message(
-            gv_verbose, 
-            'threads:%s' % (
-                future_dict)
-            )
+    scheduler.wait(1)
+    loop_count += 1
 
-    for key in future_dict:
-        future = future_dict[key]
-        if future.done():
-            if future.exception():
-                exception_dict[key] = future.exception()
+    supervise_agents()
+    supervise_media_workers()
 
-    if (len(exception_dict) > 0):
+    if loop_count % 5 == 0:
         log_message(
-                1,
-                'Exceptions Detected:\n%s' % (
-                    exception_dict)
+                gv_verbose, 
+                'agents:%s' % (
+                    {name: gv_agent_dict[name]['future'] for name in gv_agent_dict})
                 )
-        os._exit(1) 
-    
-    # MPD/Cast Device deadlock
-    # The MPD loop runs more or less on a 
-    # 1-second interval. It will delay and 
-    # potentially lock-up if either an MPD or pychromecast
-    # call goes bad. This will detect 30 seconds deadlock and exit
-    now = int(time.time())
-    if (gv_mpd_agent_timestamp > 0 and 
-            now - gv_mpd_agent_timestamp >= 30):
-        log_message(
-                1,
-                'Detected deadlocked MPD agent... exiting')
-        os._exit(1) 
-        
-    time.sleep(5)
+
+        # check for config changes
+        check_config()
+
+        # Cast device pool eviction and pre-connect
+        cast_pool_maintenance()
+
+        # Learnt cast latencies
+        save_cast_latency()
@@ -0,0 +1,207 @@
+import os
+import sys
+import threading
+import time
+import types
+
+# Drives the MPD File Agent against a fake MPD and
+# cast device to check gapless queueing around a next
+# track the cast device can't play
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+
+def load_script():
+    # The script starts its agents at module level
+    # so only the definitions ahead of main() are run
+    script_path = os.path.join(repo_dir, 'mpd2chromecast.py')
+    with open(script_path, 'r') as script_file:
+        source = script_file.read()
+    script_dict = {'__name__': 'mpd2chromecast'}
+    exec(
+            compile(source[:source.index('# main()')], script_path, 'exec'),
+            script_dict)
+
+    return script_dict
+
+
+class fake_mpd(object):
+    # MPD near the end of track 1 with the
+    # unplayable track 2 and then track 3 after it
+    def __init__(self, calls):
+        self.calls = calls
+        self.song_id = '1'
+        self.paused = False
+
+    def connect(self, host, port):
+        pass
+
+    def status(self):
+        status_dict = {}
+        status_dict['state'] = 'pause' if self.paused else 'play'
+        status_dict['volume'] = '40'
+        status_dict['elapsed'] = '195.0'
+        status_dict['duration'] = '200'
+        status_dict['nextsongid'] = str(int(self.song_id) + 1)
+        return status_dict
+
+    def song(self, song_id):
+        name = 'bad' if song_id == '2' else 'good'
+        return {'file': 'album/%s%s.flac' % (name, song_id), 'id': song_id}
+
+    def currentsong(self):
+        return self.song(self.song_id)
+
+    def playlistid(self, song_id):
+        self.calls.append(('playlistid', song_id))
+        return [self.song(song_id)]
+
+    def pause(self, paused):
+        self.paused = bool(paused)
+
+    def seekcur(self, position):
+        pass
+
+    def next(self):
+        self.calls.append(('next', self.song_id))
+        self.song_id = str(int(self.song_id) + 1)
+
+
+class fake_clock(object):
+    drift = 0
+
+    def reset_drift(self):
+        pass
+
+    def track_drift(self, position, lag):
+        return 0
+
+
+class fake_listener(object):
+    # Reports whatever was last cast as playing
+    # from 195 secs so the cast is confirmed at once
+    def __init__(self):
+        self.uuid = 'leader'
+        self.player_state = 'IDLE'
+        self.content_id = None
+        self.duration = 200
+        self.app_id = None
+        self.connection_status = 'CONNECTED'
+        self.clock = fake_clock()
+
+    def disconnected_secs(self):
+        return 0
+
+    def elapsed(self):
+        return 195.0 if self.content_id else 0
+
+    def reset_media(self):
+        pass
+
+    def probe_latency(self, kind, content_id, position):
+        pass
+
+    def wait_for(self, condition, timeout):
+        return True
+
+
+class fake_media_controller(object):
+    def __init__(self, listener, calls):
+        self.listener = listener
+        self.calls = calls
+
+    def play_media(self, url, **args):
+        self.calls.append(('play_media', url, args.get('enqueue', False)))
+        if not args.get('enqueue'):
+            self.listener.content_id = url
+            self.listener.player_state = 'PLAYING'
+
+    def queue_next(self):
+        self.calls.append(('queue_next',))
+
+    def seek(self, position):
+        pass
+
+    def pause(self):
+        pass
+
+    def play(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class fake_device(object):
+    def __init__(self, calls):
+        self.uuid = 'leader'
+        self.is_idle = True
+        self.cast_info = types.SimpleNamespace(host='127.0.0.2')
+        self.listener = fake_listener()
+        self.media_controller = fake_media_controller(self.listener, calls)
+
+    def wait(self, timeout = None):
+        pass
+
+    def set_volume(self, volume):
+        pass
+
+    def quit_app(self):
+        pass
+
+
+def test_incompatible_next_track_is_skipped_not_taken_as_gapless():
+    script_dict = load_script()
+    calls = []
+    mpd_client = fake_mpd(calls)
+    device = fake_device(calls)
+
+    script_dict['log_message'] = lambda verbose, message: None
+    script_dict['print'] = lambda *args: None
+    script_dict['mpd'] = types.SimpleNamespace(
+            MPDClient = lambda: mpd_client,
+            MPDError = Exception)
+    script_dict['get_cast_device'] = lambda name: (device, device.listener)
+    script_dict['release_cast_device'] = lambda device: None
+    script_dict['discard_cast_device'] = lambda device: None
+    script_dict['mpd_song_to_cast_media'] = lambda song: (
+            'http://media/%s' % (song['id']),
+            'file',
+            {'content_type': 'audio/flac'})
+    script_dict['cast_media_incompatible'] = lambda name, mpd_file: (
+            'unsupported codec' if 'bad' in mpd_file else None)
+    script_dict['gv_verbose'] = False
+    script_dict['gv_cfg_dict']['castDevice'] = 'Leader'
+    script_dict['gv_cfg_dict']['castMode'] = 'direct'
+    script_dict['gv_mpd_active_interval'] = 0.05
+    script_dict['gv_mpd_agent_generation'] = 1
+
+    agent_thread = threading.Thread(
+            target = script_dict['mpd_file_agent'],
+            args = (1,),
+            daemon = True)
+    agent_thread.start()
+
+    # Track 1 cast and the attempt to queue track 2
+    # then MPD moves on to track 2
+    deadline = time.monotonic() + 10
+    while (('playlistid', '2') not in calls and
+            time.monotonic() < deadline):
+        time.sleep(0.05)
+    mpd_client.song_id = '2'
+
+    while (('play_media', 'http://media/3', False) not in calls and
+            time.monotonic() < deadline):
+        time.sleep(0.05)
+
+    script_dict['gv_mpd_agent_generation'] = 2
+    agent_thread.join(timeout = 5)
+
+    # Track 2 was never queued or treated as queued,
+    # MPD was skipped past it and track 3 was cast
+    assert ('play_media', 'http://media/1', False) in calls
+    assert ('play_media', 'http://media/2', True) not in calls
+    assert ('queue_next',) not in calls
+    assert ('next', '2') in calls
+    assert ('play_media', 'http://media/3', False) in calls